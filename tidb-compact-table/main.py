@@ -26,6 +26,12 @@ else:
     import urllib.request as request
     from queue import Queue
 
+# 集群拓扑优先从tiup的meta.yaml中读取，没有安装pyyaml时使用tiup cluster display
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 region_queue = Queue(100)  # 内容为（dbname,tabname,region_id）的元组
 
 
@@ -227,7 +233,10 @@ class TableInfo:
 
 
 # 一个region可能包含多个sstfile
-class Region:
+# region、副本和sstfile的数量都可能达到百万级，使用__slots__避免每个对象都带一个__dict__
+class Region(object):
+    __slots__ = ("region_id", "leader_id", "leader_store_id", "leader_store_node_id", "sstfile_list", "peers")
+
     def __init__(self):
         self.region_id = 0
         self.leader_id = 0
@@ -238,14 +247,18 @@ class Region:
         self.peers = []
 
 
-class Peer:
+class Peer(object):
+    __slots__ = ("region_id", "peer_id", "store_id")
+
     def __init__(self):
         self.region_id = 0
         self.peer_id = 0
         self.store_id = 0
 
 
-class SSTFile:
+class SSTFile(object):
+    __slots__ = ("sst_name", "sst_size", "sst_node_id", "region_id_list")
+
     def __init__(self):
         self.sst_name = ""
         self.sst_size = 0
@@ -272,8 +285,99 @@ class TiDBCluster:
         # 老版本情况：https://github.com/tikv/tikv/blob/09a7e1efb40386d804f42ef6ba593f6b85924973/src/server/debug.rs#L918
         self.property_only_writecf_mode = False  # 目前根据region的property结果来判断，todo 最好按照tidb的版本来判断
 
+    # meta.yaml中每种角色的配置项名称，以及端口配置项和默认值，端口顺序和tiup cluster display的Ports列一致
+    meta_role_specs = [
+        ("alertmanager", "alertmanager_servers", [("web_port", 9093), ("cluster_port", 9094)]),
+        ("grafana", "grafana_servers", [("port", 3000)]),
+        ("pd", "pd_servers", [("client_port", 2379), ("peer_port", 2380)]),
+        ("prometheus", "monitoring_servers", [("port", 9090), ("ng_port", 12020)]),
+        ("tidb", "tidb_servers", [("port", 4000), ("status_port", 10080)]),
+        ("tiflash", "tiflash_servers", [("tcp_port", 9000), ("http_port", 8123), ("flash_service_port", 3930),
+                                        ("flash_proxy_port", 20170), ("flash_proxy_status_port", 20292),
+                                        ("metrics_port", 8234)]),
+        ("tikv", "tikv_servers", [("port", 20160), ("status_port", 20180)]),
+    ]
+
     def _get_clusterinfo(self):
         log.debug("TiDBCluster._get_clusterinfo")
+        if not self._get_clusterinfo_bymeta():
+            self._get_clusterinfo_bydisplay()
+
+    # 从tiup的meta.yaml中获取集群拓扑，不访问任何节点，没有安装pyyaml或者找不到meta.yaml时返回False
+    def _get_clusterinfo_bymeta(self):
+        tiup_home = os.environ.get("TIUP_HOME", os.path.expanduser("~/.tiup"))
+        meta_file = os.path.join(tiup_home, "storage", "cluster", "clusters", self.cluster_name, "meta.yaml")
+        if yaml is None:
+            log.info("pyyaml is not installed,get cluster info by tiup cluster display")
+            return False
+        if not os.path.isfile(meta_file):
+            log.info("cannot find %s,get cluster info by tiup cluster display" % (meta_file))
+            return False
+        log.debug("TiDBCluster._get_clusterinfo_bymeta,meta file:%s" % (meta_file))
+        with open(meta_file) as f:
+            meta = yaml.safe_load(f) or {}
+        self.cluster_version = str(meta.get("tidb_version", ""))
+        topology = meta.get("topology") or {}
+        global_spec = topology.get("global") or {}
+        user = global_spec.get("user") or meta.get("user") or "tidb"
+        global_deploy_dir = global_spec.get("deploy_dir") or "deploy"
+        global_data_dir = global_spec.get("data_dir") or "data"
+        for role, servers_key, port_keys in TiDBCluster.meta_role_specs:
+            for spec in topology.get(servers_key) or []:
+                ports = [int(spec.get(port_key) or default_port) for port_key, default_port in port_keys]
+                node = Node()
+                node.role = role
+                node.host = str(spec["host"])
+                node.service_port = ports[0]
+                if len(ports) > 1:
+                    node.status_port = ports[1]
+                node.id = "%s:%d" % (node.host, node.service_port)
+                # 和tiup的规则一致：实例没有配置目录时使用global中的目录，相对路径的deploy_dir在/home/<user>下，
+                # 相对路径的data_dir在实例的deploy_dir下
+                dir_name = "%s-%d" % (role, node.service_port)
+                deploy_dir = spec.get("deploy_dir") or os.path.join(global_deploy_dir, dir_name)
+                if not os.path.isabs(deploy_dir):
+                    deploy_dir = os.path.join("/home", user, deploy_dir)
+                if role in ("tidb", "grafana"):
+                    node.data_dir = "-"
+                elif spec.get("data_dir"):
+                    node.data_dir = spec["data_dir"] if os.path.isabs(spec["data_dir"]) else os.path.join(
+                        deploy_dir, spec["data_dir"])
+                elif os.path.isabs(global_data_dir):
+                    node.data_dir = os.path.join(global_data_dir, dir_name)
+                else:
+                    node.data_dir = os.path.join(deploy_dir, global_data_dir)
+                self.tidb_nodes.append(node)
+        log.info("cluster:%s,version:%s,nodes:%d from meta.yaml" % (
+            self.cluster_name, self.cluster_version, len(self.tidb_nodes)))
+        return True
+
+    # 通过tiup cluster display检查节点状态，去掉状态不是Up（Healthy）的节点，比如Down、Tombstone、Pending Offline
+    def check_liveness(self):
+        display_command = "tiup cluster display %s" % (self.cluster_name)
+        result, recode = command_run(display_command, timeout=300)
+        if recode != 0:
+            raise Exception("tiup display error:%s" % result)
+        status_map = {}  # key:node_id,value:状态
+        for each_line in result.splitlines():
+            each_line_fields = each_line.split()
+            # 状态可能包含空格（Pending Offline），位于Ports/OS/Arch之后、Data Dir/Deploy Dir之前
+            if len(each_line_fields) >= 8 and each_line_fields[1] in TiDBCluster.roles:
+                status_map[each_line_fields[0]] = " ".join(each_line_fields[5:-2])
+        alive_nodes = []
+        for node in self.tidb_nodes:
+            status = status_map.get(node.id, "")
+            if status == "" or status.startswith("Up") or status.startswith("Healthy"):
+                alive_nodes.append(node)
+            else:
+                log.warning("node:%s,role:%s,status:%s,ignore it" % (node.id, node.role, status))
+        removed_count = len(self.tidb_nodes) - len(alive_nodes)
+        self.tidb_nodes = alive_nodes
+        return removed_count
+
+    # 通过tiup cluster display获取集群拓扑，display会检查每个节点的状态，集群较大时需要数秒
+    def _get_clusterinfo_bydisplay(self):
+        log.debug("TiDBCluster._get_clusterinfo_bydisplay")
         display_command = "tiup cluster display %s" % (self.cluster_name)
         result, recode = command_run(display_command)
         log.debug("tiup display command:%s" % (display_command))
@@ -896,9 +1000,11 @@ def tiup_ctl_tikv_run(cluster, address, region_id, threads=4):
     return total_compact_count, err_compact_count
 
 
-def compact_tables(cluster_name, table_list, threads):
+def compact_tables(cluster_name, table_list, threads, check_liveness=False):
     table_compact_err_count_map = {}  # 记录每张表一共执行多少次compact和失败了多少次
     cluster = TiDBCluster(cluster_name)
+    if check_liveness:
+        cluster.check_liveness()
     store_list = cluster.get_all_stores()
     for each_table in table_list:
         tabschema, tablename = each_table.split(".")
@@ -939,6 +1045,8 @@ if __name__ == "__main__":
     arg_parser.add_argument('-t', '--tables', type=str, required=True,
                             help='table name,muti table should like this "schema1.t1,schema1.t2,schema2.t3"')
     arg_parser.add_argument('-p', '--parallel', default=4, type=int, help='region compact threads')
+    arg_parser.add_argument('--check-liveness', action='store_true',
+                            help='check node status by tiup cluster display and ignore nodes that are not up')
     args = arg_parser.parse_args()
     # log_filename = sys.argv[0] + ".log"
     # log.basicConfig(filename=log_filename, filemode='a', level=log.INFO, format='%(asctime)s - %(name)s-%(filename)s[line:%(lineno)d] - %(levelname)s - %(message)s')
@@ -946,7 +1054,7 @@ if __name__ == "__main__":
                     format='%(asctime)s - %(name)s-%(filename)s[line:%(lineno)d] - %(levelname)s - %(message)s')
     cname, tabnamelist, parallel = args.cluster, args.tables, args.parallel
     tables_list = tabnamelist.split(",")
-    table_compact_err_count_map = compact_tables(cname, tables_list, parallel)
+    table_compact_err_count_map = compact_tables(cname, tables_list, parallel, args.check_liveness)
     for each_table in table_compact_err_count_map:
         log.info("tabname:%s, compact count:%d, error ccompact count:%d" % (
             each_table, table_compact_err_count_map[each_table][0], table_compact_err_count_map[each_table][1]))
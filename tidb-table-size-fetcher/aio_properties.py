@@ -0,0 +1,164 @@
+# encoding=utf8
+# 基于asyncio的region-properties查询引擎，仅python3可用（main.py中按isV3条件导入）
+# 每个store一个独立队列，每个store最多store_parallel个常驻worker进程，整个集群最多parallel个并发查询
+# 查询全部通过asyncio子进程完成，成千上万个在途查询不占用额外的OS线程
+import asyncio
+import logging as log
+import os
+import signal
+import sys
+
+
+class _StoreWorker(object):
+    def __init__(self, script, end_marker, timeout):
+        self.script = script
+        self.end_marker = end_marker
+        self.timeout = timeout
+        self._proc = None
+
+    async def _start(self):
+        # limit调大，避免sst_files较多时单行超过StreamReader的默认64KB限制
+        self._proc = await asyncio.create_subprocess_exec("sh", "-c", self.script, stdin=asyncio.subprocess.PIPE,
+                                                          stdout=asyncio.subprocess.PIPE,
+                                                          stderr=asyncio.subprocess.STDOUT, limit=1 << 20,
+                                                          start_new_session=True)
+
+    async def _read_result(self):
+        lines = []
+        while True:
+            line = (await self._proc.stdout.readline()).decode("utf-8", "replace")
+            if line == "":
+                return "".join(lines) + "region-properties worker exited", 1
+            if line.startswith(self.end_marker):
+                fields = line.split()
+                recode = int(fields[2]) if len(fields) == 3 and fields[2].isdigit() else 1
+                return "".join(lines), recode
+            lines.append(line)
+
+    def _kill(self):
+        try:
+            os.killpg(self._proc.pid, signal.SIGKILL)
+        except Exception as e:
+            log.debug("async region-properties worker kill error:%s" % (e))
+
+    async def query(self, region_id):
+        if self._proc is None or self._proc.returncode is not None:
+            await self._start()
+        try:
+            self._proc.stdin.write(("%d\n" % (region_id)).encode())
+            await self._proc.stdin.drain()
+            result, recode = await asyncio.wait_for(self._read_result(), self.timeout)
+        except asyncio.TimeoutError:
+            self._kill()
+            await self._proc.wait()
+            self._proc = None
+            return "Timeout Error!", 9
+        except (IOError, OSError) as e:
+            self._kill()
+            await self._proc.wait()
+            self._proc = None
+            return "region-properties worker error:%s" % (e), 1
+        if recode != 0 and self._proc.stdout.at_eof():
+            await self._proc.wait()
+            self._proc = None
+        return result, recode
+
+    async def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+            await self._proc.wait()
+        except Exception as e:
+            log.debug("async region-properties worker close error:%s" % (e))
+        self._proc = None
+
+
+# asyncio版本的并发闸门，在途查询数不超过adaptive_limit.current()（main.AdaptiveLimit），查询完成后把延迟反馈给adaptive_limit
+# 必须在事件循环内创建
+class AsyncConcurrencyGate(object):
+    def __init__(self, adaptive_limit):
+        self.adaptive_limit = adaptive_limit
+        self._inflight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            # 上限变化不会主动通知，等待时定期重新检查
+            while self._inflight >= self.adaptive_limit.current():
+                try:
+                    await asyncio.wait_for(self._cond.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+            self._inflight += 1
+        return asyncio.get_event_loop().time()
+
+    async def release(self, start_time, ok=True):
+        self.adaptive_limit.on_result(asyncio.get_event_loop().time() - start_time, ok)
+        async with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+
+class AsyncRegionPropertiesEngine(object):
+    # script_factory(address)返回常驻worker的sh脚本，end_marker为每个region查询结束的标记
+    # adaptive_limit不为None时按查询延迟自动调整并发，parallel为上限
+    def __init__(self, script_factory, end_marker, parallel=1, store_parallel=1, timeout=30, adaptive_limit=None):
+        self.script_factory = script_factory
+        self.end_marker = end_marker
+        self.parallel = max(1, parallel)
+        self.store_parallel = max(1, store_parallel)
+        self.timeout = timeout
+        self.adaptive_limit = adaptive_limit
+
+    # tasks:[(address,region_id,ctx)]，每个查询完成后调用callback(ctx,result,recode)
+    # python3.8以下需要在主线程中调用：子进程依赖child watcher，child watcher只能绑定主线程中的事件循环
+    def run(self, tasks, callback):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            if sys.version_info < (3, 8):
+                asyncio.get_child_watcher().attach_loop(loop)
+            loop.run_until_complete(self._run(tasks, callback))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def _run(self, tasks, callback):
+        store_queues = {}  # key:store address,value:asyncio.Queue
+        for address, region_id, ctx in tasks:
+            if address not in store_queues:
+                store_queues[address] = asyncio.Queue()
+            store_queues[address].put_nowait((region_id, ctx))
+        log.info("async region-properties engine,stores:%d,parallel:%d,store_parallel:%d" % (
+            len(store_queues), self.parallel, self.store_parallel))
+        global_sem = asyncio.Semaphore(self.parallel)
+        gate = AsyncConcurrencyGate(self.adaptive_limit) if self.adaptive_limit is not None else None
+        consumers = []
+        for address, store_queue in store_queues.items():
+            for i in range(min(self.store_parallel, store_queue.qsize())):
+                worker = _StoreWorker(self.script_factory(address), self.end_marker, self.timeout)
+                consumers.append(self._consume(worker, store_queue, global_sem, gate, callback))
+        await asyncio.gather(*consumers)
+
+    async def _consume(self, worker, store_queue, global_sem, gate, callback):
+        try:
+            while not store_queue.empty():
+                region_id, ctx = store_queue.get_nowait()
+                async with global_sem:
+                    if gate is None:
+                        result, recode = await worker.query(region_id)
+                    else:
+                        start_time = await gate.acquire()
+                        recode = 9
+                        try:
+                            result, recode = await worker.query(region_id)
+                        finally:
+                            # region不存在（split、merge）是正常的返回，只把超时和异常当作失败
+                            await gate.release(start_time, recode != 9)
+                try:
+                    callback(ctx, result, recode)
+                except Exception as e:
+                    log.error("region-properties callback error,region_id:%d,message:%s" % (region_id, e))
+        finally:
+            await worker.close()
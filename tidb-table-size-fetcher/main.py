@@ -9,10 +9,20 @@
 # rocksdb.writecf.enable-compaction-guard=true
 # tidb.split-table=true
 import argparse
+import array
+import binascii
+import bisect
+import calendar
+import codecs
+import heapq
 import json
 import logging as log
+import math
 import os.path
+import random
+import signal
 import sqlite3
+import struct
 import subprocess
 import sys
 import tempfile
@@ -24,12 +34,39 @@ isV3 = float(sys.version[:3]) > 2.7
 
 if not isV3:
     import urllib as request
-    from Queue import Queue
+    import httplib
+    from urlparse import urlsplit
+    from Queue import Queue, Empty
+    from pipes import quote as shell_quote
+
+    aio_properties = None
 else:
     import urllib.request as request
-    from queue import Queue
+    import http.client as httplib
+    from urllib.parse import urlsplit
+    from queue import Queue, Empty
+    # pipes在python3.13中已经移除
+    from shlex import quote as shell_quote
+
+    # python3中intern移到了sys模块，sstfile大小字典中的node_id使用intern后的字符串，避免每个key持有一份拷贝
+    intern = sys.intern
+
+    # asyncio版本的region-properties查询引擎只支持python3
+    try:
+        import aio_properties
+    except ImportError:
+        aio_properties = None
+
+# 集群拓扑优先从tiup的meta.yaml中读取，没有安装pyyaml时使用tiup cluster display
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# region、sstfile相关的整数数组使用的类型（python2的array不支持q）
+ARRAY_INT_TYPECODE = "q" if isV3 else "l"
 
-region_queue = Queue(100)  # 内容为（dbname,tabname,region_id）的元组
+region_queue = Queue(100)  # 内容为（full_tabname,region_id,查询region-properties的tikv节点）的元组
 
 
 def command_run(command, use_temp=False, timeout=30):
@@ -86,6 +123,233 @@ def command_run(command, use_temp=False, timeout=30):
         return _str(mutable[0]) + _str(mutable[1]), mutable[2].returncode
 
 
+# 流式执行命令：逐行读取管道中的输出交给line_handler处理，不在内存中保留完整的结果集，适合tiup exec获取大量sstfile的场景
+# 返回(最后tail_lines行输出,returncode)，超时返回"Timeout Error!"和9，超时时杀掉整个进程组
+def command_stream(command, line_handler, timeout=30, tail_lines=20):
+    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, preexec_fn=os.setsid)
+    timeout_flag = [False]
+
+    def kill():
+        timeout_flag[0] = True
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    # 看门狗：超时后杀掉进程组，管道关闭后readline返回空串，循环自然结束
+    watchdog = threading.Timer(timeout, kill)
+    watchdog.start()
+    tail = []
+    try:
+        for each_line in iter(proc.stdout.readline, ""):
+            if len(tail) >= tail_lines:
+                tail.pop(0)
+            tail.append(each_line)
+            line_handler(each_line.rstrip("\n"))
+    except Exception:
+        kill()
+        raise
+    finally:
+        watchdog.cancel()
+        proc.stdout.close()
+        proc.wait()
+    if timeout_flag[0]:
+        return "Timeout Error!", 9
+    return "".join(tail), proc.returncode
+
+
+# tiup cluster exec的输出中"stdout:"之后才是命令的输出，逐行解析"<sst_no>.sst[:size]"，每个sstfile调用on_sstfile(sst_no,size)
+# 只列文件名时size为None
+def exec_sstfile_line_handler(on_sstfile):
+    state = {"inline": False}
+
+    def handler(each_line):
+        if each_line.startswith("stdout:"):
+            state["inline"] = True
+            return
+        if not state["inline"]:
+            return
+        each_line_fields = each_line.strip().split(":")
+        if len(each_line_fields) > 2 or not each_line_fields[0].endswith(".sst"):
+            return
+        sst_no = os.path.basename(each_line_fields[0])[:-4]
+        if not sst_no.isdigit():
+            return
+        if len(each_line_fields) == 1:
+            on_sstfile(int(sst_no), None)
+        elif each_line_fields[1].isdigit():
+            on_sstfile(int(sst_no), int(each_line_fields[1]))
+
+    return handler
+
+
+# 使用parallel个线程并发执行func(item)，单个item失败不影响其他item
+# 返回[(item,异常)]，异常为None说明执行成功
+def run_in_threads(items, func, parallel):
+    item_queue = Queue()
+    for item in items:
+        item_queue.put(item)
+    results = []
+
+    def worker():
+        while True:
+            try:
+                item = item_queue.get_nowait()
+            except Empty:
+                return
+            try:
+                func(item)
+                results.append((item, None))
+            except Exception as e:
+                results.append((item, e))
+
+    threads = [threading.Thread(target=worker) for i in range(min(max(1, parallel), len(items)))]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return results
+
+
+# 基于调用延迟的AIMD并发上限：从min_limit开始，每成功完成约limit次调用上限加1（加性增）
+# 调用失败、延迟超过基线的latency_tolerance倍或者tikv有压力（pressure）时上限减半（乘性减），直到min_limit
+# 基线为观测到的最小延迟，并缓慢向当前延迟靠拢，避免某次偶然的极小值让之后的调用都被判定为变慢
+# 线程安全，线程版本和asyncio版本的并发控制共用
+class AdaptiveLimit(object):
+    def __init__(self, name, max_limit, min_limit=1, latency_tolerance=2.0):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(self.min_limit)
+        self.baseline = None
+        self.pressure = False  # 由TiKVPressureMonitor根据prometheus中的指标设置
+        self._last_decrease_time = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        return max(self.min_limit, int(self.limit))
+
+    def on_result(self, latency, ok=True):
+        with self._lock:
+            if ok:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += (latency - self.baseline) * 0.01
+            overload = not ok or self.pressure or (
+                    self.baseline is not None and latency > self.baseline * self.latency_tolerance)
+            if not overload:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+                return
+            # 同一时刻在途的调用会陆续返回慢的结果，一个基线周期内只减半一次
+            now = time.time()
+            if now - self._last_decrease_time < (self.baseline or 0) * self.latency_tolerance:
+                return
+            self._last_decrease_time = now
+            old_limit = self.current()
+            self.limit = max(float(self.min_limit), self.limit / 2)
+            if self.current() != old_limit:
+                log.info("adaptive limit %s:%d->%d,latency:%.3fs,baseline:%.3fs,ok:%s,pressure:%s" % (
+                    self.name, old_limit, self.current(), latency, self.baseline or 0, ok, self.pressure))
+
+
+# 线程版本的并发闸门，在途调用数不超过adaptive_limit.current()
+# 用法：start_time = gate.acquire(); ...; gate.release(start_time, ok)
+class ConcurrencyGate(object):
+    def __init__(self, adaptive_limit):
+        self.adaptive_limit = adaptive_limit
+        self._inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            # 上限变化不会主动通知，等待时定期重新检查
+            while self._inflight >= self.adaptive_limit.current():
+                self._cond.wait(1.0)
+            self._inflight += 1
+        return time.time()
+
+    def release(self, start_time, ok=True):
+        self.adaptive_limit.on_result(time.time() - start_time, ok)
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+
+# 后台定期从prometheus获取tikv的grpc请求p99延迟，超过max_grpc_p99（秒）时设置所有adaptive_limit的pressure
+# prometheus不可用时不设置pressure，只依赖调用延迟控制并发
+class TiKVPressureMonitor(object):
+    grpc_p99_query = "histogram_quantile(0.99,sum(rate(tikv_grpc_msg_duration_seconds_bucket[1m]))by(le))"
+
+    def __init__(self, prometheus_node_id, max_grpc_p99, adaptive_limits, interval=15):
+        self.prometheus_node_id = prometheus_node_id
+        self.max_grpc_p99 = max_grpc_p99
+        self.adaptive_limits = adaptive_limits
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def get_grpc_p99(self):
+        url = "http://%s/api/v1/query?query=%s" % (self.prometheus_node_id, request.quote(self.grpc_p99_query))
+        data, err = get_jsondata_from_url(url)
+        if err is not None:
+            log.warning("get tikv grpc p99 error:%s,url:%s" % (err, url))
+            return None
+        try:
+            for each_item in data["data"]["result"]:
+                value = float(each_item["value"][1])
+                if not math.isnan(value):
+                    return value
+        except Exception as e:
+            log.warning("parse tikv grpc p99 error:%s" % (e))
+        return None
+
+    def check(self):
+        grpc_p99 = self.get_grpc_p99()
+        pressure = grpc_p99 is not None and grpc_p99 > self.max_grpc_p99
+        if grpc_p99 is not None:
+            log.debug("tikv grpc p99:%.3fs,pressure:%s" % (grpc_p99, pressure))
+        for adaptive_limit in self.adaptive_limits:
+            if pressure and not adaptive_limit.pressure:
+                log.info("tikv grpc p99 %.3fs exceed %.3fs,slow down %s" % (
+                    grpc_p99, self.max_grpc_p99, adaptive_limit.name))
+            adaptive_limit.pressure = pressure
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.check()
+            self._stop_event.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for adaptive_limit in self.adaptive_limits:
+            adaptive_limit.pressure = False
+
+
+# 远程聚合脚本：sh <script> <db目录> <清单文件>，清单文件每行为"组号 sstfile名称"
+# 每个sstfile只stat一次，输出每组的"AGG 组号 已获取大小的sstfile总大小 已获取大小的sstfile数 不存在的sstfile数"
+REMOTE_AGGREGATE_SCRIPT = '''#!/bin/sh
+cd "$1" || exit 1
+awk '{print $2}' "$2" | sort -u | xargs stat -c "%n %s" 2>/dev/null > "$2.size"
+awk 'FILENAME == ARGV[1] {size[$1]=$2; next}
+{ if ($2 in size) { total[$1]+=size[$2]; found[$1]++ } else { missing[$1]++ }; groups[$1]=1 }
+END { for (g in groups) printf "AGG %s %.0f %d %d\\n", g, total[g], found[g], missing[g] }' "$2.size" "$2"
+rc=$?
+rm -f "$2.size"
+exit $rc
+'''
+
+
 def format_size(size):
     if size < (1 << 10):
         return "%.2fB" % (size)
@@ -104,25 +368,335 @@ def check_env():
     return True
 
 
+# 带连接池的http客户端，线程安全，每个地址最多保留max_idle个空闲的keep-alive连接
+# addresses为多个"host:port"时每次请求轮流从不同的地址开始，连接错误、超时或者5xx时换下一个地址并等待backoff*2^n秒后重试
+class HTTPClient(object):
+    def __init__(self, timeout=30, retries=3, backoff=0.5, max_idle=8):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self._idle_conns = {}  # key:address,value:[HTTPConnection]
+        self._lock = threading.Lock()
+        self._round_robin = 0
+
+    def _get_conn(self, address):
+        with self._lock:
+            conns = self._idle_conns.get(address)
+            if conns:
+                return conns.pop(), True
+        host, port = address.rsplit(":", 1)
+        return httplib.HTTPConnection(host, int(port), timeout=self.timeout), False
+
+    def _put_conn(self, address, conn):
+        with self._lock:
+            conns = self._idle_conns.setdefault(address, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _next_start(self, count):
+        with self._lock:
+            self._round_robin += 1
+            return self._round_robin % count
+
+    # 返回响应，调用方读取完后需要close，完整读取的连接会放回连接池；非2xx或者重试后仍然失败时抛出异常
+    def request(self, addresses, path):
+        if len(addresses) == 0:
+            raise Exception("no address for %s" % (path))
+        start = self._next_start(len(addresses))
+        last_error = None
+        attempt = 0
+        while attempt <= self.retries:
+            address = addresses[(start + attempt) % len(addresses)]
+            conn, reused = self._get_conn(address)
+            try:
+                conn.request("GET", path, headers={"Connection": "keep-alive"})
+                resp = conn.getresponse()
+            except Exception as e:
+                conn.close()
+                # 空闲连接可能已经被服务端关闭，直接换新连接重试，不计入重试次数
+                if reused:
+                    continue
+                last_error = "http://%s%s,%s" % (address, path, e)
+            else:
+                if resp.status < 300:
+                    return PooledResponse(self, address, conn, resp)
+                message = resp.read()
+                conn.close()
+                last_error = "http://%s%s,status:%d,message:%s" % (address, path, resp.status, message[:200])
+                if resp.status < 500:
+                    raise Exception(last_error)
+            attempt += 1
+            if attempt <= self.retries:
+                log.warning("http request error,retry %d/%d,%s" % (attempt, self.retries, last_error))
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+        raise Exception(last_error)
+
+    def get(self, addresses, path):
+        resp = self.request(addresses, path)
+        try:
+            return resp.read()
+        finally:
+            resp.close()
+
+    # return:json data,error
+    def get_json(self, addresses, path):
+        try:
+            data = self.get(addresses, path)
+        except Exception as e:
+            return "", str(e)
+        if len(data) == 0:
+            return "", "response from %s is none" % (path)
+        return json.loads(data.decode("utf-8")), None
+
+
+# HTTPClient.request返回的响应，读取完整后close时连接放回连接池，否则关闭连接
+class PooledResponse(object):
+    def __init__(self, client, address, conn, resp):
+        self.client = client
+        self.address = address
+        self._conn = conn
+        self._resp = resp
+
+    def getcode(self):
+        return self._resp.status
+
+    def read(self, *args):
+        return self._resp.read(*args)
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._resp.isclosed() and not self._resp.will_close:
+            self.client._put_conn(self.address, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+
+http_client = HTTPClient()  # tidb status、pd、prometheus共用的http客户端
+
+
 # return:json data,error
 def get_jsondata_from_url(url):
     if url == "":
         return "", "url is none"
-    try:
-        rep = request.urlopen(url)
-    except Exception as e:
-        return "", str(e)
-    rep_data = rep.read()
-    if rep_data == "":
-        return "", "response from %s is none" % (url)
-    return json.loads(rep_data), None
+    url_parts = urlsplit(url)
+    path = url_parts.path
+    if url_parts.query != "":
+        path += "?" + url_parts.query
+    return http_client.get_json([url_parts.netloc], path)
+
+
+# 增量解析json：每次从fp读取chunk_size字节，只有匹配decode_paths的值（以及所有标量）整体解码后调用on_value(path,value)，
+# 其余的对象和数组逐层展开，不需要同时持有完整的原始数据和完整的解析结果
+# path为从根开始的key（对象）或者下标（数组）组成的元组，decode_paths中的"*"匹配任意数组下标
+class IncrementalJSONReader(object):
+    def __init__(self, fp, chunk_size=1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._buf = u""
+        self._pos = 0
+        self._eof = False
+
+    # 丢弃已经解析的部分并追加新读取的数据，已经读到结尾时返回False
+    def _read_more(self):
+        if self._eof:
+            return False
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self._eof = True
+            self._buf = self._buf[self._pos:] + self._text_decoder.decode(b"", True)
+        else:
+            self._buf = self._buf[self._pos:] + self._text_decoder.decode(data)
+        self._pos = 0
+        return True
+
+    # 跳过空白字符，返回下一个字符
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read_more():
+                raise ValueError("unexpected end of json data")
+
+    def _decode_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # 数字、true等值在缓冲区末尾时可能被截断，后面还有字符时才能确认是完整的值
+                # 数字可能在小数点、指数处被截断（比如"1."解析为1），后面的字符还可能属于该数字时也需要继续读取
+                if self._eof or (end < len(self._buf) and self._buf[end] not in "0123456789.eE+-"):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._read_more()
+
+    def _expect(self, chars):
+        ch = self._peek()
+        if ch not in chars:
+            raise ValueError("invalid json data,expect %s but got %s" % (chars, ch))
+        self._pos += 1
+        return ch
+
+    @staticmethod
+    def _match(path, decode_paths):
+        for pattern in decode_paths:
+            if len(pattern) != len(path):
+                continue
+            for p, k in zip(pattern, path):
+                if not (p == k or (p == "*" and isinstance(k, int))):
+                    break
+            else:
+                return True
+        return False
+
+    def parse(self, on_value, decode_paths=()):
+        self._walk((), [tuple(p) for p in decode_paths], on_value)
+
+    def _walk(self, path, decode_paths, on_value):
+        ch = self._peek()
+        if ch not in "{[" or self._match(path, decode_paths):
+            on_value(path, self._decode_value())
+            return
+        self._pos += 1
+        end_char = "}" if ch == "{" else "]"
+        if self._peek() == end_char:
+            self._pos += 1
+            return
+        index = 0
+        while True:
+            if ch == "{":
+                key = self._decode_value()
+                self._expect(":")
+                self._walk(path + (key,), decode_paths, on_value)
+            else:
+                self._walk(path + (index,), decode_paths, on_value)
+                index += 1
+            if self._expect("," + end_char) == end_char:
+                return
+
+
+# tikv中的key为memcomparable编码后的key：每8个字节一组，不足8字节补0，每组后追加一个标记字节(0xFF-补0的个数)
+def encode_memcomparable_bytes(raw):
+    out = bytearray()
+    data = bytearray(raw)
+    for i in range(0, len(data) + 1, 8):
+        group = data[i:i + 8]
+        pad_count = 8 - len(group)
+        out.extend(group)
+        out.extend(bytearray(pad_count))
+        out.append(0xFF - pad_count)
+    return bytes(out)
+
+
+# int64按照符号位取反后大端编码，保证编码后的字节序和数值大小序一致
+def encode_comparable_int64(num):
+    return struct.pack(">Q", (num & 0xFFFFFFFFFFFFFFFF) ^ 0x8000000000000000)
+
+
+# 表（分区）的数据key前缀：t{table_id}_r，索引key前缀：t{table_id}_i{index_id}，返回memcomparable编码后的key
+def encode_table_key(table_id, suffix=b""):
+    return encode_memcomparable_bytes(b"t" + encode_comparable_int64(table_id) + suffix)
+
+
+def encode_record_key(table_id):
+    return encode_table_key(table_id, b"_r")
+
+
+def encode_index_key(table_id, index_id):
+    return encode_table_key(table_id, b"_i" + encode_comparable_int64(index_id))
+
+
+# region的key范围[start_key,end_key)是否与[range_start,range_end)重叠，end_key为空表示无穷大
+def is_key_range_overlap(start_key, end_key, range_start, range_end):
+    return start_key < range_end and (end_key == b"" or end_key > range_start)
+
+
+# [start_key,end_key)中[sub_start,sub_end)所占的比例，start_key为空表示最小，end_key、sub_end为空表示无穷大
+# 去掉start_key和end_key的公共前缀后，把key接下来的window个字节看作一个整数，按照整数之差计算比例
+# 索引id、handle等位于key中较深的位置，window需要足够大才能区分同一个region中的多个索引
+def key_range_fraction(start_key, end_key, sub_start, sub_end, window=32):
+    prefix_len = 0
+    if end_key != b"":
+        while prefix_len < min(len(start_key), len(end_key)) and \
+                start_key[prefix_len:prefix_len + 1] == end_key[prefix_len:prefix_len + 1]:
+            prefix_len += 1
+
+    def _position(key, is_end):
+        if key == b"":
+            return 1 << (8 * window) if is_end else 0
+        tail = bytearray(key[prefix_len:prefix_len + window])
+        tail.extend(bytearray(window - len(tail)))
+        return int(binascii.hexlify(bytes(tail)), 16)
+
+    total = _position(end_key, True) - _position(start_key, False)
+    if total <= 0:
+        return 1.0
+    return max(0.0, min(1.0, float(_position(sub_end, True) - _position(sub_start, False)) / total))
+
+
+# 互不重叠的key区间的索引，segments:[(start_key,end_key,value)]，key为memcomparable编码后的key
+# 按start_key排序后二分查找，查找与一个region的key范围重叠的区间为O(log n+重叠的区间数)
+class KeyRangeIndex(object):
+    def __init__(self, segments):
+        self.segments = sorted(segments, key=lambda x: x[0])
+        self.starts = [each_segment[0] for each_segment in self.segments]
+        self.min_start = self.starts[0] if len(self.starts) != 0 else b""
+        self.max_end = max([each_segment[1] for each_segment in self.segments]) if len(self.segments) != 0 else b""
+
+    # 返回[(value,比例)]，比例为重叠部分在region的key范围[start_key,end_key)中所占的比例，end_key为空表示无穷大
+    # 没有边界的region（集群的第一个、最后一个region）分别以所有区间的最小start_key、最大end_key作为边界
+    def overlaps(self, start_key, end_key):
+        result = []
+        range_start = start_key if start_key != b"" else self.min_start
+        range_end = end_key if end_key != b"" else self.max_end
+        pos = max(bisect.bisect_right(self.starts, start_key) - 1, 0)
+        while pos < len(self.segments):
+            seg_start, seg_end, value = self.segments[pos]
+            pos += 1
+            if end_key != b"" and seg_start >= end_key:
+                break
+            if not is_key_range_overlap(start_key, end_key, seg_start, seg_end):
+                continue
+            sub_end = seg_end if end_key == b"" else min(end_key, seg_end)
+            result.append((value, key_range_fraction(range_start, range_end, max(start_key, seg_start), sub_end)))
+        return result
+
+
+# 按weights:{key:权重}的比例把整数total分摊到每个key上，分摊结果之和等于total（最大余数法）
+def distribute_by_weights(total, weights):
+    total_weight = float(sum(weights.values()))
+    if total_weight <= 0:
+        return dict((key, 0) for key in weights)
+    result = {}
+    remainders = []
+    for key, weight in weights.items():
+        share = total * weight / total_weight
+        result[key] = int(share)
+        remainders.append((share - int(share), key))
+    remainders.sort(key=lambda x: x[0], reverse=True)
+    for i in range(int(total - sum(result.values()))):
+        result[remainders[i % len(remainders)][1]] += 1
+    return result
 
 
 # parms:
 # sqlite3_fname 数据库的路径
 # cluster_name 集群名称
 # data_list，需要加载的数据列表，包含多行记录，二维列表
-def load2sqlite3(sqlite3_fname, cluster_name, data_list):
+# size_method 表大小的获取方式，exact为精确计算，sample为抽样估算，approximate为根据pd的region统计信息估算
+# insert_time为None时使用当前时间，分批写入同一次执行的结果时应使用同一个insert_time
+def load2sqlite3(sqlite3_fname, cluster_name, data_list, size_method="exact", insert_time=None):
     try:
         conn = sqlite3.connect(sqlite3_fname)
         cur = conn.cursor()
@@ -147,14 +721,21 @@ def load2sqlite3(sqlite3_fname, cluster_name, data_list):
         create index if not exists idx1 on table_size_info (cname,dbname,tabname,insert_time)
         '''
         cur.execute(create_index_ddl)
+        # 老版本的表中没有size_method字段
+        columns = [each_col[1] for each_col in cur.execute("pragma table_info(table_size_info)").fetchall()]
+        if "size_method" not in columns:
+            cur.execute("alter table table_size_info add column size_method varchar(20) default 'exact'")
         insert_data_rows = []
-        now = cur.execute("select datetime('now','localtime')").fetchone()[0]
+        now = insert_time
+        if now is None:
+            now = cur.execute("select datetime('now','localtime')").fetchone()[0]
         for each_row in data_list:
             # each_row只包含：dbname,tabname,ispartition,index_count,data_size,data_size_format,index_size,index_size_format,table_size,table_size_format
             row = [now, cluster_name]
-            row.extend(each_row)
+            row.extend(each_row[:10])
+            row.append(size_method)
             insert_data_rows.append(tuple(row))
-        cur.executemany('''insert into table_size_info values (?,?,?,?,?,?,?,?,?,?,?,?)''', insert_data_rows)
+        cur.executemany('''insert into table_size_info values (?,?,?,?,?,?,?,?,?,?,?,?,?)''', insert_data_rows)
         cur.close()
         conn.commit()
         conn.close()
@@ -162,6 +743,725 @@ def load2sqlite3(sqlite3_fname, cluster_name, data_list):
         log.error("load data error,message:%s" % (e))
 
 
+# 加载每个分区、每个索引的大小
+# data_list:[(dbname,tabname,segment_type,segment_name,size,size_format,split_method)]，segment_type为partition或index，
+# split_method为approximate或estimated，见get_detail_rows
+def load_detail2sqlite3(sqlite3_fname, cluster_name, data_list, insert_time=None):
+    try:
+        conn = sqlite3.connect(sqlite3_fname)
+        cur = conn.cursor()
+        cur.execute('''
+        create table if not exists table_size_detail_info (
+        insert_time timestamp,
+        cname varchar(30),
+        dbname varchar(30),
+        tabname varchar(255),
+        segment_type varchar(20),
+        segment_name varchar(255),
+        size bigint,
+        size_format varchar(50)
+        );
+        ''')
+        cur.execute('''
+        create index if not exists idx_detail1 on table_size_detail_info (cname,dbname,tabname,insert_time)
+        ''')
+        # 老版本的表中没有split_method字段
+        columns = [each_col[1] for each_col in cur.execute("pragma table_info(table_size_detail_info)").fetchall()]
+        if "split_method" not in columns:
+            cur.execute("alter table table_size_detail_info add column split_method varchar(20) default 'estimated'")
+        now = insert_time
+        if now is None:
+            now = cur.execute("select datetime('now','localtime')").fetchone()[0]
+        cur.executemany('''insert into table_size_detail_info values (?,?,?,?,?,?,?,?,?)''',
+                        [tuple([now, cluster_name] + list(each_row[:7])) for each_row in data_list])
+        cur.close()
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        log.error("load detail data error,message:%s" % (e))
+
+
+# 加载每张表（数据、每个索引）的mvcc统计信息
+# data_list:[(dbname,tabname,segment_type,segment_name,regions,num_rows,num_versions,num_deletes,max_row_versions,
+# garbage_ratio,num_entries,tombstones,tombstone_ratio)]，segment_type为table、data或index
+def load_mvcc2sqlite3(sqlite3_fname, cluster_name, data_list, insert_time=None):
+    try:
+        conn = sqlite3.connect(sqlite3_fname)
+        cur = conn.cursor()
+        cur.execute('''
+        create table if not exists table_size_mvcc_info (
+        insert_time timestamp,
+        cname varchar(30),
+        dbname varchar(30),
+        tabname varchar(255),
+        segment_type varchar(20),
+        segment_name varchar(255),
+        regions int,
+        num_rows bigint,
+        num_versions bigint,
+        num_deletes bigint,
+        max_row_versions bigint,
+        garbage_ratio real,
+        num_entries bigint,
+        tombstones bigint,
+        tombstone_ratio real
+        );
+        ''')
+        cur.execute('''
+        create index if not exists idx_mvcc1 on table_size_mvcc_info (cname,dbname,tabname,insert_time)
+        ''')
+        now = insert_time
+        if now is None:
+            now = cur.execute("select datetime('now','localtime')").fetchone()[0]
+        cur.executemany('''insert into table_size_mvcc_info values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                        [tuple([now, cluster_name] + list(each_row[:13])) for each_row in data_list])
+        cur.close()
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        log.error("load mvcc data error,message:%s" % (e))
+
+
+# [(dbname,tabname)]按相邻的dbname合并为[(dbname,tabname_list)]
+def group_db_tabname_list(db_tabnames):
+    db_tabname_list = []
+    for dbname, tabname in db_tabnames:
+        if len(db_tabname_list) == 0 or db_tabname_list[-1][0] != dbname:
+            db_tabname_list.append((dbname, []))
+        db_tabname_list[-1][1].append(tabname)
+    return db_tabname_list
+
+
+# 将排序后的物理表id划分为pd扫描范围[(first_id,last_id)]，每个范围内不包含未选中的物理表
+# 相邻两个物理表之间有skipped_ids中的id，或者属于不同的分组（比如不同的数据库，其他数据库的表未知）且id不连续时，分为两次扫描
+# id_db_map:key:physical_id,value:所属的分组（dbname或者表名）
+def get_pd_scan_ranges(physical_ids, skipped_ids, id_db_map):
+    sorted_skipped_ids = sorted(skipped_ids)
+    scan_ranges = []
+    for physical_id in physical_ids:
+        if len(scan_ranges) != 0:
+            first_id, last_id = scan_ranges[-1]
+            has_skipped = bisect.bisect_right(sorted_skipped_ids, last_id) != bisect.bisect_left(sorted_skipped_ids,
+                                                                                                  physical_id)
+            if not has_skipped and (id_db_map[last_id] == id_db_map[physical_id] or physical_id == last_id + 1):
+                scan_ranges[-1] = (first_id, physical_id)
+                continue
+        scan_ranges.append((physical_id, physical_id))
+    return scan_ranges
+
+
+# sstfile名称为"<文件号>.sst"，返回文件号
+def sst_file_number(sst_name):
+    return int(os.path.basename(sst_name).split(".")[0])
+
+
+# sstfile物理大小的持久化缓存，key:(node_id,sst文件号),value:sstfile大小
+# sstfile生成后不会再修改，因此每次只需要stat缓存中不存在的sstfile，并删除已经不存在的sstfile
+class SSTSizeCache(object):
+    def __init__(self, sqlite3_fname):
+        self.sqlite3_fname = sqlite3_fname
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(sqlite3_fname, check_same_thread=False)
+        self._conn.execute('''
+        create table if not exists sst_size_cache (
+        node_id varchar(255),
+        sst_no bigint,
+        sst_size bigint,
+        update_time timestamp default (datetime('now','localtime')),
+        primary key (node_id, sst_no)
+        )
+        ''')
+        # 每个节点上次全量获取时的sstfile总数，用于按节点选择获取sstfile大小的方式
+        self._conn.execute('''
+        create table if not exists sst_node_stats (
+        node_id varchar(255) primary key,
+        sst_count bigint,
+        update_time timestamp default (datetime('now','localtime'))
+        )
+        ''')
+        self._conn.commit()
+
+    # 返回node上缓存的所有sstfile大小，{sst_no:size}
+    def get_node_sizes(self, node_id):
+        with self._lock:
+            cur = self._conn.execute("select sst_no,sst_size from sst_size_cache where node_id=?", (node_id,))
+            return dict(cur.fetchall())
+
+    # 返回node上次全量获取时的sstfile总数，没有全量获取过时返回None
+    def get_node_count(self, node_id):
+        with self._lock:
+            row = self._conn.execute("select sst_count from sst_node_stats where node_id=?", (node_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_node_count(self, node_id, sst_count):
+        with self._lock:
+            self._conn.execute("insert or replace into sst_node_stats (node_id,sst_count) values (?,?)",
+                               (node_id, sst_count))
+            self._conn.commit()
+
+    # 返回node上指定sstfile的缓存大小，{sst_no:size}，不在缓存中的sstfile不返回
+    def lookup(self, node_id, sst_nos):
+        if len(sst_nos) == 0:
+            return {}
+        wanted = set(sst_nos)
+        # 需要查找的sstfile较少时按主键查找，否则直接取出node上所有缓存
+        if len(wanted) <= 500:
+            result = {}
+            with self._lock:
+                for sst_no in wanted:
+                    row = self._conn.execute("select sst_size from sst_size_cache where node_id=? and sst_no=?",
+                                             (node_id, sst_no)).fetchone()
+                    if row is not None:
+                        result[sst_no] = row[0]
+            return result
+        return dict((sst_no, size) for sst_no, size in self.get_node_sizes(node_id).items() if sst_no in wanted)
+
+    # sstfile_size_map:{sst_no:size}
+    def put(self, node_id, sstfile_size_map):
+        if len(sstfile_size_map) == 0:
+            return
+        with self._lock:
+            self._conn.executemany("insert or replace into sst_size_cache (node_id,sst_no,sst_size) values (?,?,?)",
+                                   [(node_id, sst_no, size) for sst_no, size in sstfile_size_map.items()])
+            self._conn.commit()
+
+    def remove(self, node_id, sst_nos):
+        if len(sst_nos) == 0:
+            return
+        with self._lock:
+            self._conn.executemany("delete from sst_size_cache where node_id=? and sst_no=?",
+                                   [(node_id, sst_no) for sst_no in sst_nos])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# region-properties结果的持久化缓存，key:region_id，在region epoch(version/conf_ver)未变化且查询节点仍然是region的副本时有效
+# region发生compaction后sstfile会变化，但epoch不变，因此使用缓存后还需要确认sstfile仍然存在（见_get_stale_cached_regions）
+# flush、ingest只新增sstfile，epoch不变也不删除sstfile，因此缓存中同时记录pd中region的approximate_size和approximate_keys，
+# 两者发生变化时缓存无效（见TiDBCluster.is_cached_properties_valid）
+class RegionPropertiesCache(object):
+    def __init__(self, sqlite3_fname, commit_batch=1000):
+        self.sqlite3_fname = sqlite3_fname
+        self.commit_batch = commit_batch
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._conn = sqlite3.connect(sqlite3_fname, check_same_thread=False)
+        self._conn.execute('''
+        create table if not exists region_properties_cache (
+        region_id bigint primary key,
+        node_id varchar(255),
+        conf_ver bigint,
+        version bigint,
+        properties text,
+        update_time timestamp default (datetime('now','localtime'))
+        )
+        ''')
+        self._conn.commit()
+
+    # 返回(node_id,properties)，缓存无效时返回None
+    # node_ids:region当前所有副本所在的tikv节点
+    def lookup(self, region, node_ids):
+        # 获取不到epoch的情况下不使用缓存
+        if region.conf_ver == 0 and region.version == 0:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "select node_id,conf_ver,version,properties from region_properties_cache where region_id=?",
+                (region.region_id,)).fetchone()
+        if row is None:
+            return None
+        node_id, conf_ver, version, properties = row
+        if conf_ver != region.conf_ver or version != region.version or node_id not in node_ids:
+            return None
+        return node_id, json.loads(properties)
+
+    def put(self, region, node_id, properties):
+        if region.conf_ver == 0 and region.version == 0:
+            return
+        with self._lock:
+            self._conn.execute(
+                "insert or replace into region_properties_cache (region_id,node_id,conf_ver,version,properties) values (?,?,?,?,?)",
+                (region.region_id, node_id, region.conf_ver, region.version, json.dumps(properties)))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_batch:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def remove(self, region_id):
+        with self._lock:
+            self._conn.execute("delete from region_properties_cache where region_id=?", (region_id,))
+            self._uncommitted += 1
+
+    def flush(self):
+        with self._lock:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+# 记录精确计算的表大小和pd中region的approximate_size之和，用于approximate模式校准
+# data_list:[(dbname,tabname,data_size,index_size,table_size,approx_data_size,approx_index_size,approx_table_size)]
+def load_calibration2sqlite3(sqlite3_fname, cluster_name, data_list, insert_time=None):
+    try:
+        conn = sqlite3.connect(sqlite3_fname)
+        cur = conn.cursor()
+        cur.execute('''
+        create table if not exists table_size_calibration (
+        insert_time timestamp,
+        cname varchar(30),
+        dbname varchar(30),
+        tabname varchar(255),
+        data_size bigint,
+        index_size bigint,
+        table_size bigint,
+        approx_data_size bigint,
+        approx_index_size bigint,
+        approx_table_size bigint,
+        primary key (cname, dbname, tabname)
+        )
+        ''')
+        now = insert_time
+        if now is None:
+            now = cur.execute("select datetime('now','localtime')").fetchone()[0]
+        cur.executemany('''insert or replace into table_size_calibration values (?,?,?,?,?,?,?,?,?,?)''',
+                        [tuple([now, cluster_name] + list(each_row)) for each_row in data_list])
+        cur.close()
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        log.error("load calibration data error,message:%s" % (e))
+
+
+# 返回key:(dbname,tabname),value:(data_factor,index_factor,table_factor)的字典，key为None时表示整个集群的校准系数
+# 校准系数=精确大小/approximate大小
+def get_calibration_from_sqlite3(sqlite3_fname, cluster_name):
+    calibration = {}
+    try:
+        conn = sqlite3.connect(sqlite3_fname)
+        rows = conn.execute('''select dbname,tabname,data_size,index_size,table_size,approx_data_size,approx_index_size,
+        approx_table_size from table_size_calibration where cname=?''', (cluster_name,)).fetchall()
+        conn.close()
+    except Exception as e:
+        log.error("get calibration data error,message:%s" % (e))
+        return calibration
+    totals = [0] * 6
+
+    def _factor(exact, approx):
+        return float(exact) / approx if approx > 0 else 1.0
+
+    for each_row in rows:
+        dbname, tabname, sizes = each_row[0], each_row[1], each_row[2:]
+        calibration[(dbname, tabname)] = (_factor(sizes[0], sizes[3]), _factor(sizes[1], sizes[4]),
+                                          _factor(sizes[2], sizes[5]))
+        for i in range(6):
+            totals[i] += sizes[i]
+    if len(rows) != 0:
+        calibration[None] = (_factor(totals[0], totals[3]), _factor(totals[1], totals[4]),
+                             _factor(totals[2], totals[5]))
+    log.info("calibration tables count:%d" % (len(rows)))
+    return calibration
+
+
+# 表大小的时序历史数据，和table_size_info保存在同一个sqlite3文件中，但只保存整数：
+# size_history_table为(cname,dbname,tabname)的维度表，size_history中每行只有整数的table_key、时间和大小
+# 数据按粒度分层：hour（每小时一个点）、day、week，超过保留时间的数据降采样到下一层，
+# 同一个时间点（时间段）内优先使用size_method最精确的数据（exact>sample>approximate），同一小时内获取方式相同时保留最后一次，
+# 降采样时按样本数加权平均
+# 时间和insert_time一样使用本地时间：把本地时间当作UTC转换成的时间戳（秒），按本地时间对齐到小时、天、周（周一）
+class TableSizeHistory(object):
+    granularities = (("hour", 3600, 0), ("day", 86400, 0), ("week", 604800, 4 * 86400))  # (名称,秒数,对齐偏移)
+    size_method_codes = {"exact": 0, "sample": 1, "approximate": 2}
+    # 每层默认保留的天数，0表示不删除
+    default_retention = {"hour": 7, "day": 180, "week": 1095}
+
+    def __init__(self, sqlite3_fname):
+        self.sqlite3_fname = sqlite3_fname
+        self._conn = sqlite3.connect(sqlite3_fname)
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.execute("pragma synchronous=normal")
+        self._conn.execute('''
+        create table if not exists size_history_table (
+        table_key integer primary key,
+        cname varchar(30),
+        dbname varchar(30),
+        tabname varchar(255),
+        unique (cname, dbname, tabname)
+        )
+        ''')
+        self._conn.execute('''
+        create table if not exists size_history (
+        table_key int,
+        granularity int,
+        ts int,
+        size_method int,
+        samples int,
+        data_size int,
+        index_size int,
+        table_size int,
+        primary key (table_key, granularity, ts)
+        )
+        ''')
+        self._conn.execute("create index if not exists idx_size_history1 on size_history (granularity, ts)")
+        self._conn.execute("create table if not exists size_history_meta (name varchar(50) primary key, value text)")
+        self._conn.commit()
+        self._table_keys = {}  # key:(cname,dbname,tabname),value:table_key
+
+    def close(self):
+        self._conn.close()
+
+    def _get_meta(self, name, default=None):
+        row = self._conn.execute("select value from size_history_meta where name=?", (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, name, value):
+        self._conn.execute("insert or replace into size_history_meta values (?,?)", (name, str(value)))
+
+    # 返回(cname,dbname,tabname)对应的table_key，不存在时新增
+    def _get_table_key(self, cluster_name, dbname, tabname):
+        key = (cluster_name, dbname, tabname)
+        if key not in self._table_keys:
+            self._conn.execute("insert or ignore into size_history_table (cname,dbname,tabname) values (?,?,?)", key)
+            self._table_keys[key] = self._conn.execute(
+                "select table_key from size_history_table where cname=? and dbname=? and tabname=?", key).fetchone()[0]
+        return self._table_keys[key]
+
+    # "%Y-%m-%d %H:%M:%S"格式的本地时间转换为时间戳
+    @staticmethod
+    def parse_time(time_str):
+        return calendar.timegm(time.strptime(time_str, "%Y-%m-%d %H:%M:%S"))
+
+    @staticmethod
+    def now_ts():
+        return calendar.timegm(time.localtime())
+
+    @staticmethod
+    def format_ts(ts, time_format="%Y-%m-%d %H:%M"):
+        return time.strftime(time_format, time.gmtime(ts))
+
+    # 写入小时粒度的数据点，rows:[(table_key,0,ts,size_method,samples,data_size,index_size,table_size)]
+    # 同一个时间点已经有数据时，只有size_method相同或者更精确时才覆盖
+    def _put_hour_points(self, rows):
+        self._conn.executemany("insert or ignore into size_history values (?,?,?,?,?,?,?,?)", rows)
+        self._conn.executemany('''update size_history set size_method=?,samples=?,data_size=?,index_size=?,table_size=?
+        where table_key=? and granularity=? and ts=? and size_method>=?''',
+                               [row[3:] + row[:3] + (row[3],) for row in rows])
+
+    # 写入一次执行的结果，data_list:[(dbname,tabname,data_size,index_size,table_size)]，insert_time为"%Y-%m-%d %H:%M:%S"格式的本地时间
+    # 一批数据在一个事务中写入，同一小时内再次写入同一张表时覆盖之前获取方式相同或者更不精确的数据（--resume重新获取的表也是如此）
+    def write(self, cluster_name, data_list, size_method="exact", insert_time=None):
+        if insert_time is None:
+            insert_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        ts = self.parse_time(insert_time) // 3600 * 3600
+        method_code = self.size_method_codes.get(size_method, 0)
+        try:
+            rows = []
+            for dbname, tabname, data_size, index_size, table_size in data_list:
+                rows.append((self._get_table_key(cluster_name, dbname, tabname), 0, ts, method_code, 1, int(data_size),
+                             int(index_size), int(table_size)))
+            self._put_hour_points(rows)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            self._table_keys = {}
+            raise
+
+    # 把老版本table_size_info中的数据导入size_history（只导入上次导入之后新增的数据），返回导入的行数
+    def migrate_legacy(self, batch=10000):
+        if self._conn.execute(
+                "select count(*) from sqlite_master where type='table' and name='table_size_info'").fetchone()[0] == 0:
+            return 0
+        columns = [each_col[1] for each_col in self._conn.execute("pragma table_info(table_size_info)").fetchall()]
+        method_column = "size_method" if "size_method" in columns else "'exact'"
+        last_time = self._get_meta("legacy_migrated_time", "")
+        cur = self._conn.cursor()
+        cur.execute('''select insert_time,cname,dbname,tabname,data_size,index_size,table_size,%s from table_size_info
+        where insert_time>? order by insert_time''' % (method_column), (last_time,))
+        count = 0
+        try:
+            while True:
+                rows = cur.fetchmany(batch)
+                if len(rows) == 0:
+                    break
+                history_rows = []
+                for insert_time, cname, dbname, tabname, data_size, index_size, table_size, size_method in rows:
+                    history_rows.append((self._get_table_key(cname, dbname, tabname), 0,
+                                         self.parse_time(insert_time) // 3600 * 3600,
+                                         self.size_method_codes.get(size_method, 0), 1, int(data_size or 0),
+                                         int(index_size or 0), int(table_size or 0)))
+                    last_time = insert_time
+                self._put_hour_points(history_rows)
+                count += len(rows)
+            self._set_meta("legacy_migrated_time", last_time)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            self._table_keys = {}
+            raise
+        if count != 0:
+            log.info("migrate %d rows from table_size_info into size_history" % (count))
+        return count
+
+    # 删除老版本的table_size_info（需要先migrate_legacy）并整理数据库文件
+    def drop_legacy(self):
+        self.migrate_legacy()
+        self._conn.execute("drop table if exists table_size_info")
+        self._conn.commit()
+        self._conn.execute("vacuum")
+
+    # 每层的保留天数，retention为None时使用上次设置的值（没有设置过时使用default_retention），否则修改并记录
+    def get_retention(self, retention=None):
+        result = {}
+        for name, seconds, offset in self.granularities:
+            days = None if retention is None else retention.get(name)
+            if days is None:
+                days = int(self._get_meta("retention_" + name, self.default_retention[name]))
+            else:
+                self._set_meta("retention_" + name, days)
+            result[name] = days
+        self._conn.commit()
+        return result
+
+    # 降采样：超过保留时间的hour数据合并为day数据，超过保留时间的day数据合并为week数据，超过保留时间的week数据删除
+    def downsample(self, now=None, retention=None):
+        now = self.now_ts() if now is None else now
+        retention = self.get_retention(retention)
+        for level, (name, seconds, offset) in enumerate(self.granularities):
+            days = retention[name]
+            if days <= 0:
+                continue
+            if level + 1 == len(self.granularities):
+                cur = self._conn.execute("delete from size_history where granularity=? and ts<?",
+                                         (level, now - days * 86400))
+                if cur.rowcount > 0:
+                    log.info("size history remove %d expired %s rows" % (cur.rowcount, name))
+                continue
+            next_seconds, next_offset = self.granularities[level + 1][1], self.granularities[level + 1][2]
+            # 截止时间对齐到下一层的时间段，保证一个时间段的数据一次合并完
+            cutoff = (now - days * 86400 - next_offset) // next_seconds * next_seconds + next_offset
+            merged = self._merge_level(level, cutoff, next_seconds, next_offset)
+            if merged > 0:
+                log.info("size history downsample %d %s rows into %s" % (merged, name, self.granularities[level + 1][0]))
+        self._conn.commit()
+
+    # 把granularity=level且ts<cutoff的数据按下一层的时间段合并，返回合并的行数
+    def _merge_level(self, level, cutoff, next_seconds, next_offset):
+        cur = self._conn.cursor()
+        cur.execute('''select table_key,ts,size_method,samples,data_size,index_size,table_size from size_history
+        where granularity=? and ts<? order by table_key,ts''', (level, cutoff))
+        merged = 0
+        buckets = {}  # key:下一层时间段的开始时间,value:[size_method,samples,data_size之和,index_size之和,table_size之和]
+        current_key = None
+        while True:
+            rows = cur.fetchmany(10000)
+            for table_key, ts, size_method, samples, data_size, index_size, table_size in rows:
+                if table_key != current_key:
+                    self._write_buckets(current_key, level + 1, buckets)
+                    buckets = {}
+                    current_key = table_key
+                bucket_ts = (ts - next_offset) // next_seconds * next_seconds + next_offset
+                self._add_bucket(buckets, bucket_ts, size_method, samples, data_size, index_size, table_size)
+                merged += 1
+            if len(rows) == 0:
+                break
+        self._write_buckets(current_key, level + 1, buckets)
+        self._conn.execute("delete from size_history where granularity=? and ts<?", (level, cutoff))
+        return merged
+
+    @staticmethod
+    def _add_bucket(buckets, bucket_ts, size_method, samples, data_size, index_size, table_size):
+        bucket = buckets.get(bucket_ts)
+        # 只保留最精确的size_method的数据
+        if bucket is None or size_method < bucket[0]:
+            buckets[bucket_ts] = [size_method, samples, data_size * samples, index_size * samples, table_size * samples]
+        elif size_method == bucket[0]:
+            bucket[1] += samples
+            bucket[2] += data_size * samples
+            bucket[3] += index_size * samples
+            bucket[4] += table_size * samples
+
+    def _write_buckets(self, table_key, level, buckets):
+        if table_key is None or len(buckets) == 0:
+            return
+        for bucket_ts in list(buckets.keys()):
+            # 下一层已经有该时间段的数据时（例如较早的数据后来才写入）一起合并
+            row = self._conn.execute('''select size_method,samples,data_size,index_size,table_size from size_history
+            where table_key=? and granularity=? and ts=?''', (table_key, level, bucket_ts)).fetchone()
+            if row is not None:
+                self._add_bucket(buckets, bucket_ts, *row)
+        self._conn.executemany("insert or replace into size_history values (?,?,?,?,?,?,?,?)", [
+            (table_key, level, bucket_ts, bucket[0], bucket[1], int(round(float(bucket[2]) / bucket[1])),
+             int(round(float(bucket[3]) / bucket[1])), int(round(float(bucket[4]) / bucket[1]))) for bucket_ts, bucket
+            in buckets.items()])
+
+    # 查询[start_ts,end_ts]时间段内每张表的增长，返回[(dbname,tabname,开始时间,结束时间,开始大小,结束大小,size_method列表)]
+    # 每张表取时间段内最早和最晚的数据点，各层数据的时间不重叠；dbname、tabname为None时不过滤，size_method不为None时只使用该方式的数据
+    def growth(self, cluster_name, start_ts, end_ts, dbname=None, tabname_list=None, size_method=None):
+        sql = '''select t.dbname,t.tabname,h.ts,h.size_method,h.table_size from size_history h,size_history_table t
+        where h.table_key=t.table_key and t.cname=? and h.ts>=? and h.ts<=?'''
+        params = [cluster_name, start_ts, end_ts]
+        if dbname is not None:
+            sql += " and t.dbname=?"
+            params.append(dbname)
+        if tabname_list is not None:
+            sql += " and t.tabname in (%s)" % (",".join(["?"] * len(tabname_list)))
+            params.extend(tabname_list)
+        if size_method is not None:
+            sql += " and h.size_method=?"
+            params.append(self.size_method_codes[size_method])
+        sql += " order by h.table_key,h.ts,h.granularity"
+        method_names = dict((code, name) for name, code in self.size_method_codes.items())
+        result = []
+        first = last = None
+        for row in self._conn.execute(sql, params):
+            if first is not None and (row[0], row[1]) != (first[0], first[1]):
+                result.append(self._growth_row(first, last, method_names))
+                first = None
+            if first is None:
+                first = row
+            last = row
+        if first is not None:
+            result.append(self._growth_row(first, last, method_names))
+        return result
+
+    @staticmethod
+    def _growth_row(first, last, method_names):
+        methods = [method_names[first[3]]]
+        if last[3] != first[3]:
+            methods.append(method_names[last[3]])
+        return first[0], first[1], first[2], last[2], first[4], last[4], methods
+
+
+# 一次表大小获取的检查点，和表大小历史数据保存在同一个sqlite3文件中
+# table_size_run记录每次执行，table_size_run_table记录该次执行已经完成的表及其结果（table_map中的值，json格式）
+# 中断后再次执行时继续最近一次参数相同且未完成的执行，跳过已经完成的表，并使用同一个insert_time写入size_history（和table_size_info）
+# scan_args包含影响每张表结果的所有参数，同一批表最近一次未完成的执行参数不同时拒绝继续，避免同一次执行中混合不同方式获取的结果
+# region-properties结果和sstfile大小的进度由RegionPropertiesCache和SSTSizeCache保存
+class ScanCheckpoint(object):
+    # 每批表完成后写入的结果表，都按照insert_time、cname、dbname、tabname记录每张表的结果
+    output_tables = ["table_size_info", "table_size_detail_info", "table_size_mvcc_info", "table_size_calibration"]
+
+    # scan_args:{"dbname":..,"tabnamelist":..,其他影响结果的参数}
+    def __init__(self, sqlite3_fname, cluster_name, scan_args):
+        self.sqlite3_fname = sqlite3_fname
+        self.cluster_name = cluster_name
+        self.scan_args = json.dumps(scan_args, sort_keys=True)  # 获取哪些表以及获取方式，只有参数相同的执行才能继续
+        self.scan_tables = [scan_args["dbname"], scan_args["tabnamelist"]]
+        self.run_id = None
+        self.insert_time = None
+        self.done_tables = {}  # key:(dbname,tabname),value:table_map中的结果，只包含继续执行之前已经完成的表
+        self.done_count = 0
+        self._conn = sqlite3.connect(sqlite3_fname)
+        self._conn.execute('''
+        create table if not exists table_size_run (
+        run_id integer primary key autoincrement,
+        cname varchar(30),
+        scan_args text,
+        insert_time timestamp,
+        start_time timestamp default (datetime('now','localtime')),
+        end_time timestamp,
+        status varchar(20)
+        )
+        ''')
+        self._conn.execute('''
+        create table if not exists table_size_run_table (
+        run_id bigint,
+        dbname varchar(30),
+        tabname varchar(255),
+        result text,
+        primary key (run_id, dbname, tabname)
+        )
+        ''')
+        self._conn.commit()
+
+    # 返回scan_args中的[dbname,tabnamelist]，兼容老版本的[dbname,tabnamelist,size_method,...]格式
+    @staticmethod
+    def _get_scan_tables(scan_args):
+        try:
+            val = json.loads(scan_args)
+        except ValueError:
+            return None
+        if isinstance(val, dict):
+            return [val.get("dbname"), val.get("tabnamelist")]
+        return list(val[:2])
+
+    # 继续最近一次未完成的执行，没有时开始一次新的执行，返回是否为继续执行
+    # 同一批表最近一次未完成的执行参数不同时抛出异常，restart=True时放弃该执行（status为abandoned）并开始一次新的执行
+    def resume_or_start(self, restart=False):
+        row = None
+        for run_id, insert_time, scan_args in self._conn.execute('''select run_id,insert_time,scan_args from
+        table_size_run where cname=? and status='running' order by run_id desc''', (self.cluster_name,)).fetchall():
+            if self._get_scan_tables(scan_args) != self.scan_tables:
+                continue
+            if restart:
+                self._conn.execute("update table_size_run set status='abandoned',end_time=datetime('now','localtime') "
+                                   "where run_id=?", (run_id,))
+                self._conn.execute("delete from table_size_run_table where run_id=?", (run_id,))
+                self._conn.commit()
+                log.info("checkpoint abandon run:%d" % (run_id))
+                continue
+            if scan_args != self.scan_args:
+                raise Exception("unfinished run:%d has different arguments:%s,current arguments:%s,"
+                                "rerun with the same arguments or add --restart" % (run_id, scan_args, self.scan_args))
+            row = (run_id, insert_time)
+            break
+        if row is None:
+            self.insert_time = self._conn.execute("select datetime('now','localtime')").fetchone()[0]
+            cur = self._conn.execute("insert into table_size_run (cname,scan_args,insert_time,status) values (?,?,?,?)",
+                                     (self.cluster_name, self.scan_args, self.insert_time, "running"))
+            self.run_id = cur.lastrowid
+            self._conn.commit()
+            log.info("checkpoint start run:%d" % (self.run_id))
+            return False
+        self.run_id, self.insert_time = row
+        for dbname, tabname, result in self._conn.execute(
+                "select dbname,tabname,result from table_size_run_table where run_id=?", (self.run_id,)):
+            self.done_tables[(dbname, tabname)] = json.loads(result)
+        self.done_count = len(self.done_tables)
+        # 写入sqlite3之后、记录检查点之前中断的表会重新获取，先删除其已经写入的结果（size_history中的数据会被覆盖）
+        for table_name in self.output_tables:
+            if self._conn.execute("select count(*) from sqlite_master where type='table' and name=?",
+                                  (table_name,)).fetchone()[0] == 0:
+                continue
+            cur = self._conn.execute('''delete from %s where cname=? and insert_time=? and not exists (
+            select 1 from table_size_run_table t where t.run_id=? and t.dbname=%s.dbname and
+            t.tabname=%s.tabname)''' % (table_name, table_name, table_name),
+                                     (self.cluster_name, self.insert_time, self.run_id))
+            if cur.rowcount > 0:
+                log.info("checkpoint remove %d unfinished rows from %s" % (cur.rowcount, table_name))
+        self._conn.commit()
+        log.info("checkpoint resume run:%d,insert_time:%s,done tables:%d" % (
+            self.run_id, self.insert_time, len(self.done_tables)))
+        return True
+
+    def is_done(self, dbname, tabname):
+        return (dbname, tabname) in self.done_tables
+
+    # 记录已经完成的表，tables_map为get_phy_cluster_tables_size等方法的返回值
+    def mark_done(self, tables_map):
+        self._conn.executemany("insert or replace into table_size_run_table values (?,?,?,?)",
+                               [(self.run_id, val["dbname"], val["tabname"], json.dumps(val)) for val in
+                                tables_map.values()])
+        self._conn.commit()
+        self.done_count += len(tables_map)
+
+    def finish(self):
+        self._conn.execute("update table_size_run set status='done',end_time=datetime('now','localtime') where run_id=?",
+                           (self.run_id,))
+        self._conn.execute("delete from table_size_run_table where run_id=?", (self.run_id,))
+        self._conn.commit()
+        log.info("checkpoint finish run:%d" % (self.run_id))
+
+    def close(self):
+        self._conn.close()
+
+
 class Node:
     def __init__(self):
         self.id = ""
@@ -176,6 +1476,7 @@ class Store:
     def __init__(self):
         self.id = 0
         self.address = ""
+        self.is_tiflash = False  # 根据store的engine标签判断
 
 
 # 一张表中可能包含多个分区信息，多个分区可能共用一个region
@@ -196,8 +1497,14 @@ class TableInfo:
         self.partition_name_list = []
         self.index_region_map = {}
         self.all_region_map = {}  # 表和索引的region（包括重合部分),获取property时就用变量
-        self.sstfiles_withoutsize_map = {}  # key:(node_id,sstname);value:SSTFile region property中存在，但是在实际物理文件中不存在的sstfile，去重
+        self.sstfiles_withoutsize_set = set()  # (node_id,sst_no) region property中存在，但是在实际物理文件中不存在的sstfile，去重
         self.cf_info = None
+        self.sampled_region_ids = None  # 抽样模式下抽取的region_id集合，为None说明不抽样
+        # 远程聚合模式下tikv节点汇总的结果，key:data/index/table,value:[已获取大小的sstfile总大小,已获取大小的sstfile数,不存在的sstfile数]
+        self.aggregated_sizes = None
+        self.segments = []  # 每个分区的数据和索引的key范围，[(start_key,end_key,(分区名,索引名))]，索引名为None表示数据
+        self.physical_ids = []  # 物理表（非分区表或者分区）的id
+        self.index_region_ids = {}  # key:索引名,value:该索引（所有分区）的region_id集合，只有开启mvcc统计时才记录
 
     def estimate_with_cf(self, cf_info):
         self.cf_info = cf_info
@@ -214,21 +1521,29 @@ class TableInfo:
     # 预估提供两种方案：1、对于没有size的sst按照每一个8MB方式填充；2、计算出总的sst文件的大小算出每一个sst文件的平均值，利用平均值填充没有size的sst
     # prams:cf_info，如果当前sst文件只计算了writecf的，那么需要对defaultcf的sst文件进行预估
     def _get_xx_size(self, region_map, predict=True):
-        # predict_method-> 1: sstfile_size=8MB;2: sstfile_size = avg(sstfiles_size)
-        predict_method = 2
         # 已有的数据大小
         total_size = 0
         sstfile_dictinct_map = {}  # 避免sstfile被多个region重复计算
         for region in region_map.values():
-            if len(region.sstfile_list) == 0:
+            if len(region.sst_nos) == 0:
                 continue
-            for sstfile in region.sstfile_list:
-                sstfile_dictinct_map[(sstfile.sst_node_id, sstfile.sst_name)] = sstfile.sst_size
+            for sst_no, sst_size in zip(region.sst_nos, region.sst_sizes):
+                sstfile_dictinct_map[(region.props_node_id, sst_no)] = sst_size
         total_sstfiles_cnt = len(sstfile_dictinct_map)  # 包含没有大小的sstfile文件
         for size in sstfile_dictinct_map.values():
             total_size += size
+        return self._estimate_size(total_size, total_sstfiles_cnt, len(self.sstfiles_withoutsize_set), predict)
+
+    # 远程聚合模式下根据tikv节点上汇总的结果计算大小，kind为data、index或table
+    def _get_xx_size_aggregated(self, kind, predict=True):
+        withsize_total, withsize_cnt, withoutsize_cnt = self.aggregated_sizes.get(kind, (0, 0, 0))
+        return self._estimate_size(withsize_total, withsize_cnt + withoutsize_cnt, withoutsize_cnt, predict)
+
+    # total_size:已获取到大小的sstfile总大小，total_sstfiles_cnt:sstfile总数（包含没有大小的sstfile），sstfiles_withoutsize_cnt:没有大小的sstfile数
+    def _estimate_size(self, total_size, total_sstfiles_cnt, sstfiles_withoutsize_cnt, predict=True):
+        # predict_method-> 1: sstfile_size=8MB;2: sstfile_size = avg(sstfiles_size)
+        predict_method = 2
         if predict:
-            sstfiles_withoutsize_cnt = len(self.sstfiles_withoutsize_map)
             sstfiles_withsize_cnt = total_sstfiles_cnt - sstfiles_withoutsize_cnt
             if sstfiles_withsize_cnt != 0:
                 if predict_method == 1:
@@ -238,6 +1553,10 @@ class TableInfo:
                     total_size = total_size * total_sstfiles_cnt / sstfiles_withsize_cnt
                 else:
                     log.error("no this predict_method:%s,return total_size without predict" % (predict_method))
+        return int(self._scale_with_cf(total_size))
+
+    # 如果region property只打印了writecf的sstfile，根据prometheus中defaultcf和writecf的比例预估总大小
+    def _scale_with_cf(self, total_size):
         if self.cf_info is not None:
             log.info(
                 "tabname:%s,tikv-ctl region properties dump only sst_file instead of writecf.sst_file and defaultcf.sst_file,estimate it" % (
@@ -261,66 +1580,553 @@ class TableInfo:
                             self.cf_info.defaultcf_sstfiles_count + self.cf_info.writecf_sstfiles_count) / self.cf_info.writecf_sstfiles_count
                 else:
                     log.warning("cannot estimate!")
-        return int(total_size)
+        return total_size
+
+    # region所属的层的类型：只属于数据为data，只属于索引为index，同时属于数据和索引为both
+    # 数据、索引和整张表的region都由完整的层组成，估算时每一层都有抽样region
+    def _get_region_kind(self, region_id):
+        if region_id in self.data_region_map:
+            return "both" if region_id in self.index_region_map else "data"
+        return "index"
+
+    # 按照store和数据/索引分层随机抽样region，只查询抽样region的property信息
+    # sample_ratio:每层的抽样比例；sample_count:整张表的抽样region数，按照每层region数的比例分配到每层
+    # 每层至少抽取2个region（不足2个时全部抽取），用于计算方差
+    def sample_regions(self, sample_ratio=0.0, sample_count=0, rand=random):
+        strata = {}  # key:(store node_id,data/index/both),value:[region_id]
+        for region_id, region in self.all_region_map.items():
+            strata.setdefault((region.leader_store_node_id, self._get_region_kind(region_id)), []).append(region_id)
+        total_region_cnt = len(self.all_region_map)
+        self.sampled_region_ids = set()
+        for stratum, region_ids in strata.items():
+            if sample_count > 0:
+                n = int(round(float(sample_count) * len(region_ids) / total_region_cnt))
+            else:
+                n = int(math.ceil(sample_ratio * len(region_ids)))
+            n = min(max(n, 2), len(region_ids))
+            self.sampled_region_ids.update(rand.sample(region_ids, n))
+        log.info("tabname:%s,sample regions:%d/%d,strata:%d" % (
+            self.dbname + "." + self.tabname, len(self.sampled_region_ids), total_region_cnt, len(strata)))
+
+    # 需要查询property信息的region
+    def get_property_region_map(self):
+        if self.sampled_region_ids is None:
+            return self.all_region_map
+        return dict((region_id, self.all_region_map[region_id]) for region_id in self.sampled_region_ids)
+
+    # 分层抽样估算region_map的总大小，返回(预估大小,95%置信区间的误差)
+    # 每层的总大小=层内region数*抽样region大小的均值，误差按照分层抽样的方差计算：sum(N^2*(1-n/N)*s^2/n)
+    # 和精确计算一样按照(node_id,sst_no)对sstfile去重：被多个抽样region引用的sstfile平均分摊到这些region上，
+    # 每个抽样region的大小为其分摊的sstfile大小之和，没有大小的sstfile按照层内sstfile的平均大小填充
+    # 没有抽样region的层（比如抽样之后新加入的region）按照所有抽样region大小的均值外推
+    def _get_xx_size_sampled(self, region_map):
+        strata = {}  # key:(store node_id,data/index/both),value:[region总数,[抽样region]]
+        sstfile_refs = {}  # key:(node_id,sst_no),value:引用该sstfile的抽样region数
+        for region_id, region in region_map.items():
+            stratum = strata.setdefault((region.leader_store_node_id, self._get_region_kind(region_id)), [0, []])
+            stratum[0] += 1
+            if region_id in self.sampled_region_ids:
+                stratum[1].append(region)
+                for sst_no in set(region.sst_nos):
+                    sstfile_refs[(region.props_node_id, sst_no)] = sstfile_refs.get((region.props_node_id, sst_no), 0) + 1
+        total_size = 0.0
+        variance = 0.0
+        unsampled_population = 0
+        sampled_size_total = 0.0
+        sampled_cnt = 0
+        for (node_id, kind), (population, sampled) in strata.items():
+            if len(sampled) == 0:
+                log.warning("tabname:%s,stratum:%s-%s has no sampled region,extrapolate %d regions" % (
+                    self.tabname, node_id, kind, population))
+                unsampled_population += population
+                continue
+            withsize_total = 0.0
+            withsize_cnt = 0.0
+            for region in sampled:
+                for sst_no, sst_size in zip(region.sst_nos, region.sst_sizes):
+                    if (region.props_node_id, sst_no) not in self.sstfiles_withoutsize_set:
+                        refs = sstfile_refs[(region.props_node_id, sst_no)]
+                        withsize_total += float(sst_size) / refs
+                        withsize_cnt += 1.0 / refs
+            avg_sstfile_size = withsize_total / withsize_cnt if withsize_cnt != 0 else 0.0
+            region_sizes = []
+            for region in sampled:
+                region_size = 0.0
+                for sst_no, sst_size in zip(region.sst_nos, region.sst_sizes):
+                    refs = sstfile_refs[(region.props_node_id, sst_no)]
+                    if (region.props_node_id, sst_no) in self.sstfiles_withoutsize_set:
+                        region_size += avg_sstfile_size / refs
+                    else:
+                        region_size += float(sst_size) / refs
+                region_sizes.append(region_size)
+            n = len(region_sizes)
+            mean = sum(region_sizes) / n
+            total_size += population * mean
+            sampled_size_total += sum(region_sizes)
+            sampled_cnt += n
+            if n > 1 and population > n:
+                s2 = sum([(x - mean) ** 2 for x in region_sizes]) / (n - 1)
+                variance += population * population * (1 - float(n) / population) * s2 / n
+        if unsampled_population > 0 and sampled_cnt > 0:
+            total_size += unsampled_population * sampled_size_total / sampled_cnt
+        error = 1.96 * math.sqrt(variance)
+        return int(self._scale_with_cf(total_size)), int(self._scale_with_cf(error))
+
+    # 返回(大小,抽样模式下95%置信区间的误差)，非抽样模式误差为0；kind为data、index或table
+    # 抽样模式下大小和误差由同一次_get_xx_size_sampled计算得到
+    def _get_xx_size_with_err(self, region_map, kind):
+        if self.sampled_region_ids is not None:
+            return self._get_xx_size_sampled(region_map)
+        if self.aggregated_sizes is not None:
+            return self._get_xx_size_aggregated(kind), 0
+        return self._get_xx_size(region_map), 0
+
+    # 一次计算数据、索引、整张表的大小和误差，返回((data_size,data_size_err),(index_size,index_size_err),(table_size,table_size_err))
+    def get_all_sizes_with_err(self):
+        return (self._get_xx_size_with_err(self.data_region_map, "data"),
+                self._get_xx_size_with_err(self.index_region_map, "index"),
+                self._get_xx_size_with_err(self.all_region_map, "table"))
 
     def get_all_data_size(self):
-        return self._get_xx_size(self.data_region_map)
+        return self._get_xx_size_with_err(self.data_region_map, "data")[0]
 
     def get_all_index_size(self):
-        return self._get_xx_size(self.index_region_map)
+        return self._get_xx_size_with_err(self.index_region_map, "index")[0]
 
     def get_all_table_size(self):
-        return self._get_xx_size(self.all_region_map)
+        return self._get_xx_size_with_err(self.all_region_map, "table")[0]
+
+    # 添加一个物理表（非分区表或者分区）的数据和索引的key范围，index_list:[(index_id,index_name)]
+    def add_physical_segments(self, physical_id, partition_name, index_list):
+        self.physical_ids.append(physical_id)
+        self.segments.append((encode_record_key(physical_id), encode_table_key(physical_id, b"_s"), (partition_name, None)))
+        for index_id, index_name in index_list:
+            self.segments.append((encode_index_key(physical_id, index_id), encode_index_key(physical_id, index_id + 1),
+                                  (partition_name, index_name)))
+
+    # 把表的大小分摊到每个分区和每个索引上，返回({分区名:大小},{索引名:大小})
+    # 每个region以pd的approximate_size为权重，按它覆盖的每个分区数据、索引区间在region的key范围中所占的比例拆分，
+    # 区间之间没有数据的key范围不参与拆分，每个region拆分后的权重之和等于region的权重（数据和索引、多个分区共用的region不重复计算）
+    # 分区的大小包括分区的数据和索引，按权重分摊table_size；索引的大小只按索引的权重分摊index_size
+    # 分摊后所有分区的大小之和等于table_size，所有索引的大小之和等于index_size；没有pd中key范围的region不参与计算
+    # 按key范围拆分的比例不代表region中数据的实际分布，第三个返回值为使用了这种拆分的分区、索引{(segment_type,名称)}，
+    # 多个分区共用的region计入分区的拆分，多个索引（数据和索引）共用的region计入索引的拆分
+    def get_segment_sizes(self, table_size, index_size):
+        partition_weights = dict((name, 0) for name in self.partition_name_list)
+        index_weights = dict((name, 0) for name in self.index_name_list)
+        split_segments = set()
+        key_range_index = KeyRangeIndex(self.segments)
+        for region in self.all_region_map.values():
+            if not region.has_pd_stats:
+                continue
+            overlaps = key_range_index.overlaps(region.start_key, region.end_key)
+            if len(overlaps) == 0:
+                continue
+            total_fraction = sum([fraction for segment, fraction in overlaps])
+            weight = max(region.approximate_size, 1)
+            if len(overlaps) > 1:
+                split_segments.update([("index", index_name) for (partition_name, index_name), fraction in overlaps
+                                       if index_name is not None])
+                partition_names = set([partition_name for (partition_name, index_name), fraction in overlaps])
+                if len(partition_names) > 1:
+                    split_segments.update([("partition", partition_name) for partition_name in partition_names])
+            for (partition_name, index_name), fraction in overlaps:
+                # 覆盖的区间在key范围中的比例都为0时平均拆分
+                share = weight * fraction / total_fraction if total_fraction > 0 else float(weight) / len(overlaps)
+                partition_weights[partition_name] = partition_weights.get(partition_name, 0) + share
+                if index_name is not None:
+                    index_weights[index_name] = index_weights.get(index_name, 0) + share
+        return (distribute_by_weights(table_size, partition_weights), distribute_by_weights(index_size, index_weights),
+                split_segments)
+
+    # 汇总已查询property的region的mvcc统计信息，返回{"table":stats,"data":stats,"index":stats,"indexes":{索引名:stats}}
+    # stats见sum_mvcc_stats，多个索引（数据和索引）共用的region分别计入每个索引，整张表中只计算一次；抽样模式下只包含抽样的region
+    def get_mvcc_stats(self):
+        return {
+            "table": sum_mvcc_stats(self.all_region_map.values()),
+            "data": sum_mvcc_stats(self.data_region_map.values()),
+            "index": sum_mvcc_stats(self.index_region_map.values()),
+            "indexes": dict((index_name, sum_mvcc_stats([self.all_region_map[region_id] for region_id in region_ids]))
+                            for index_name, region_ids in self.index_region_ids.items()),
+        }
+
+    # 根据pd中region的approximate_size（单位MB）估算数据、索引和整张表的大小，返回(data_size,index_size,table_size)
+    def get_approximate_sizes(self):
+        def _sum(region_map):
+            return sum([region.approximate_size for region in region_map.values()]) * (1 << 20)
+
+        return _sum(self.data_region_map), _sum(self.index_region_map), _sum(self.all_region_map)
+
+    # 抽样模式下大小的误差（95%置信区间），非抽样模式为0，同时需要大小时使用get_all_sizes_with_err
+    def get_all_data_size_err(self):
+        if self.sampled_region_ids is None:
+            return 0
+        return self._get_xx_size_sampled(self.data_region_map)[1]
+
+    def get_all_index_size_err(self):
+        if self.sampled_region_ids is None:
+            return 0
+        return self._get_xx_size_sampled(self.index_region_map)[1]
+
+    def get_all_table_size_err(self):
+        if self.sampled_region_ids is None:
+            return 0
+        return self._get_xx_size_sampled(self.all_region_map)[1]
 
 
 # 一个region可能包含多个sstfile
-class Region:
+# region数量可能达到百万级，因此使用__slots__，副本和sstfile使用整数数组保存，不再为每个副本和sstfile创建对象
+class Region(object):
+    __slots__ = ("region_id", "leader_id", "leader_store_id", "leader_store_node_id", "sst_nos", "sst_sizes",
+                 "peer_store_ids", "conf_ver", "version", "start_key", "end_key", "approximate_size",
+                 "approximate_keys", "has_pd_stats", "props_node_id", "props_from_cache", "mvcc_stats")
+
     def __init__(self):
         self.region_id = 0
         self.leader_id = 0
         self.leader_store_id = 0
-        self.leader_store_node_id = ""
-        # 通过property查询，为空说明未查询到
-        self.sstfile_list = []  # SSTFile
-        self.peers = []
+        self.leader_store_node_id = ""  # intern后的store地址
+        # 通过property查询，为空说明未查询到，sstfile都位于props_node_id节点上
+        self.sst_nos = array.array(ARRAY_INT_TYPECODE)  # sstfile文件号
+        self.sst_sizes = array.array(ARRAY_INT_TYPECODE)  # 与sst_nos一一对应的sstfile大小，0表示未获取到大小
+        self.peer_store_ids = array.array(ARRAY_INT_TYPECODE)  # 副本所在的store_id（不包括tiflash）
+        self.conf_ver = 0  # region epoch
+        self.version = 0
+        # 以下信息只有从pd获取region信息时才有
+        self.start_key = b""  # memcomparable编码后的key
+        self.end_key = b""
+        self.approximate_size = 0  # 单位MB
+        self.approximate_keys = 0
+        self.has_pd_stats = False  # approximate_size和approximate_keys是否已经从pd获取
+        self.props_node_id = ""  # 查询region-properties的tikv节点，sstfile位于该节点上
+        self.props_from_cache = False  # property信息是否来自缓存
+        self.mvcc_stats = None  # region-properties中的mvcc统计信息，顺序同MVCC_PROPERTY_NAMES，只有开启mvcc统计时才记录
 
 
-class Peer:
-    def __init__(self):
-        self.region_id = 0
-        self.peer_id = 0
-        self.store_id = 0
+# 从region-properties的结果中解析出sst文件列表
+# 返回：(sstfile名称列表, 是否为只包含writecf的sst_files打印格式)
+def parse_region_sstfiles(result):
+    sstfile_names = []
+    only_writecf = False
+    for each_line in result.splitlines():
+        if each_line.find("sst_files:") > -1:
+            # 如果tikv-ctl region properties的结果中包含sst_files开头的说明打印的结果只包含了writecf的sst文件
+            if each_line.find("sst_files:") == 0:
+                only_writecf = True
+            each_line_fields = each_line.split(":")
+            each_line_fields_len = len(each_line_fields)
+            if each_line_fields_len == 2 and each_line_fields[1] != "":
+                for sstfilename in [x.strip() for x in each_line_fields[1].split(",")]:
+                    if sstfilename == "":
+                        continue
+                    sstfile_names.append(sstfilename)
+    return sstfile_names, only_writecf
 
 
-class SSTFile:
-    def __init__(self):
-        self.sst_name = ""
-        self.sst_size = 0
-        self.sst_node_id = ""
-        self.region_id_list = []  # 当前sstfile包含哪些region_id
+# region-properties结果中的mvcc统计项：mvcc.*为writecf中的mvcc统计，num_entries、num_deletes为rocksdb的key数和删除标记（tombstone）数
+# 新版本的tikv-ctl按cf打印，writecf.num_entries、writecf.num_deletes对应老版本的num_entries、num_deletes（同sst_files）
+MVCC_PROPERTY_NAMES = ("mvcc.num_rows", "mvcc.num_puts", "mvcc.num_deletes", "mvcc.num_versions", "mvcc.max_row_versions",
+                       "num_entries", "num_deletes")
+
+
+# 从region-properties的结果中解析出mvcc统计信息，返回顺序同MVCC_PROPERTY_NAMES的列表，没有mvcc信息时返回None
+def parse_region_mvcc(result):
+    values = {}
+    for each_line in result.splitlines():
+        each_line_fields = each_line.split(":")
+        if len(each_line_fields) != 2:
+            continue
+        name, value = each_line_fields[0].strip(), each_line_fields[1].strip()
+        if name.startswith("writecf."):
+            name = name[len("writecf."):]
+        if name in MVCC_PROPERTY_NAMES and value.isdigit():
+            values[name] = int(value)
+    if "mvcc.num_versions" not in values:
+        return None
+    return [values.get(name, 0) for name in MVCC_PROPERTY_NAMES]
+
+
+# 汇总多个region的mvcc统计信息，max_row_versions取最大值，其余求和
+# 返回key为MVCC_PROPERTY_NAMES去掉"mvcc."前缀（rocksdb的num_deletes为tombstones）的字典，并附加：
+# regions:有mvcc统计的region数；garbage_ratio:旧版本占比(1-num_rows/num_versions)；tombstone_ratio:删除标记占比(num_deletes/num_entries)
+def sum_mvcc_stats(regions):
+    totals = [0] * len(MVCC_PROPERTY_NAMES)
+    region_cnt = 0
+    for region in regions:
+        if region.mvcc_stats is None:
+            continue
+        region_cnt += 1
+        for i, value in enumerate(region.mvcc_stats):
+            if MVCC_PROPERTY_NAMES[i] == "mvcc.max_row_versions":
+                totals[i] = max(totals[i], value)
+            else:
+                totals[i] += value
+    stats = {"regions": region_cnt}
+    for name, value in zip(MVCC_PROPERTY_NAMES, totals):
+        stats["tombstones" if name == "num_deletes" else name.replace("mvcc.", "")] = value
+    stats["garbage_ratio"] = 1 - float(stats["num_rows"]) / stats["num_versions"] if stats["num_versions"] > 0 else 0.0
+    stats["tombstone_ratio"] = float(stats["tombstones"]) / stats["num_entries"] if stats["num_entries"] > 0 else 0.0
+    return stats
+
+
+# 常驻的region-properties查询进程，一个worker对应一个tikv store
+# 通过stdin逐个下发region_id，由sh循环调用tikv-ctl，每个region结束后输出结束标记，避免每个region都经过一次tiup的启动和组件解析
+class RegionPropertiesWorker(object):
+    end_marker = "__REGION_PROPERTIES_END__"
+
+    def __init__(self, ctl_cmd, address, timeout=30):
+        self.ctl_cmd = ctl_cmd  # tikv-ctl二进制路径，"tiup ctl:<ver> tikv"每次调用都要启动tiup，不使用常驻进程
+        self.address = address
+        self.timeout = timeout
+        self._proc = None
+        self._timeout_flag = False
+
+    @staticmethod
+    def script(ctl_cmd, address):
+        return 'while read rid; do %s --host %s region-properties -r "$rid" 2>&1; echo "%s $rid $?"; done' % (
+            ctl_cmd, shell_quote(address), RegionPropertiesWorker.end_marker)
+
+    def _start(self):
+        script = RegionPropertiesWorker.script(self.ctl_cmd, self.address)
+        log.debug("RegionPropertiesWorker start,address:%s,script:%s" % (self.address, script))
+        self._proc = subprocess.Popen(["sh", "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT, universal_newlines=True, preexec_fn=os.setsid)
+
+    def _kill(self):
+        self._timeout_flag = True
+        try:
+            # 连同正在执行的tikv-ctl子进程一起kill
+            os.killpg(self._proc.pid, signal.SIGKILL)
+        except Exception as e:
+            log.debug("RegionPropertiesWorker kill error:%s" % (e))
+
+    # 返回值与command_run一致：(result,recode)
+    def query(self, region_id):
+        if self._proc is None or self._proc.poll() is not None:
+            self._start()
+        self._timeout_flag = False
+        timer = threading.Timer(self.timeout, self._kill)
+        timer.start()
+        lines = []
+        try:
+            self._proc.stdin.write("%d\n" % (region_id))
+            self._proc.stdin.flush()
+            while True:
+                line = self._proc.stdout.readline()
+                if line == "":
+                    # 进程退出（超时被kill或者异常退出），下次查询时重新拉起
+                    self._proc.wait()
+                    self._proc = None
+                    if self._timeout_flag:
+                        return "Timeout Error!", 9
+                    return "".join(lines) + "region-properties worker exited", 1
+                if line.startswith(RegionPropertiesWorker.end_marker):
+                    fields = line.split()
+                    recode = int(fields[2]) if len(fields) == 3 and fields[2].isdigit() else 1
+                    return "".join(lines), recode
+                lines.append(line)
+        except (IOError, OSError) as e:
+            self._kill()
+            self._proc = None
+            return "region-properties worker error:%s" % (e), 1
+        finally:
+            timer.cancel()
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+            self._proc.wait()
+        except Exception as e:
+            log.debug("RegionPropertiesWorker close error:%s" % (e))
+        self._proc = None
+
+
+# 按store维护RegionPropertiesWorker池，每个store最多workers_per_store个常驻进程
+class RegionPropertiesCollector(object):
+    def __init__(self, ctl_cmd, workers_per_store=1, timeout=30):
+        self.ctl_cmd = ctl_cmd
+        self.workers_per_store = workers_per_store
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle_workers = {}  # key:store address,value:Queue(RegionPropertiesWorker)
+        self._all_workers = []
+
+    def _get_idle_queue(self, address):
+        with self._lock:
+            if address not in self._idle_workers:
+                idle_queue = Queue()
+                for i in range(self.workers_per_store):
+                    worker = RegionPropertiesWorker(self.ctl_cmd, address, self.timeout)
+                    self._all_workers.append(worker)
+                    idle_queue.put(worker)
+                self._idle_workers[address] = idle_queue
+            return self._idle_workers[address]
+
+    def query(self, address, region_id):
+        idle_queue = self._get_idle_queue(address)
+        worker = idle_queue.get()
+        try:
+            return worker.query(region_id)
+        finally:
+            idle_queue.put(worker)
+
+    def close(self):
+        for worker in self._all_workers:
+            worker.close()
+        self._all_workers = []
+        self._idle_workers = {}
 
 
 class TiDBCluster:
     roles = ["alertmanager", "grafana", "pd", "prometheus", "tidb", "tiflash", "tikv"]
 
-    def __init__(self, cluster_name):
+    # check_ctl=False时不检查tikv-ctl（比如只使用pd的region统计信息的场景）
+    def __init__(self, cluster_name, check_ctl=True):
         self.cluster_name = cluster_name
         self.cluster_version = ""
         self.tidb_nodes = []
         self._get_clusterinfo()
-        self.ctl_version = self.get_ctl_version()
-        self._check_env()
-        self._sstfiles_list = []
-        self._get_store_sstfiles_bystoreall_once = False  # 是否调用过get_store_sstfiles_bystoreall方法，如果调用过则说明_sstfiles_list包含所有的sstfile文件信息，不需要重复执行
+        self.ctl_version = ""
+        if check_ctl:
+            self.ctl_version = self.get_ctl_version()
+            self._check_env()
+        self._sstfile_map = {}  # key:node_id,value:{sst_no:sstfile大小}
+        self._get_store_sstfiles_bystoreall_once = False  # 是否调用过get_store_sstfiles_bystoreall方法，如果调用过则说明_sstfile_map包含所有的sstfile文件信息，不需要重复执行
         self._table_region_map = {}  # 所有表的region信息
+        self._region_registry = {}  # key:region_id,value:Region，所有表共用的region信息，用于region去重
+        self._pd_schema_map = {}  # key:dbname,value:get_pd_schema4db的结果，pd方式发现region时每个数据库只获取一次表结构
         self._stores = []  # stores列表
         # 通过region properties打印的信息中包含sst_files（不包含writecf.sst_files和defaultcf.sst_files），该值在源码中只包含了writecf的大小，需要估算defaultcf的大小
         # 新版本情况：https://github.com/tikv/tikv/blob/790c744e582d4fddfab2b884b40d7d5af14a47e1/src/server/debug.rs#L918
         # 老版本情况：https://github.com/tikv/tikv/blob/09a7e1efb40386d804f42ef6ba593f6b85924973/src/server/debug.rs#L918
         self.property_only_writecf_mode = False  # 目前根据region的property结果来判断，todo 最好按照tidb的版本来判断
+        self._properties_collector = None  # RegionPropertiesCollector，get_phy_tables_size期间有效
+        # region-properties查询引擎：auto（python3下使用asyncio）、thread、asyncio
+        self.properties_engine = "auto"
+        self.store_parallel = 1  # 每个store的region-properties并发上限，parallel为整个集群的并发上限
+        self.host_parallel = 1  # 同时获取sstfile大小的tikv节点数
+        self.stat_chunk_size = 5000  # 定点stat时每批的sstfile数
+        self.stat_chunk_parallel = 4  # 每个节点同时执行的stat批次数
+        # 查询region-properties时选择副本的策略：leader、round-robin、least-loaded、store:<store_id>
+        self.peer_policy = "leader"
+        self.remote_aggregate = False  # 在tikv节点上按表汇总sstfile大小，只返回每张表的汇总结果
+        self.stat_inline_max = 200  # 每批sstfile数不超过此值时直接放在命令行中，否则通过tiup cluster push上传文件名清单
+        self.adaptive = False  # 是否根据调用延迟自动调整region-properties和stat的并发，parallel等参数作为并发上限
+        self.top_margin = 0.2  # top模式下剩下的表的大小上限的额外余量
+        self.top_candidates = 4  # top模式下每轮按approximate大小保留top*top_candidates张候选表
+        self.max_grpc_p99 = 0.0  # adaptive模式下tikv grpc p99延迟（秒）超过此值时降低并发，0表示不检查prometheus
+        self._properties_gate = None  # ConcurrencyGate，get_phy_tables_size期间有效
+        self._stat_gate = None  # ConcurrencyGate，get_phy_tables_size期间有效
+        # 获取sstfile大小时每个sstfile的相对代价（经验值）：定点stat每个文件都要fork一次stat，全量获取时find|xargs stat批量执行
+        self.stat_file_cost = 1.0
+        self.scan_file_cost = 0.05
+        # region信息获取方式：table（按表调用tidb status接口）、pd（按key范围一次扫描pd的region信息）
+        self.region_discovery = "table"
+        # 抽样模式：sample_ratio为每层region的抽样比例，sample_count为每张表的抽样region数，都为0时不抽样
+        self.sample_ratio = 0.0
+        self.sample_count = 0
+        self.collect_approximate = False  # 精确计算时是否同时获取pd中的region大小，用于校准approximate模式
+        self.collect_detail = False  # 是否按key范围把表大小分摊到每个分区和每个索引上
+        self.collect_mvcc = False  # 是否汇总region-properties中的mvcc统计信息（旧版本、删除标记占比）
+        self.sst_size_cache = None  # SSTSizeCache，为None时不使用缓存
+        self.region_properties_cache = None  # RegionPropertiesCache，为None时不使用缓存
+        self._ctl_command = ""
+
+    # meta.yaml中每种角色的配置项名称，以及端口配置项和默认值，端口顺序和tiup cluster display的Ports列一致
+    meta_role_specs = [
+        ("alertmanager", "alertmanager_servers", [("web_port", 9093), ("cluster_port", 9094)]),
+        ("grafana", "grafana_servers", [("port", 3000)]),
+        ("pd", "pd_servers", [("client_port", 2379), ("peer_port", 2380)]),
+        ("prometheus", "monitoring_servers", [("port", 9090), ("ng_port", 12020)]),
+        ("tidb", "tidb_servers", [("port", 4000), ("status_port", 10080)]),
+        ("tiflash", "tiflash_servers", [("tcp_port", 9000), ("http_port", 8123), ("flash_service_port", 3930),
+                                        ("flash_proxy_port", 20170), ("flash_proxy_status_port", 20292),
+                                        ("metrics_port", 8234)]),
+        ("tikv", "tikv_servers", [("port", 20160), ("status_port", 20180)]),
+    ]
+
+    def _get_clusterinfo(self):
+        log.debug("TiDBCluster._get_clusterinfo")
+        if not self._get_clusterinfo_bymeta():
+            self._get_clusterinfo_bydisplay()
+
+    # 从tiup的meta.yaml中获取集群拓扑，不访问任何节点，没有安装pyyaml或者找不到meta.yaml时返回False
+    def _get_clusterinfo_bymeta(self):
+        tiup_home = os.environ.get("TIUP_HOME", os.path.expanduser("~/.tiup"))
+        meta_file = os.path.join(tiup_home, "storage", "cluster", "clusters", self.cluster_name, "meta.yaml")
+        if yaml is None:
+            log.info("pyyaml is not installed,get cluster info by tiup cluster display")
+            return False
+        if not os.path.isfile(meta_file):
+            log.info("cannot find %s,get cluster info by tiup cluster display" % (meta_file))
+            return False
+        log.debug("TiDBCluster._get_clusterinfo_bymeta,meta file:%s" % (meta_file))
+        with open(meta_file) as f:
+            meta = yaml.safe_load(f) or {}
+        self.cluster_version = str(meta.get("tidb_version", ""))
+        topology = meta.get("topology") or {}
+        global_spec = topology.get("global") or {}
+        user = global_spec.get("user") or meta.get("user") or "tidb"
+        global_deploy_dir = global_spec.get("deploy_dir") or "deploy"
+        global_data_dir = global_spec.get("data_dir") or "data"
+        for role, servers_key, port_keys in TiDBCluster.meta_role_specs:
+            for spec in topology.get(servers_key) or []:
+                ports = [int(spec.get(port_key) or default_port) for port_key, default_port in port_keys]
+                node = Node()
+                node.role = role
+                node.host = str(spec["host"])
+                node.service_port = ports[0]
+                if len(ports) > 1:
+                    node.status_port = ports[1]
+                node.id = "%s:%d" % (node.host, node.service_port)
+                # 和tiup的规则一致：实例没有配置目录时使用global中的目录，相对路径的deploy_dir在/home/<user>下，
+                # 相对路径的data_dir在实例的deploy_dir下
+                dir_name = "%s-%d" % (role, node.service_port)
+                deploy_dir = spec.get("deploy_dir") or os.path.join(global_deploy_dir, dir_name)
+                if not os.path.isabs(deploy_dir):
+                    deploy_dir = os.path.join("/home", user, deploy_dir)
+                if role in ("tidb", "grafana"):
+                    node.data_dir = "-"
+                elif spec.get("data_dir"):
+                    node.data_dir = spec["data_dir"] if os.path.isabs(spec["data_dir"]) else os.path.join(
+                        deploy_dir, spec["data_dir"])
+                elif os.path.isabs(global_data_dir):
+                    node.data_dir = os.path.join(global_data_dir, dir_name)
+                else:
+                    node.data_dir = os.path.join(deploy_dir, global_data_dir)
+                self.tidb_nodes.append(node)
+        log.info("cluster:%s,version:%s,nodes:%d from meta.yaml" % (
+            self.cluster_name, self.cluster_version, len(self.tidb_nodes)))
+        return True
+
+    # 通过tiup cluster display检查节点状态，去掉状态不是Up（Healthy）的节点，比如Down、Tombstone、Pending Offline
+    def check_liveness(self):
+        display_command = "tiup cluster display %s" % (self.cluster_name)
+        result, recode = command_run(display_command, timeout=300)
+        if recode != 0:
+            raise Exception("tiup display error:%s" % result)
+        status_map = {}  # key:node_id,value:状态
+        for each_line in result.splitlines():
+            each_line_fields = each_line.split()
+            # 状态可能包含空格（Pending Offline），位于Ports/OS/Arch之后、Data Dir/Deploy Dir之前
+            if len(each_line_fields) >= 8 and each_line_fields[1] in TiDBCluster.roles:
+                status_map[each_line_fields[0]] = " ".join(each_line_fields[5:-2])
+        alive_nodes = []
+        for node in self.tidb_nodes:
+            status = status_map.get(node.id, "")
+            if status == "" or status.startswith("Up") or status.startswith("Healthy"):
+                alive_nodes.append(node)
+            else:
+                log.warning("node:%s,role:%s,status:%s,ignore it" % (node.id, node.role, status))
+        removed_count = len(self.tidb_nodes) - len(alive_nodes)
+        self.tidb_nodes = alive_nodes
+        return removed_count
 
-    def _get_clusterinfo(self):
-        log.debug("TiDBCluster._get_clusterinfo")
+    # 通过tiup cluster display获取集群拓扑，display会检查每个节点的状态，集群较大时需要数秒
+    def _get_clusterinfo_bydisplay(self):
+        log.debug("TiDBCluster._get_clusterinfo_bydisplay")
         display_command = "tiup cluster display %s" % (self.cluster_name)
         result, recode = command_run(display_command)
         log.debug("tiup display command:%s" % (display_command))
@@ -356,25 +2162,25 @@ class TiDBCluster:
         if recode != 0:
             raise Exception("tikv-ctl check error,cmd:%s,message:%s" % (cmd, result))
 
+    # 所有tidb节点的status地址，请求在这些地址之间轮流发送
+    def _get_tidb_status_addresses(self):
+        return ["%s:%s" % (node.host, node.status_port) for node in self.tidb_nodes if node.role == "tidb"]
+
+    # 所有pd节点的地址，pd的follower会把api请求转发给leader
+    def _get_pd_addresses(self):
+        return ["%s:%s" % (node.host, node.service_port) for node in self.tidb_nodes if node.role == "pd"]
+
     # 返回数据库列表
     def get_dblist(self, ignore=['performance_schema', 'metrics_schema', 'information_schema', 'mysql']):
         log.debug("TiDBCluster.get_dblist")
         db_list = []
-        req = ""
-        for node in self.tidb_nodes:
-            if node.role == "tidb":
-                req = "http://%s:%s/schema" % (node.host, node.status_port)
-                break
-        if req == "":
-            raise Exception("cannot find db list,%s" % (req))
-        log.debug("get_dblist.request:%s" % (req))
-        rep = request.urlopen(req)
-        if rep.getcode() != 200:
-            raise Exception(req)
-        rep_data = rep.read()
-        if rep_data == "":
-            raise Exception("%s,data is None" % (req))
-        json_data = json.loads(rep_data)
+        addresses = self._get_tidb_status_addresses()
+        if len(addresses) == 0:
+            raise Exception("cannot find db list,no tidb node")
+        log.debug("get_dblist.request:/schema")
+        json_data, err = http_client.get_json(addresses, "/schema")
+        if err is not None:
+            raise Exception(err)
         for each_db in json_data:
             each_dbname = each_db["db_name"]["L"]
             if each_dbname not in ignore:
@@ -382,26 +2188,60 @@ class TiDBCluster:
         log.info("db_list:%s" % (",".join(db_list)))
         return db_list
 
+    # 获取数据库中所有表的表结构信息(tidb status接口/schema/{db}的结果)
+    def get_tableinfos4db(self, dbname):
+        log.debug("TiDBCluster.get_tableinfos4db")
+        addresses = self._get_tidb_status_addresses()
+        if len(addresses) == 0:
+            raise Exception("cannot find table list for db:%s,no tidb node" % (dbname))
+        req = "/schema/%s" % (dbname)
+        log.debug("get_tableinfos4db.request:%s" % (req))
+        json_data, err = http_client.get_json(addresses, req)
+        if err is not None:
+            raise Exception("database:%s no tables,message:%s" % (dbname, err))
+        return json_data
+
+    # 返回pd方式发现region需要的表结构摘要，key:tabname,value:([(index_id,index_name)],[(physical_id,physical_name)])
+    # physical为分区表的每个分区或者非分区表本身。/schema/{db}按表逐个增量解析，只保留摘要，每个数据库只获取一次
+    def get_pd_schema4db(self, dbname):
+        if dbname in self._pd_schema_map:
+            return self._pd_schema_map[dbname]
+        addresses = self._get_tidb_status_addresses()
+        if len(addresses) == 0:
+            raise Exception("cannot find table list for db:%s,no tidb node" % (dbname))
+        req = "/schema/%s" % (dbname)
+        log.debug("get_pd_schema4db.request:%s" % (req))
+        schema = {}
+
+        def on_table(path, each_table):
+            tabname = intern(str(each_table["name"]["L"]))
+            index_list = [(each_index["id"], intern(str(each_index["idx_name"]["L"]))) for each_index in
+                          (each_table.get("index_info") or [])]
+            partition_info = each_table.get("partition")
+            if partition_info is not None and len(partition_info.get("definitions") or []) > 0:
+                physical_list = [(each_def["id"], intern(str(each_def["name"]["L"]))) for each_def in
+                                 partition_info["definitions"]]
+            else:
+                physical_list = [(each_table["id"], tabname)]
+            schema[tabname] = (index_list, physical_list)
+
+        try:
+            rep = http_client.request(addresses, req)
+        except Exception as e:
+            raise Exception("database:%s no tables,message:%s" % (dbname, e))
+        try:
+            IncrementalJSONReader(rep).parse(on_table, [("*",)])
+        finally:
+            rep.close()
+        log.info("dbname:%s,schema tables:%d" % (dbname, len(schema)))
+        self._pd_schema_map[dbname] = schema
+        return schema
+
     # 获取表名列表
     def get_tablelist4db(self, dbname):
         log.debug("TiDBCluster.get_tablelist4db")
         tabname_list = []
-        req = ""
-        for node in self.tidb_nodes:
-            if node.role == "tidb":
-                req = "http://%s:%s/schema/%s" % (node.host, node.status_port, dbname)
-                break
-        if req == "":
-            raise Exception("cannot find table list for db,%s" % (req))
-        log.debug("get_tablelist4db.request:%s" % (req))
-        rep = request.urlopen(req)
-        if rep.getcode() != 200:
-            raise Exception(req)
-        rep_data = rep.read()
-        if rep_data == "":
-            raise Exception("database:%s no tables" % (dbname))
-        json_data = json.loads(rep_data)
-        for each_table in json_data:
+        for each_table in self.get_tableinfos4db(dbname):
             tabname_list.append(each_table["name"]["L"])
         log.info("tabname_list:%s" % (",".join(tabname_list)))
         return tabname_list
@@ -414,137 +2254,568 @@ class TiDBCluster:
     # 返回 dbname+"."+tabname为key，TableInfo为value的字典
     # 在多数据库获取时候一定要先获取完成所有数据库的region信息
     def _get_regions4tables(self, dbname, tabname_list):
+        if self.region_discovery == "pd":
+            return self._get_regions4tables_bypd(dbname, tabname_list)
         self._table_region_map = {}
         log.debug("TiDBCluster.get_regions4tables")
-        req = ""
+        addresses = self._get_tidb_status_addresses()
+        if len(addresses) == 0:
+            log.error("cannot find regions,no tidb node")
+            return self._table_region_map
         # table_region_map = {} #key:dbname+"."+tabname,value:TableInfo
-        stores = self.get_all_stores()
+        store_address_map = {}  # key:store_id,value:address
+        for store in self.get_all_stores():
+            store_address_map[store.id] = store.address
         log.debug("tabname_list:%s" % (",".join(tabname_list)))
+        table_region_map = {}
+
+        def get_table_regions(tabname):
+            table_info = self._get_table_regions(addresses, store_address_map, dbname, tabname)
+            if table_info is not None:
+                table_region_map[dbname + "." + tabname] = table_info
+
+        # 每个tidb节点同时处理一张表的请求，表较多时获取region信息的速度随tidb节点数增加
+        run_in_threads(tabname_list, get_table_regions, len(addresses))
+        # 保持tabname_list的顺序
         for tabname in tabname_list:
-            table_info = TableInfo()
-            table_info.dbname = dbname
-            table_info.tabname = tabname
-            for node in self.tidb_nodes:
-                if node.role == "tidb":
-                    req = "http://%s:%s/tables/%s/%s/regions" % (node.host, node.status_port, dbname, tabname)
-                    break
-            if req == "":
-                log.error("cannot find regions,%s" % (req))
-                # return table_region_map
-                return self._table_region_map
-            log.info("get table:%s region info:%s" % (dbname + "." + tabname, req))
-            try:
-                rep = request.urlopen(req)
-            except Exception as e:
-                log.error("url error %s,message:%s,tablename: %s may not exists!" % (e, req, dbname + "." + tabname))
-                continue
-            if rep.getcode() != 200:
-                log.error("cannot find regions,%s" % (req))
+            if dbname + "." + tabname in table_region_map:
+                self._table_region_map[dbname + "." + tabname] = table_region_map[dbname + "." + tabname]
+        return self._table_region_map
+
+    # 从tidb的status接口获取一张表的region信息，返回TableInfo，表不存在时返回None
+    def _get_table_regions(self, addresses, store_address_map, dbname, tabname):
+        table_info = TableInfo()
+        table_info.dbname = dbname
+        table_info.tabname = tabname
+        req = "/tables/%s/%s/regions" % (dbname, tabname)
+        log.info("get table:%s region info:%s" % (dbname + "." + tabname, req))
+        try:
+            rep = http_client.request(addresses, req)
+        except Exception as e:
+            log.error("url error %s,message:%s,tablename: %s may not exists!" % (e, req, dbname + "." + tabname))
+            return None
+        # 分区表返回每个分区的列表，非分区表只返回一个分区，分区中的region逐个解析并加入table_info，
+        # 表的region很多时返回的数据有几百MB，不能一次性读取和解析
+        segment_meta = {}  # key:分区的位置，value:{"name":分区名,"id":物理表id,"indices":{索引的位置:{"name":索引名,"id":索引id}}}
+        try:
+            IncrementalJSONReader(rep).parse(
+                lambda path, value: self._on_table_regions_value(table_info, store_address_map, path, value,
+                                                                 segment_meta),
+                [("record_regions", "*"), ("indices", "*", "regions", "*"),
+                 ("*", "record_regions", "*"), ("*", "indices", "*", "regions", "*")])
+        except Exception as e:
+            log.error("table:%s's json data format error,messges:%s" % (dbname + "." + tabname, e))
+        finally:
+            rep.close()
+        for partition_pos in sorted(segment_meta.keys()):
+            partition_meta = segment_meta[partition_pos]
+            if "id" not in partition_meta:
                 continue
-            rep_data = rep.read()
-            if rep_data == "":
-                log.error("table:%s,no regions" % (tabname))
+            index_list = [(index_meta["id"], index_meta.get("name", "")) for index_pos, index_meta in
+                          sorted(partition_meta["indices"].items()) if "id" in index_meta]
+            for index_meta in partition_meta["indices"].values():
+                if "region_ids" in index_meta:
+                    table_info.index_region_ids.setdefault(index_meta.get("name", ""), set()).update(
+                        index_meta["region_ids"])
+            table_info.add_physical_segments(partition_meta["id"], partition_meta.get("name", ""), index_list)
+        log.info("dbname:%s,tabname:%s data_region_count:%d,index_region_count:%d,table_region_count:%d" % (
+            dbname, tabname, len(table_info.data_region_map), len(table_info.index_region_map),
+            len(table_info.all_region_map)))
+        return table_info
+
+    # IncrementalJSONReader解析/tables/{db}/{table}/regions时的回调，path[0]为下标时是分区表的第几个分区
+    # segment_meta不为None时记录分区和索引的名称、id，用于生成TableInfo.segments
+    def _on_table_regions_value(self, table_info, store_address_map, path, value, segment_meta=None):
+        partition_pos = 0
+        if len(path) > 0 and isinstance(path[0], int):
+            partition_pos = path[0]
+            path = path[1:]
+        if segment_meta is not None:
+            partition_meta = segment_meta.setdefault(partition_pos, {"indices": {}})
+            if path == ("name",) or path == ("id",):
+                partition_meta[path[0]] = value
+            elif len(path) == 3 and path[0] == "indices" and path[2] in ("name", "id"):
+                partition_meta["indices"].setdefault(path[1], {})[path[2]] = value
+            elif self.collect_mvcc and len(path) == 4 and path[0] == "indices" and path[2] == "regions":
+                partition_meta["indices"].setdefault(path[1], {}).setdefault("region_ids", []).append(
+                    value["region_id"])
+        if path == ("name",):
+            # 获取数据信息
+            table_info.partition_name_list.append(value)
+        elif len(path) == 2 and path[0] == "record_regions":
+            region = self._register_region(self._new_region_from_tidb(value, store_address_map))
+            table_info.data_region_map[region.region_id] = region
+            table_info.all_region_map[region.region_id] = region
+        elif len(path) == 3 and path[0] == "indices" and path[2] == "name":
+            # 获取索引信息
+            table_info.index_name_list.append(value)
+        elif len(path) == 4 and path[0] == "indices" and path[2] == "regions":
+            region = self._register_region(self._new_region_from_tidb(value, store_address_map))
+            table_info.index_region_map[region.region_id] = region
+            table_info.all_region_map[region.region_id] = region
+
+    # 根据tidb status接口返回的region json数据生成Region
+    @staticmethod
+    def _new_region_from_tidb(each_region, store_address_map):
+        region = Region()
+        region.region_id = each_region["region_id"]
+        region.leader_id = each_region["leader"]["id"]
+        region.leader_store_id = each_region["leader"]["store_id"]
+        if "region_epoch" in each_region and each_region["region_epoch"] is not None:
+            region.conf_ver = each_region["region_epoch"].get("conf_ver", 0)
+            region.version = each_region["region_epoch"].get("version", 0)
+        for each_peer in each_region["peers"]:
+            # 避免引入tiflash
+            if "role" in each_peer and each_peer["role"] == 1:
                 continue
-            json_data = json.loads(rep_data)
-            json_data_list = []
-            if isinstance(json_data, dict):
-                json_data_list.append(json_data)
-            elif isinstance(json_data, list):
-                json_data_list = json_data
-            else:
-                log.error("table:%s's json data is not dict or list,source data:%s,json data:%s" % (
-                    dbname + "." + tabname, rep_data, json_data))
-            try:
-                for each_partition in json_data_list:
-                    # 获取数据信息
-                    table_info.partition_name_list.append(each_partition["name"])
-                    for each_region in each_partition["record_regions"]:
-                        region = Region()
-                        region.region_id = each_region["region_id"]
-                        region.leader_id = each_region["leader"]["id"]
-                        region.leader_store_id = each_region["leader"]["store_id"]
-                        for each_peer in each_region["peers"]:
-                            # 避免引入tiflash
-                            if "role" in each_peer and each_peer["role"] == 1:
-                                continue
-                            peer = Peer()
-                            peer.peer_id = each_peer["id"]
-                            peer.store_id = each_peer["store_id"]
-                            peer.region_id = region.region_id
-                            region.peers.append(peer)
-                        for store in stores:
-                            if store.id == region.leader_store_id:
-                                region.leader_store_node_id = store.address
-                                break
-                        table_info.data_region_map[region.region_id] = region
-                        table_info.all_region_map[region.region_id] = region
-                    # 获取索引信息
-                    for each_index in each_partition["indices"]:
-                        table_info.index_name_list.append(each_index["name"])
-                        for each_region in each_index["regions"]:
-                            region = Region()
-                            region.region_id = each_region["region_id"]
-                            region.leader_id = each_region["leader"]["id"]
-                            region.leader_store_id = each_region["leader"]["store_id"]
-                            for store in stores:
-                                if store.id == region.leader_store_id:
-                                    region.leader_store_node_id = store.address
-                                    break
-                            table_info.index_region_map[region.region_id] = region
-                            table_info.all_region_map[region.region_id] = region
-            except Exception as e:
-                log.error(log.error("table:%s's json data format error,source data:%s,json data:%s,messges:%s" % (
-                    dbname + "." + tabname, rep_data, json_data, e)))
-            # table_region_map[dbname + "." + tabname] = table_info
-            log.info("dbname:%s,tabname:%s data_region_count:%d,index_region_count:%d,table_region_count:%d" % (
-                dbname, tabname, len(table_info.data_region_map), len(table_info.index_region_map),
+            region.peer_store_ids.append(each_peer["store_id"])
+        region.leader_store_node_id = intern(str(store_address_map.get(region.leader_store_id, "")))
+        return region
+
+    # 从pd按照key范围扫描region信息，每次最多返回limit个region，返回region的json数据的生成器
+    # start_key/end_key为memcomparable编码后的key，end_key为空表示扫描到最后
+    def scan_pd_regions(self, start_key, end_key=b"", limit=10000):
+        pd_addresses = self._get_pd_addresses()
+        if len(pd_addresses) == 0:
+            raise Exception("cannot find pd node")
+        key = start_key
+        while True:
+            req = "/pd/api/v1/regions/key?key=%s&end_key=%s&limit=%d" % (
+                request.quote(key, safe=""), request.quote(end_key, safe=""), limit)
+            log.debug("scan_pd_regions.request:%s" % (req))
+            json_data, err = http_client.get_json(pd_addresses, req)
+            if err is not None:
+                raise Exception("scan pd regions error,url:%s,message:%s" % (req, err))
+            regions = json_data.get("regions") or []
+            for each_region in regions:
+                yield each_region
+            if len(regions) == 0:
+                return
+            next_key = binascii.unhexlify(regions[-1].get("end_key", ""))
+            if next_key == b"" or (end_key != b"" and next_key >= end_key) or next_key <= key:
+                return
+            key = next_key
+
+    # 通过pd按照key范围一次扫描整个数据库涉及的region，根据t{id}_r/t{id}_i{index_id}的key范围将region映射到表、分区和索引
+    # 表、分区和索引的id来自/schema/{db}，结果与_get_regions4tables一致
+    def _get_regions4tables_bypd(self, dbname, tabname_list):
+        return self._get_regions4dbs_bypd([(dbname, tabname_list)])
+
+    # db_tabname_list:[(dbname,tabname_list)]，多个数据库也只扫描一次pd
+    def _get_regions4dbs_bypd(self, db_tabname_list):
+        self._table_region_map = {}
+        log.debug("TiDBCluster._get_regions4dbs_bypd")
+        store_address_map = {}  # key:store_id,value:address
+        for store in self.get_all_stores():
+            store_address_map[store.id] = store.address
+        # 每个物理表（非分区表或者分区）对应的key范围
+        segments = {}  # key:physical_id,value:(TableInfo,[(index_id,index_name)])
+        skipped_ids = set()  # 同一个数据库中未选中的物理表id，扫描pd时跳过这些物理表的region
+        for dbname, tabname_list in db_tabname_list:
+            self._add_pd_segments4db(dbname, tabname_list, segments, skipped_ids)
+        if len(segments) == 0:
+            return self._table_region_map
+        physical_ids = sorted(segments.keys())
+        physical_keys = [encode_table_key(physical_id) for physical_id in physical_ids]
+        scan_ranges = get_pd_scan_ranges(physical_ids, skipped_ids,
+                                         dict((physical_id, segments[physical_id][0].dbname) for physical_id in
+                                              physical_ids))
+        log.info("scan pd regions,physical tables:%d,scan ranges:%d" % (len(physical_ids), len(scan_ranges)))
+
+        # 相邻的扫描范围可能返回同一个横跨边界的region，只处理一次
+        def scan_regions():
+            scanned_region_ids = set()
+            for first_id, last_id in scan_ranges:
+                for each_region in self.scan_pd_regions(encode_table_key(first_id), encode_table_key(last_id + 1)):
+                    if each_region["id"] in scanned_region_ids:
+                        continue
+                    scanned_region_ids.add(each_region["id"])
+                    yield each_region
+
+        region_count = 0
+        for each_region in scan_regions():
+            region_count += 1
+            start_key = binascii.unhexlify(each_region.get("start_key", ""))
+            end_key = binascii.unhexlify(each_region.get("end_key", ""))
+            region = None
+            # region可能横跨多个物理表，找出key范围内所有选中的物理表
+            pos = max(bisect.bisect_right(physical_keys, start_key) - 1, 0)
+            while pos < len(physical_ids):
+                physical_id = physical_ids[pos]
+                pos += 1
+                if end_key != b"" and end_key <= physical_keys[pos - 1]:
+                    break
+                table_info, index_list = segments[physical_id]
+                in_record = is_key_range_overlap(start_key, end_key, encode_record_key(physical_id),
+                                                 encode_table_key(physical_id, b"_s"))
+                in_index_names = []
+                for index_id, index_name in index_list:
+                    if is_key_range_overlap(start_key, end_key, encode_index_key(physical_id, index_id),
+                                            encode_index_key(physical_id, index_id + 1)):
+                        in_index_names.append(index_name)
+                        # 只有统计每个索引的mvcc信息时才需要知道region覆盖的所有索引
+                        if not self.collect_mvcc:
+                            break
+                in_index = len(in_index_names) != 0
+                if not in_record and not in_index:
+                    continue
+                if region is None:
+                    region = self._new_region_from_pd(each_region, store_address_map)
+                    region.start_key = start_key
+                    region.end_key = end_key
+                    region = self._register_region(region)
+                if in_record:
+                    table_info.data_region_map[region.region_id] = region
+                if in_index:
+                    table_info.index_region_map[region.region_id] = region
+                    if self.collect_mvcc:
+                        for index_name in in_index_names:
+                            table_info.index_region_ids.setdefault(index_name, set()).add(region.region_id)
+                table_info.all_region_map[region.region_id] = region
+        log.info("scan pd regions done,scanned region count:%d" % (region_count))
+        for full_tabname, table_info in self._table_region_map.items():
+            log.info("tabname:%s data_region_count:%d,index_region_count:%d,table_region_count:%d" % (
+                full_tabname, len(table_info.data_region_map), len(table_info.index_region_map),
                 len(table_info.all_region_map)))
-            self._table_region_map[dbname + "." + tabname] = table_info
         return self._table_region_map
 
+    # 将dbname中tabname_list的物理表（非分区表或者分区）加入segments，key:physical_id,value:(TableInfo,[(index_id,index_name)])
+    # skipped_ids不为None时记录该数据库中未选中的物理表id
+    def _add_pd_segments4db(self, dbname, tabname_list, segments, skipped_ids=None):
+        tabname_set = set(tabname_list)
+        for tabname, (index_list, physical_list) in self.get_pd_schema4db(dbname).items():
+            if tabname not in tabname_set:
+                if skipped_ids is not None:
+                    skipped_ids.update([physical_id for physical_id, physical_name in physical_list])
+                continue
+            table_info = TableInfo()
+            table_info.dbname = dbname
+            table_info.tabname = tabname
+            for physical_id, physical_name in physical_list:
+                table_info.add_physical_segments(physical_id, physical_name, index_list)
+                table_info.partition_name_list.append(physical_name)
+                table_info.index_name_list.extend([index_name for index_id, index_name in index_list])
+                segments[physical_id] = (table_info, index_list)
+            self._table_region_map[dbname + "." + tabname] = table_info
+        for tabname in tabname_list:
+            if dbname + "." + tabname not in self._table_region_map:
+                log.error("table:%s may not exists!" % (dbname + "." + tabname))
+
+    # 同一个region可能属于多张表（或者同时属于数据和索引），所有表共用同一个Region对象，保证每个region只查询一次property
+    def _register_region(self, region):
+        # 多张表的region信息可能在不同线程中同时获取
+        return self._region_registry.setdefault(region.region_id, region)
+
+    # 根据pd返回的region json数据生成Region
+    def _new_region_from_pd(self, each_region, store_address_map):
+        region = Region()
+        region.region_id = each_region["id"]
+        leader = each_region.get("leader") or {}
+        region.leader_id = leader.get("id", 0)
+        region.leader_store_id = leader.get("store_id", 0)
+        region.leader_store_node_id = intern(str(store_address_map.get(region.leader_store_id, "")))
+        epoch = each_region.get("epoch") or {}
+        region.conf_ver = epoch.get("conf_ver", 0)
+        region.version = epoch.get("version", 0)
+        region.approximate_size = each_region.get("approximate_size", 0)
+        region.approximate_keys = each_region.get("approximate_keys", 0)
+        region.has_pd_stats = True
+        for each_peer in each_region.get("peers") or []:
+            # 避免引入tiflash
+            if each_peer.get("is_learner") or each_peer.get("role") == 1:
+                continue
+            region.peer_store_ids.append(each_peer["store_id"])
+        return region
+
     def get_phy_tables_size(self, dbname, tabname_list, parallel=1):
-        log.debug("TiDBCluster.get_phy_tables_size")
+        return self.get_phy_cluster_tables_size([(dbname, tabname_list)], parallel)
+
+    # 整个集群一次性获取多个数据库中表的大小：先获取所有数据库的region信息，region全局去重后每个region只查询一次property，
+    # sstfile大小也只获取一次，最后再把结果归属到每一张表（索引）上
+    # db_tabname_list:[(dbname,tabname_list)]
+    def get_phy_cluster_tables_size(self, db_tabname_list, parallel=1):
+        log.debug("TiDBCluster.get_phy_cluster_tables_size")
         table_map = {}  # 打印每一张表的大小
-        sstfile_map = {}  # key:sstfile绝对路径,value:sstfile大小
-        table_region_map = self._get_regions4tables(dbname, tabname_list)  # 获取列表的region相关信息
+        table_region_map = self._get_regions4dbs(db_tabname_list)  # 获取列表的region相关信息
+        if self.sample_ratio > 0 or self.sample_count > 0:
+            for tabinfo in table_region_map.values():
+                tabinfo.sample_regions(self.sample_ratio, self.sample_count)
         log.info("<----start get tables size---->")
         log.info("get sstfiles...")
+        tasks = self._region_property_tasks(table_region_map)
+        pressure_monitor = self._start_adaptive(parallel)
+        try:
+            self._collect_region_properties(table_region_map, tasks, parallel)
+            if self.remote_aggregate:
+                self._fill_remote_aggregates(table_region_map)
+            else:
+                self._fill_sstfile_map(table_region_map, parallel)
+        finally:
+            self._stop_adaptive(pressure_monitor)
+        if self.collect_approximate or self.collect_detail:
+            self._fill_region_approximate_stats(table_region_map)
+        # table_region_map中已经有完整的sstfile相关数据
+        for tabinfo in table_region_map.values():
+            tabinfo.estimate_with_cf(self.get_cf_info())
+            dbname = tabinfo.dbname
+            tabname = tabinfo.tabname
+            full_tabname = dbname + "." + tabname
+            log.info("tabname:%s sstfiles_withoutsize_count:%d" % (full_tabname, len(tabinfo.sstfiles_withoutsize_set)))
+            (data_size, data_size_err), (index_size, index_size_err), (
+                table_size, table_size_err) = tabinfo.get_all_sizes_with_err()
+            table_map[full_tabname] = {
+                "dbname": tabinfo.dbname,
+                "tabname": tabinfo.tabname,
+                "is_partition": "False" if tabinfo.is_partition() == False else "True-" + str(
+                    len(tabinfo.partition_name_list)),
+                "index_count": tabinfo.get_index_cnt(),
+                "data_size": data_size,
+                "index_size": index_size,
+                "table_size": table_size,
+                "data_size_err": data_size_err,
+                "index_size_err": index_size_err,
+                "table_size_err": table_size_err,
+            }
+            if self.collect_approximate:
+                (table_map[full_tabname]["approx_data_size"], table_map[full_tabname]["approx_index_size"],
+                 table_map[full_tabname]["approx_table_size"]) = tabinfo.get_approximate_sizes()
+            if self.collect_detail:
+                (table_map[full_tabname]["partition_sizes"], table_map[full_tabname]["index_sizes"],
+                 table_map[full_tabname]["split_segments"]) = tabinfo.get_segment_sizes(
+                    table_map[full_tabname]["table_size"], table_map[full_tabname]["index_size"])
+            if self.collect_mvcc:
+                table_map[full_tabname]["mvcc"] = tabinfo.get_mvcc_stats()
+        log.info("<----end get tables size---->")
+        return table_map
 
-        # 获取region信息,并将结果写入region_queue
-        def put_regions_to_queue(table_region_map, dbname, tabname_list, region_queue, parallel):
-            tabname_list_region_count = 0
+    # 按window张表一批调用get_tables_size(db_tabname_list)（get_phy_cluster_tables_size或get_approximate_cluster_tables_size），
+    # 每批完成后返回该批的table_map并释放该批的region信息，内存占用只和window有关，与表的总数无关
+    # sstfile大小信息（_sstfile_map）只和tikv节点有关，在批次之间保留，全量获取过的节点不会重复获取
+    # pd方式发现region时每批按物理表id的key范围扫描pd，因此先按表id排序，使每批的表在key空间上尽量相邻
+    def iter_cluster_tables_size(self, db_tabname_list, window, get_tables_size):
+        window = max(1, window)
+        if self.region_discovery == "pd":
+            db_tabname_list = [(dbname, self._sort_tablist_byid(dbname, tabname_list)) for dbname, tabname_list in
+                               db_tabname_list]
+        window_tables = []  # [(dbname,tabname)]
+        for dbname, tabname_list in db_tabname_list:
             for tabname in tabname_list:
-                full_tabname = dbname + "." + tabname
-                if full_tabname not in table_region_map:
-                    log.error("table:%s not maybe not exists!" % (full_tabname))
+                window_tables.append((dbname, tabname))
+                if len(window_tables) >= window:
+                    yield self._get_window_tables_size(window_tables, get_tables_size)
+                    window_tables = []
+        if len(window_tables) != 0:
+            yield self._get_window_tables_size(window_tables, get_tables_size)
+
+    # 按物理表id（分区表为最小的分区id）排序tabname_list，不存在的表排在最后
+    def _sort_tablist_byid(self, dbname, tabname_list):
+        if len(tabname_list) <= 1:
+            return tabname_list
+        table_id_map = {}  # key:tabname,value:最小的物理表id
+        for tabname, (index_list, physical_list) in self.get_pd_schema4db(dbname).items():
+            table_id_map[tabname] = min([physical_id for physical_id, physical_name in physical_list])
+        return sorted(tabname_list, key=lambda tabname: (tabname not in table_id_map, table_id_map.get(tabname, 0)))
+
+    def _get_window_tables_size(self, window_tables, get_tables_size):
+        log.info("window tables:%d,first table:%s.%s" % (len(window_tables), window_tables[0][0], window_tables[0][1]))
+        table_map = get_tables_size(group_db_tabname_list(window_tables))
+        self._table_region_map = {}
+        self._region_registry = {}
+        return table_map
+
+    # 按window张表一批获取approximate大小（calibration不为None时先校准），返回approximate大小最大的limit张表，
+    # [(approximate大小,dbname,tabname,table_map中的值)]按大小从大到小排序，以及是否有表因为超过limit被丢弃
+    # cutoff不为None时只考虑(approximate大小,dbname,tabname)小于cutoff的表，内存占用只和window、limit有关
+    def get_top_approximate_tables(self, db_tabname_list, limit, window, calibration=None, cutoff=None):
+        heap = []  # 最小堆，保留最大的limit张表
+        dropped = False
+        for approx_table_map in self.iter_cluster_tables_size(
+                db_tabname_list, window, lambda x: self.get_approximate_cluster_tables_size(x, calibration)):
+            for val in approx_table_map.values():
+                item = (val["table_size"], val["dbname"], val["tabname"], val)
+                if cutoff is not None and item[:3] >= cutoff:
                     continue
-                for region_id in table_region_map[full_tabname].all_region_map.keys():
-                    region_queue.put((dbname, tabname, region_id))
-                    log.debug("put region into region_queue:%s" % (region_id))
-                    tabname_list_region_count += 1
-            for i in range(parallel):
-                # signal close region_queue
-                log.debug("put region into region_queue:None")
-                region_queue.put(None)
-
-        region_thread = threading.Thread(target=put_regions_to_queue,
-                                         args=(table_region_map, dbname, tabname_list, region_queue, parallel))
-        log.info("put_regions_to_queue")
-        region_thread.start()
-        threads = []
-        log.info("region_queue->get_leader_region_sstfiles_muti")
-        for i in range(parallel):
-            t = threading.Thread(target=self.get_leader_region_sstfiles_muti,
-                                 args=(table_region_map, region_queue, i))
-            t.start()
-            threads.append(t)
-        for i in threads: i.join()
-        log.info("region_queue->get_leader_region_sstfiles_muti done")
-        region_thread.join()
-        log.info("put_regions_to_queue done")
-        # 获取sstfile的物理大小信息
-        # 如果当前table_region_map中包含的sst文件数量比较小，则直接下发sst文件名去tikv上查找sst文件的物理大小，如果比较多则直接去tikv获取全部的sst文件信息
-        fetchall_flag = True
+                if len(heap) < limit:
+                    heapq.heappush(heap, item)
+                    continue
+                dropped = True
+                if item[:3] > heap[0][:3]:
+                    heapq.heapreplace(heap, item)
+        return sorted(heap, reverse=True, key=lambda x: x[:3]), dropped
+
+    # 获取最大的top张表的大小：先根据pd的approximate_size给表排序（calibration不为None时先校准），
+    # 再按排序每次对最多top张还可能进入前top的表执行get_tables_size（精确或抽样），直到剩下的表都不可能进入前top
+    # 剩下的表的大小上限=approximate大小*已计算的表中(计算大小/approximate大小)的最大值*(1+top_margin)
+    # approximate大小按window张表一批获取，每轮只保留top*top_candidates张候选表，候选表都计算完仍然不能确定前top时，
+    # 再获取一轮比这些候选表小的表，内存占用与表的总数无关
+    # 返回只包含前top张表的table_map
+    def get_top_cluster_tables_size(self, db_tabname_list, top, get_tables_size, calibration=None, window=100):
+        table_map = {}
+        max_ratio = 0.0  # 已计算的表中计算大小/approximate大小的最大值
+        cutoff = None  # 上一轮候选表中最小的(approximate大小,dbname,tabname)
+        skipped_count = 0
+        while True:
+            ranking, dropped = self.get_top_approximate_tables(db_tabname_list, top * self.top_candidates, window,
+                                                               calibration, cutoff)
+            log.info("top %d tables,candidate tables:%d,more tables:%s" % (top, len(ranking), dropped))
+            pos = 0  # ranking中pos之前的表都已经计算过
+            finished = False
+            while pos < len(ranking):
+                top_sizes = sorted([val["table_size"] for val in table_map.values()], reverse=True)[:top]
+                # 已计算的表中还没有approximate大小不为0的表时无法估算上限，不跳过任何表
+                threshold = top_sizes[-1] if len(top_sizes) >= top and max_ratio > 0 else -1
+                batch = []
+                for approx_size, each_db, each_tab, val in ranking[pos:]:
+                    if approx_size * max_ratio * (1 + self.top_margin) < threshold:
+                        break
+                    batch.append((each_db, each_tab))
+                    if len(batch) >= top:
+                        break
+                if len(batch) == 0:
+                    finished = True
+                    break
+                log.info("top refine tables:%d,ranking position:%d,threshold:%s,max ratio:%.2f" % (
+                    len(batch), pos, format_size(max(threshold, 0)), max_ratio))
+                approx_size_map = dict((item[1] + "." + item[2], item[0]) for item in ranking[pos:pos + len(batch)])
+                pos += len(batch)
+                for full_tabname, val in self._get_window_tables_size(batch, get_tables_size).items():
+                    table_map[full_tabname] = val
+                    approx_size = approx_size_map.get(full_tabname, 0)
+                    if approx_size > 0:
+                        max_ratio = max(max_ratio, float(val["table_size"]) / approx_size)
+                # 只保留前top张表
+                table_map = dict((val["dbname"] + "." + val["tabname"], val) for val in sorted(
+                    table_map.values(), reverse=True, key=lambda x: x["table_size"])[:top])
+            skipped_count += len(ranking) - pos
+            if finished or not dropped or len(ranking) == 0:
+                break
+            cutoff = ranking[-1][:3]
+            log.info("top %d tables,candidates exhausted,get approximate size of tables smaller than %s" % (
+                top, format_size(cutoff[0])))
+        log.info("top %d tables,skipped candidate tables:%d" % (top, skipped_count))
+        return table_map
+
+    # 只根据pd中region的approximate_size估算表大小，不调用tikv-ctl和tiup cluster exec
+    # calibration为get_calibration_from_sqlite3的结果，不为None时用最近一次精确计算的结果校准
+    def get_approximate_cluster_tables_size(self, db_tabname_list, calibration=None):
+        log.debug("TiDBCluster.get_approximate_cluster_tables_size")
+        table_map = {}
+        table_region_map = self._get_regions4dbs(db_tabname_list)
+        self._fill_region_approximate_stats(table_region_map)
+        for full_tabname, tabinfo in table_region_map.items():
+            data_size, index_size, table_size = tabinfo.get_approximate_sizes()
+            if calibration is not None:
+                factors = calibration.get((tabinfo.dbname, tabinfo.tabname), calibration.get(None))
+                if factors is not None:
+                    log.debug("tabname:%s calibration factors:%s" % (full_tabname, factors))
+                    data_size = int(data_size * factors[0])
+                    index_size = int(index_size * factors[1])
+                    table_size = int(table_size * factors[2])
+            table_map[full_tabname] = {
+                "dbname": tabinfo.dbname,
+                "tabname": tabinfo.tabname,
+                "is_partition": "False" if tabinfo.is_partition() == False else "True-" + str(
+                    len(tabinfo.partition_name_list)),
+                "index_count": tabinfo.get_index_cnt(),
+                "data_size": data_size,
+                "index_size": index_size,
+                "table_size": table_size,
+                "data_size_err": 0,
+                "index_size_err": 0,
+                "table_size_err": 0,
+            }
+            if self.collect_detail:
+                (table_map[full_tabname]["partition_sizes"], table_map[full_tabname]["index_sizes"],
+                 table_map[full_tabname]["split_segments"]) = tabinfo.get_segment_sizes(table_size, index_size)
+        return table_map
+
+    # 从pd获取region的approximate_size和approximate_keys（按pd方式获取region信息时已经包含，不需要再获取）
+    # region较少时按region_id逐个获取，否则只按这些region所在表的key范围扫描pd，不扫描整个集群的region
+    # region_ids不为None时只获取其中的region
+    def _fill_region_approximate_stats(self, table_region_map, by_id_max=200, region_ids=None):
+        regions = {}
+        id_table_map = {}  # key:physical_id,value:full_tabname，需要获取统计信息的表的物理表
+        for full_tabname, tabinfo in table_region_map.items():
+            table_regions = [(region_id, region) for region_id, region in tabinfo.all_region_map.items() if
+                             not region.has_pd_stats and (region_ids is None or region_id in region_ids)]
+            if len(table_regions) == 0:
+                continue
+            regions.update(table_regions)
+            for physical_id in tabinfo.physical_ids:
+                id_table_map[physical_id] = full_tabname
+        if len(regions) == 0:
+            return
+        log.info("get region approximate stats from pd,region count:%d" % (len(regions)))
+        if len(regions) > by_id_max and len(id_table_map) != 0:
+            # 同一张表的分区以及id相邻的表合并为一次扫描
+            scan_ranges = get_pd_scan_ranges(sorted(id_table_map.keys()), set(), id_table_map)
+            log.info("scan pd regions for approximate stats,physical tables:%d,scan ranges:%d" % (
+                len(id_table_map), len(scan_ranges)))
+            for first_id, last_id in scan_ranges:
+                for each_region in self.scan_pd_regions(encode_table_key(first_id), encode_table_key(last_id + 1)):
+                    region = regions.get(each_region["id"])
+                    if region is not None:
+                        self._set_region_pd_stats(region, each_region)
+            # 没有物理表id的表的region（或者扫描期间发生了分裂、合并的region）按region_id逐个获取
+            regions = dict((region_id, region) for region_id, region in regions.items() if not region.has_pd_stats)
+            if len(regions) == 0:
+                return
+            if len(regions) > by_id_max:
+                log.warning("cannot get approximate stats from pd,region count:%d" % (len(regions)))
+                return
+        pd_addresses = self._get_pd_addresses()
+        for region_id, region in regions.items():
+            req = "/pd/api/v1/region/id/%d" % (region_id)
+            json_data, err = http_client.get_json(pd_addresses, req)
+            if err is not None or not isinstance(json_data, dict) or "id" not in json_data:
+                log.warning("cannot get region:%d from pd,message:%s" % (region_id, err))
+                continue
+            self._set_region_pd_stats(region, json_data)
+
+    @staticmethod
+    def _set_region_pd_stats(region, each_region):
+        region.approximate_size = each_region.get("approximate_size", 0)
+        region.approximate_keys = each_region.get("approximate_keys", 0)
+        region.start_key = binascii.unhexlify(each_region.get("start_key", ""))
+        region.end_key = binascii.unhexlify(each_region.get("end_key", ""))
+        region.has_pd_stats = True
+
+    # 获取多个数据库中表的region信息，返回dbname+"."+tabname为key，TableInfo为value的字典
+    def _get_regions4dbs(self, db_tabname_list):
+        self._region_registry = {}
+        if self.region_discovery == "pd":
+            return self._get_regions4dbs_bypd(db_tabname_list)
+        table_region_map = {}
+        for dbname, tabname_list in db_tabname_list:
+            table_region_map.update(self._get_regions4tables(dbname, tabname_list))
+        self._table_region_map = table_region_map
+        log.info("total tables:%d,distinct regions:%d" % (len(table_region_map), len(self._region_registry)))
+        return table_region_map
+
+    # 获取sstfile的物理大小并填充到table_region_map的region中
+    def _fill_sstfile_map(self, table_region_map, parallel):
+        sstfile_map = self._get_sstfile_map(table_region_map)
+        # 使用了缓存的region，如果其sstfile在tikv上已经不存在，说明region发生过compaction，需要重新查询property信息
+        stale_tasks = self._get_stale_cached_regions(table_region_map, sstfile_map)
+        if len(stale_tasks) != 0:
+            log.info("region properties cache,compacted region count:%d,query again" % (len(stale_tasks)))
+            self._collect_region_properties(table_region_map, stale_tasks, parallel)
+            stale_table_region_map = {}
+            for full_tabname, region_id in stale_tasks:
+                if full_tabname not in stale_table_region_map:
+                    stale_table_region_map[full_tabname] = TableInfo()
+                stale_table_region_map[full_tabname].all_region_map[region_id] = \
+                    table_region_map[full_tabname].all_region_map[region_id]
+            self._merge_sstfile_map(sstfile_map, self._get_sstfile_map(stale_table_region_map))
+        log.info("total sstfiles count:%d,size in memory:%s" % (
+            sum(len(m) for m in sstfile_map.values()),
+            format_size(sum(sys.getsizeof(m) for m in sstfile_map.values()))))
+        log.info("get sstfiles,done.")
+        self._fill_sstfile_sizes(table_region_map, sstfile_map)
+
+    # 获取table_region_map中sstfile的物理大小信息，返回key:node_id,value:{sst_no:sstfile大小}的字典
+    def _get_sstfile_map(self, table_region_map):
+        # 每个节点根据需要的sst文件数和节点上的sst文件总数选择直接下发sst文件名去tikv上查找sst文件的物理大小，还是直接去tikv获取全部的sst文件信息
 
         # region_max:当所有表的region数大于此值后直接根据 region获取sstfile大小
         # sstfile_max: 当所有表的涉及到的sstfile数大于此值后直接根据region获取sstfile大小
@@ -554,174 +2825,667 @@ class TiDBCluster:
             try:
                 for k in table_region_map:
                     for region_id in table_region_map[k].all_region_map:
+                        # 没有sstfile的region（比如抽样模式下未抽中的region）不需要获取sstfile大小
+                        region_sstfiles_cnt = len(table_region_map[k].all_region_map[region_id].sst_nos)
+                        if region_sstfiles_cnt == 0:
+                            continue
                         if temp_region_cnt > region_max:
                             return True
                         temp_region_cnt += 1
-                        for each_sstfile in table_region_map[k].all_region_map[region_id].sstfile_list:
-                            if temp_sstfiles_cnt > sstfile_max:
-                                return True
-                            temp_sstfiles_cnt += 1
+                        temp_sstfiles_cnt += region_sstfiles_cnt
+                        if temp_sstfiles_cnt > sstfile_max:
+                            return True
             except Exception as e:
                 log.error("useFetchall method error:%s" % (e))
             return False
 
-        fetchall_flag = useFetchall(table_region_map, 200, 5000)
-        if fetchall_flag:
-            sstfile_list = self.get_store_sstfiles_bystoreall()
-        # 如果不一次性全部获取则需要去各个节点获取sstfile的大小信息
-        else:
-            sstfile_list = self.get_store_sstfiles_bysstfilelist(
-                [each_sstfile for k in table_region_map for region_id in table_region_map[k].all_region_map for
-                 each_sstfile in table_region_map[k].all_region_map[region_id].sstfile_list])
-
-        for sstfile in sstfile_list:
-            sstfile_map[(sstfile.sst_node_id, sstfile.sst_name)] = sstfile.sst_size
-        log.info(
-            "total sstfiles count:%d,size in memory:%s" % (len(sstfile_map), format_size(sys.getsizeof(sstfile_map))))
-        log.info("get sstfiles,done.")
-        # 在sstfile_map中查查找table_region_map中的sstfile文件并填充数据
+        if self._get_store_sstfiles_bystoreall_once is True:
+            return self._sstfile_map
+        # 来自region property缓存的sstfile需要确认仍然存在，因此不使用sstfile大小缓存
+        sstfiles_node_map = self._get_sstfiles_node_map(
+            [region for k in table_region_map for region in table_region_map[k].all_region_map.values() if
+             not region.props_from_cache])
+        cached_sstfiles_node_map = self._get_sstfiles_node_map(
+            [region for k in table_region_map for region in table_region_map[k].all_region_map.values() if
+             region.props_from_cache])
+        needed_count_map = {}  # key:node_id,value:该节点上需要获取大小的sstfile数
+        for each_node_map in (sstfiles_node_map, cached_sstfiles_node_map):
+            for node_id, sst_nos in each_node_map.items():
+                needed_count_map[node_id] = needed_count_map.get(node_id, 0) + len(sst_nos)
+        full_node_ids = self._plan_sstfile_fetch(needed_count_map,
+                                                 lambda: useFetchall(table_region_map, 200, 5000))
+        tikv_node_ids = set([node.id for node in self.tidb_nodes if node.role == "tikv"])
+        if len(full_node_ids) != 0 and full_node_ids >= tikv_node_ids:
+            return self.get_store_sstfiles_bystoreall()
+        # 全量获取的节点获取所有sstfile的大小（本次已经全量获取过的节点直接使用），其余节点只stat需要的sstfile
+        sstfile_map = dict((node_id, self._sstfile_map[node_id]) for node_id in full_node_ids if
+                           node_id in self._sstfile_map)
+        sstfile_map.update(self._get_node_all_sstfiles_map(
+            [node for node in self.tidb_nodes if node.id in full_node_ids and node.id not in sstfile_map]))
+        sstfile_map = self.get_store_sstfiles_bysstfilelist(
+            dict((node_id, sst_nos) for node_id, sst_nos in sstfiles_node_map.items() if node_id not in full_node_ids),
+            sstfile_map=sstfile_map)
+        return self.get_store_sstfiles_bysstfilelist(
+            dict((node_id, sst_nos) for node_id, sst_nos in cached_sstfiles_node_map.items() if
+                 node_id not in full_node_ids), use_cache=False, sstfile_map=sstfile_map)
+
+    # 按节点选择获取sstfile大小的方式，返回需要全量获取的node_id集合，本次已经全量获取过的节点直接使用已有结果
+    # 定点stat的代价约为needed*stat_file_cost，全量获取的代价约为total*scan_file_cost，total为该节点上的sstfile总数，
+    # 来自sstfile大小缓存（即上次执行的结果）
+    # total未知（比如首次执行且没有缓存）的节点按照useFetchall的结果决定，use_fetchall只在需要时才计算
+    def _plan_sstfile_fetch(self, needed_count_map, use_fetchall):
+        full_node_ids = set()
+        fetchall_flag = None
+        for node_id, needed in needed_count_map.items():
+            if node_id in self._sstfile_map:
+                full_node_ids.add(node_id)
+                continue
+            total = self._get_node_sstfile_count(node_id)
+            if total is None:
+                if fetchall_flag is None:
+                    fetchall_flag = use_fetchall()
+                use_full = fetchall_flag
+            else:
+                use_full = total * self.scan_file_cost < needed * self.stat_file_cost
+            log.info("node_id:%s,needed sstfiles:%d,total sstfiles:%s,plan:%s" % (
+                node_id, needed, "unknown" if total is None else total, "full" if use_full else "targeted"))
+            if use_full:
+                full_node_ids.add(node_id)
+        return full_node_ids
+
+    # 返回节点上的sstfile总数，未知时返回None
+    def _get_node_sstfile_count(self, node_id):
+        if self.sst_size_cache is not None:
+            return self.sst_size_cache.get_node_count(node_id)
+        return None
+
+    # 返回regions中sstfile按照所在节点的分组，key:node_id,value:set(sst_no)
+    @staticmethod
+    def _get_sstfiles_node_map(regions):
+        sstfiles_node_map = {}
+        for region in regions:
+            if len(region.sst_nos) == 0:
+                continue
+            if region.props_node_id in sstfiles_node_map:
+                sstfiles_node_map[region.props_node_id].update(region.sst_nos)
+            else:
+                sstfiles_node_map[region.props_node_id] = set(region.sst_nos)
+        return sstfiles_node_map
+
+    # 合并两个{node_id:{sst_no:size}}字典，结果写入dst_map
+    @staticmethod
+    def _merge_sstfile_map(dst_map, src_map):
+        for node_id, sstfile_size_map in src_map.items():
+            if node_id not in dst_map:
+                dst_map[node_id] = sstfile_size_map
+            elif dst_map[node_id] is not sstfile_size_map:
+                dst_map[node_id].update(sstfile_size_map)
+        return dst_map
+
+    # 返回使用了缓存且sstfile已经不存在的region列表[(full_tabname,region_id)]，同时清理这些region的缓存
+    def _get_stale_cached_regions(self, table_region_map, sstfile_map):
+        stale_tasks = []
+        region_id_set = set()
+        for k in table_region_map:
+            for region_id, region in table_region_map[k].all_region_map.items():
+                if not region.props_from_cache or region_id in region_id_set:
+                    continue
+                region_id_set.add(region_id)
+                sstfile_size_map = sstfile_map.get(region.props_node_id, {})
+                for sst_no in region.sst_nos:
+                    if sst_no not in sstfile_size_map:
+                        stale_tasks.append((k, region_id))
+                        self.region_properties_cache.remove(region_id)
+                        break
+        return stale_tasks
+
+    # 在sstfile_map中查查找table_region_map中的sstfile文件并填充数据
+    def _fill_sstfile_sizes(self, table_region_map, sstfile_map):
         # k为full表名
         for k in table_region_map:
             for region_id in table_region_map[k].all_region_map:
-                i = 0
-                for each_sstfile in table_region_map[k].all_region_map[region_id].sstfile_list:
-                    key = (each_sstfile.sst_node_id, each_sstfile.sst_name)
-                    region = table_region_map[k].all_region_map[region_id]
-                    if key not in sstfile_map:
-                        # table_region_map[k].sstfiles_withoutsize_cnt += 1
-                        table_region_map[k].sstfiles_withoutsize_map[
-                            (each_sstfile.sst_node_id, each_sstfile.sst_name)] = each_sstfile
-                        log.debug("table:%s,region:%d,node_id:%s,sstfilename:%s cannot find in sstfile_map" % (
-                            k, region_id, region.leader_store_node_id, each_sstfile.sst_name))
+                region = table_region_map[k].all_region_map[region_id]
+                sstfile_size_map = sstfile_map.get(region.props_node_id, {})
+                for i, sst_no in enumerate(region.sst_nos):
+                    sst_size = sstfile_size_map.get(sst_no)
+                    if sst_size is None:
+                        table_region_map[k].sstfiles_withoutsize_set.add((region.props_node_id, sst_no))
+                        log.debug("table:%s,region:%d,node_id:%s,sst_no:%d cannot find in sstfile_map" % (
+                            k, region_id, region.props_node_id, sst_no))
                     else:
-                        table_region_map[k].all_region_map[region_id].sstfile_list[i].sst_size = sstfile_map[key]
-                    i += 1
-        # table_region_map中已经有完整的sstfile相关数据
-        for tabinfo in table_region_map.values():
-            tabinfo.estimate_with_cf(self.get_cf_info())
-            dbname = tabinfo.dbname
-            tabname = tabinfo.tabname
-            full_tabname = dbname + "." + tabname
-            log.info("tabname:%s sstfiles_withoutsize_count:%d" % (full_tabname, len(tabinfo.sstfiles_withoutsize_map)))
-            table_map[full_tabname] = {
-                "dbname": tabinfo.dbname,
-                "tabname": tabinfo.tabname,
-                "is_partition": "False" if tabinfo.is_partition() == False else "True-" + str(
-                    len(tabinfo.partition_name_list)),
-                "index_count": tabinfo.get_index_cnt(),
-                "data_size": tabinfo.get_all_data_size(),
-                "index_size": tabinfo.get_all_index_size(),
-                "table_size": tabinfo.get_all_table_size(),
-            }
-        log.info("<----end get tables size---->")
-        return table_map
+                        region.sst_sizes[i] = sst_size
+
+    # 远程聚合：把每张表（数据、索引、整张表）需要的sstfile清单和汇总脚本上传到每个tikv节点，在节点上stat并按组汇总，
+    # 只返回每组的汇总结果，传输和解析的开销与表的数量相关而与sstfile数量无关
+    def _fill_remote_aggregates(self, table_region_map):
+        group_list = []  # 下标为组号，内容为(full_tabname,kind)
+        node_group_sstfiles = {}  # key:node_id,value:{组号:set(sst_no)}
+        for full_tabname, tabinfo in table_region_map.items():
+            tabinfo.aggregated_sizes = {}
+            for kind, region_map in (("data", tabinfo.data_region_map), ("index", tabinfo.index_region_map),
+                                     ("table", tabinfo.all_region_map)):
+                tabinfo.aggregated_sizes[kind] = [0, 0, 0]
+                group_id = len(group_list)
+                group_list.append((full_tabname, kind))
+                for region in region_map.values():
+                    if len(region.sst_nos) == 0:
+                        continue
+                    node_group_sstfiles.setdefault(region.props_node_id, {}).setdefault(group_id, set()).update(
+                        region.sst_nos)
+        nodes = []
+        for node_id in node_group_sstfiles:
+            node = self._get_tikv_node(node_id)
+            if node is None:
+                log.error("cannot find node_id:%s sstfile's data dir" % (node_id))
+                continue
+            nodes.append(node)
+        log.info("remote aggregate,groups:%d,nodes:%d" % (len(group_list), len(nodes)))
+        result_map = self._run_on_tikv_nodes(nodes, lambda node: self._aggregate_node_sstfiles(
+            node, node_group_sstfiles[node.id]))
+        for node_id, group_sstfiles in node_group_sstfiles.items():
+            if node_id in result_map:
+                group_results = result_map[node_id]
+            else:
+                # 节点获取失败，该节点上的sstfile全部视为不存在
+                group_results = dict((group_id, (0, 0, len(sst_nos))) for group_id, sst_nos in group_sstfiles.items())
+            for group_id, (withsize_total, withsize_cnt, withoutsize_cnt) in group_results.items():
+                full_tabname, kind = group_list[group_id]
+                aggregated = table_region_map[full_tabname].aggregated_sizes[kind]
+                aggregated[0] += withsize_total
+                aggregated[1] += withsize_cnt
+                aggregated[2] += withoutsize_cnt
+
+    # 在tikv节点上执行汇总脚本，group_sstfiles:{组号:set(sst_no)}，返回{组号:(已获取大小的sstfile总大小,已获取大小的sstfile数,不存在的sstfile数)}
+    def _aggregate_node_sstfiles(self, node, group_sstfiles):
+        local_files = []
+        remote_files = []
+        try:
+            for content, suffix in ((REMOTE_AGGREGATE_SCRIPT, ".sh"), ("".join(
+                    "%d %06d.sst\n" % (group_id, sst_no) for group_id, sst_nos in group_sstfiles.items() for sst_no in
+                    sst_nos), ".list")):
+                local_file = tempfile.NamedTemporaryFile(mode="w", prefix="tidb_table_size_agg_", suffix=suffix,
+                                                         delete=False)
+                local_files.append(local_file.name)
+                local_file.write(content)
+                local_file.close()
+                remote_file = "/tmp/%s" % (os.path.basename(local_file.name))
+                cmd = "tiup cluster push %s %s %s -N %s" % (self.cluster_name, local_file.name, remote_file, node.host)
+                log.debug(cmd)
+                result, recode = command_run(cmd, timeout=600)
+                if recode != 0:
+                    raise Exception("push remote aggregate file error,cmd:%s,message:%s" % (cmd, result))
+                remote_files.append(remote_file)
+            cmd = '''tiup cluster exec %s --command='sh %s %s/db %s;rm -f %s' -N %s''' % (
+                self.cluster_name, remote_files[0], node.data_dir, remote_files[1], " ".join(remote_files), node.host)
+            log.debug(cmd)
+            group_results = {}
+
+            def handler(each_line):
+                each_line_fields = each_line.split()
+                if len(each_line_fields) == 5 and each_line_fields[0] == "AGG":
+                    group_id, withsize_total, withsize_cnt, withoutsize_cnt = [int(x) for x in each_line_fields[1:]]
+                    group_results[group_id] = (withsize_total, withsize_cnt, withoutsize_cnt)
+
+            result, recode = command_stream(cmd, handler, timeout=600)
+            if recode != 0:
+                raise Exception("remote aggregate error,cmd:%s,message:%s" % (cmd, result))
+            return group_results
+        finally:
+            for local_file in local_files:
+                os.remove(local_file)
 
     def get_all_stores(self):
         if len(self._stores) != 0:
             return self._stores
-        req = ""
         stores = []
-        for node in self.tidb_nodes:
-            if node.role == "pd":
-                req = "http://%s:%s/pd/api/v1/stores" % (node.host, node.service_port)
-                break
-        if req == "":
-            log.error("cannot find stores,%s" % (req))
+        pd_addresses = self._get_pd_addresses()
+        if len(pd_addresses) == 0:
+            log.error("cannot find stores,no pd node")
             return stores
-        rep = request.urlopen(req)
-        if rep.getcode() != 200:
-            raise Exception(req)
-        json_data = json.loads(rep.read())
+        json_data, err = http_client.get_json(pd_addresses, "/pd/api/v1/stores")
+        if err is not None:
+            raise Exception(err)
         for each_store in json_data["stores"]:
             store = Store()
             store.id = each_store["store"]["id"]
             store.address = each_store["store"]["address"]
+            for each_label in each_store["store"].get("labels") or []:
+                if each_label.get("key") == "engine" and each_label.get("value") == "tiflash":
+                    store.is_tiflash = True
             stores.append(store)
         self._stores = stores
         return self._stores
 
-    # 根据sstfile文件名去tikv上获取文件大小
-    # 入参：[SSTFile]
-    def get_store_sstfiles_bysstfilelist(self, sstfiles):
-        log.info("tikv-property method:get_store_sstfiles_bysstfilelist,sstfiles count:%d" % (len(sstfiles)))
-        if len(self._sstfiles_list) != 0 and self._get_store_sstfiles_bystoreall_once is True:
-            return self._sstfiles_list
-        sstfiles_node_map = {}  # key:node_id,value:sstfile_list
-        result_sstfiles = []
-        for each_sstfile in sstfiles:
-            if each_sstfile.sst_node_id in sstfiles_node_map:
-                sstfiles_node_map[each_sstfile.sst_node_id].append(each_sstfile)
+    def _get_tikv_node(self, node_id):
+        for node in self.tidb_nodes:
+            if node.id == node_id and node.role == "tikv":
+                return node
+        return None
+
+    # adaptive模式下为region-properties查询和sstfile的stat各创建一个并发闸门，parallel、host_parallel*stat_chunk_parallel为上限
+    # 配置了max_grpc_p99并且集群中有prometheus时，启动后台线程检查tikv的grpc延迟，返回TiKVPressureMonitor或None
+    def _start_adaptive(self, parallel):
+        if not self.adaptive:
+            return None
+        properties_limit = AdaptiveLimit("region-properties", parallel)
+        stat_limit = AdaptiveLimit("stat", max(1, self.host_parallel) * max(1, self.stat_chunk_parallel))
+        self._properties_gate = ConcurrencyGate(properties_limit)
+        self._stat_gate = ConcurrencyGate(stat_limit)
+        if self.max_grpc_p99 <= 0:
+            return None
+        prometheus_node_id = ""
+        for nd in self.tidb_nodes:
+            if nd.role == "prometheus":
+                prometheus_node_id = nd.id
+                break
+        if prometheus_node_id == "":
+            log.warning("cannot find prometheus node,tikv grpc p99 will not be checked")
+            return None
+        pressure_monitor = TiKVPressureMonitor(prometheus_node_id, self.max_grpc_p99, [properties_limit, stat_limit])
+        pressure_monitor.start()
+        return pressure_monitor
+
+    def _stop_adaptive(self, pressure_monitor):
+        if pressure_monitor is not None:
+            pressure_monitor.stop()
+        for gate in (self._properties_gate, self._stat_gate):
+            if gate is not None:
+                log.info("adaptive limit %s:%d,baseline:%.3fs" % (
+                    gate.adaptive_limit.name, gate.adaptive_limit.current(), gate.adaptive_limit.baseline or 0))
+        self._properties_gate = None
+        self._stat_gate = None
+
+    # 流式执行tiup cluster exec，输出中的每个sstfile调用on_sstfile(sst_no,size)，不保留完整的输出
+    def _exec_node_sstfiles(self, cmd, on_sstfile, errmsg):
+        log.debug(cmd)
+        result, recode = command_stream(cmd, exec_sstfile_line_handler(on_sstfile), timeout=600)
+        if recode != 0:
+            raise Exception("%s,cmd:%s,message:%s" % (errmsg, cmd, result))
+
+    # 在tikv节点上获取指定sstfile的物理大小，结果直接写入sstfile_size_map:{sst_no:size}，不存在的sstfile不写入
+    # sstfile按照stat_chunk_size分批，每个节点最多stat_chunk_parallel个批次并发执行，避免命令行过长以及单个超长的串行stat
+    def _stat_node_sstfiles(self, node, sst_nos, sstfile_size_map=None):
+        if sstfile_size_map is None:
+            sstfile_size_map = {}
+        if len(sst_nos) == 0:
+            return sstfile_size_map
+        sst_nos = list(sst_nos)
+        chunk_size = max(1, self.stat_chunk_size)
+        chunks = [sst_nos[i:i + chunk_size] for i in range(0, len(sst_nos), chunk_size)]
+        for chunk, e in run_in_threads(chunks, lambda chunk: self._stat_node_sstfiles_chunk(
+                node, chunk, sstfile_size_map), self.stat_chunk_parallel):
+            if e is not None:
+                raise e
+        return sstfile_size_map
+
+    # 文件较少时直接把文件名放在命令行中，否则先通过tiup cluster push上传文件名清单，再在tikv节点上xargs stat
+    # 不存在的sstfile（已经被compaction删除）stat会报错，忽略错误输出
+    def _stat_node_sstfiles_chunk(self, node, sst_nos, sstfile_size_map):
+        if self._stat_gate is None:
+            return self._stat_node_sstfiles_chunk_once(node, sst_nos, sstfile_size_map)
+        start_time = self._stat_gate.acquire()
+        ok = False
+        try:
+            self._stat_node_sstfiles_chunk_once(node, sst_nos, sstfile_size_map)
+            ok = True
+        finally:
+            self._stat_gate.release(start_time, ok)
+
+    def _stat_node_sstfiles_chunk_once(self, node, sst_nos, sstfile_size_map):
+        sstfile_path = os.path.join(node.data_dir, "db")
+        sst_names = ["%06d.sst" % (sst_no) for sst_no in sst_nos]
+        if len(sst_names) <= self.stat_inline_max:
+            cmd = '''tiup cluster exec %s --command='cd %s;stat -c "%s" %s 2>/dev/null;true' -N %s ''' % (
+                self.cluster_name, sstfile_path, "%n:%s", " ".join(sst_names), node.host)
+            self._exec_node_sstfiles(cmd, sstfile_size_map.__setitem__, "get sst file info error")
+            return
+        manifest = tempfile.NamedTemporaryFile(mode="w", prefix="tidb_table_size_", suffix=".list", delete=False)
+        try:
+            manifest.write("\n".join(sst_names) + "\n")
+            manifest.close()
+            remote_manifest = "/tmp/%s" % (os.path.basename(manifest.name))
+            cmd = "tiup cluster push %s %s %s -N %s" % (self.cluster_name, manifest.name, remote_manifest, node.host)
+            log.debug(cmd)
+            result, recode = command_run(cmd, timeout=600)
+            if recode != 0:
+                raise Exception("push sst file manifest error,cmd:%s,message:%s" % (cmd, result))
+            cmd = '''tiup cluster exec %s --command='cd %s;xargs stat -c "%s" < %s 2>/dev/null;rm -f %s' -N %s ''' % (
+                self.cluster_name, sstfile_path, "%n:%s", remote_manifest, remote_manifest, node.host)
+            self._exec_node_sstfiles(cmd, sstfile_size_map.__setitem__, "get sst file info error")
+        finally:
+            os.remove(manifest.name)
+
+    # 在tikv节点上获取所有sstfile的物理大小，结果直接写入sstfile_size_map:{sst_no:size}
+    def _stat_node_all_sstfiles(self, node, sstfile_size_map=None):
+        if sstfile_size_map is None:
+            sstfile_size_map = {}
+        cmd = r'''tiup cluster exec %s --command='find %s/db/*.sst |xargs stat -c "%s"|grep -Po "\d+\.sst:\d+"' -N %s''' % (
+            self.cluster_name, node.data_dir, "%n:%s", node.host)
+        self._exec_node_sstfiles(cmd, sstfile_size_map.__setitem__, "get sst file info error")
+        return sstfile_size_map
+
+    # 在tikv节点上只列出所有sstfile的文件号（不stat），每个sstfile调用on_sstfile(sst_no,None)
+    def _list_node_sstfiles(self, node, on_sstfile):
+        cmd = r'''tiup cluster exec %s --command='ls %s/db |grep -Po "^\d+\.sst$"' -N %s''' % (
+            self.cluster_name, node.data_dir, node.host)
+        self._exec_node_sstfiles(cmd, on_sstfile, "list sst file error")
+
+    # 借助sstfile大小缓存获取tikv节点上所有sstfile的大小：只stat缓存中不存在的sstfile，并删除缓存中已经不存在的sstfile
+    def _stat_node_all_sstfiles_withcache(self, node):
+        cached_size_map = self.sst_size_cache.get_node_sizes(node.id)  # key:sst_no,value:size
+        sstfile_size_map = {}
+        uncached_sst_nos = []
+
+        def on_sstfile(sst_no, sst_size):
+            cached_size = cached_size_map.pop(sst_no, None)
+            if cached_size is not None:
+                sstfile_size_map[sst_no] = cached_size
             else:
-                sstfiles_node_map[each_sstfile.sst_node_id] = [each_sstfile]
-        for each_node_id, sstfiles in sstfiles_node_map.items():
-            data_dir = ""
-            host = ""
-            for node in self.tidb_nodes:
-                if each_node_id == node.id:
-                    data_dir = node.data_dir
-                    host = node.host
-            if data_dir == "":
+                uncached_sst_nos.append(sst_no)
+
+        self._list_node_sstfiles(node, on_sstfile)
+        # 列表中没有出现的缓存即为已经删除的sstfile
+        deleted_sst_nos = list(cached_size_map)
+        cached_size_map = None
+        sst_count = len(sstfile_size_map) + len(uncached_sst_nos)
+        log.info("node_id:%s,sstfiles count:%d,cached:%d,need stat:%d,deleted from cache:%d" % (
+            node.id, sst_count, len(sstfile_size_map), len(uncached_sst_nos), len(deleted_sst_nos)))
+        if len(uncached_sst_nos) * 2 > sst_count:
+            # 缓存命中率较低（比如首次执行）时，直接全量stat效率更高
+            stat_size_map = self._stat_node_all_sstfiles(node)
+            sstfile_size_map = stat_size_map
+        else:
+            stat_size_map = self._stat_node_sstfiles(node, uncached_sst_nos)
+            sstfile_size_map.update(stat_size_map)
+        self.sst_size_cache.put(node.id, stat_size_map)
+        self.sst_size_cache.remove(node.id, deleted_sst_nos)
+        self.sst_size_cache.put_node_count(node.id, len(sstfile_size_map))
+        return sstfile_size_map
+
+    # 根据sstfile文件名去tikv上获取文件大小
+    # 入参：key:node_id,value:set(sst_no)的字典，返回key:node_id,value:{sst_no:size}的字典，结果写入sstfile_map（为None时新建）
+    # use_cache=False时不从sstfile大小缓存中获取，用于确认sstfile是否仍然存在
+    def get_store_sstfiles_bysstfilelist(self, sstfiles_node_map, use_cache=True, sstfile_map=None):
+        log.info("tikv-property method:get_store_sstfiles_bysstfilelist,sstfiles count:%d" % (
+            sum(len(sst_nos) for sst_nos in sstfiles_node_map.values())))
+        if self._get_store_sstfiles_bystoreall_once is True:
+            return self._sstfile_map
+        if sstfile_map is None:
+            sstfile_map = {}
+        nodes = []
+        for each_node_id in sstfiles_node_map:
+            node = self._get_tikv_node(each_node_id)
+            if node is None:
                 log.error("cannot find node_id:%s sstfile's data dir" % (each_node_id))
                 continue
-            sstfile_path = os.path.join(data_dir, "db")
-            cmd = '''tiup cluster exec %s --command='cd %s;for ssf in %s ;do stat -c "%s" $ssf ;done' -N %s ''' % (
-                self.cluster_name, sstfile_path, " ".join([sstf.sst_name for sstf in sstfiles]), "%n:%s", host)
-            result, recode = command_run(cmd, use_temp=True, timeout=600)
-            log.debug(cmd)
-            if recode != 0:
-                raise Exception("get sst file info error,cmd:%s,message:%s" % (cmd, result))
-            inline = False
-            for each_line in result.splitlines():
-                if each_line.startswith("stdout:"):
-                    inline = True
-                    continue
-                if inline:
-                    each_line_fields = each_line.split(":")
-                    each_line_fields_len = len(each_line_fields)
-                    if each_line_fields_len != 2 or each_line.find(".sst:") == -1: continue
-                    sstfile = SSTFile()
-                    sstfile.sst_name = each_line_fields[0]
-                    sstfile.sst_size = int(each_line_fields[1])
-                    sstfile.sst_node_id = each_node_id
-                    result_sstfiles.append(sstfile)
-        return result_sstfiles
-
-    # 获取所有tikv的sstfiles列表
+            nodes.append(node)
+
+        def get_node_sstfiles(node):
+            sst_nos = sstfiles_node_map[node.id]
+            sstfile_size_map = {}
+            uncached_sst_nos = list(sst_nos)
+            if self.sst_size_cache is not None and use_cache:
+                sstfile_size_map = self.sst_size_cache.lookup(node.id, sst_nos)
+                uncached_sst_nos = [sst_no for sst_no in sst_nos if sst_no not in sstfile_size_map]
+                log.info("node_id:%s,sstfiles count:%d,cached:%d,need stat:%d" % (
+                    node.id, len(sst_nos), len(sstfile_size_map), len(uncached_sst_nos)))
+            stat_size_map = self._stat_node_sstfiles(node, uncached_sst_nos)
+            if self.sst_size_cache is not None:
+                self.sst_size_cache.put(node.id, stat_size_map)
+            sstfile_size_map.update(stat_size_map)
+            return sstfile_size_map
+
+        return self._merge_sstfile_map(sstfile_map, self._run_on_tikv_nodes(nodes, get_node_sstfiles))
+
+    # 获取所有tikv的sstfile大小，返回key:node_id,value:{sst_no:size}的字典
     def get_store_sstfiles_bystoreall(self):
         log.info("tikv-property method:get_store_sstfiles_bystoreall")
-        if len(self._sstfiles_list) != 0 and self._get_store_sstfiles_bystoreall_once is True:
-            return self._sstfiles_list
-        result_sstfiles = []
-        for node in self.tidb_nodes:
-            if node.role != "tikv": continue
-            cmd = '''tiup cluster exec %s --command='find %s/db/*.sst |xargs stat -c "%s"|grep -Po "\d+\.sst:\d+"' -N %s''' % (
-                self.cluster_name, node.data_dir, "%n:%s", node.host)
-            result, recode = command_run(cmd, use_temp=True, timeout=600)
-            log.debug(cmd)
-            if recode != 0:
-                raise Exception("get sst file info error,cmd:%s,message:%s" % (cmd, result))
-            inline = False
-            for each_line in result.splitlines():
-                if each_line.startswith("stdout:"):
-                    inline = True
+        if self._get_store_sstfiles_bystoreall_once is True:
+            return self._sstfile_map
+        nodes = [node for node in self.tidb_nodes if node.role == "tikv"]
+        # 本次已经全量获取过的节点直接使用已有结果，只获取其余节点
+        sstfile_map = dict((node.id, self._sstfile_map[node.id]) for node in nodes if node.id in self._sstfile_map)
+        sstfile_map.update(self._get_node_all_sstfiles_map(
+            [node for node in nodes if node.id not in sstfile_map]))
+        # 有节点失败时不记录为已全量获取，下次调用时重新获取
+        self._get_store_sstfiles_bystoreall_once = len(sstfile_map) == len(nodes)
+        return sstfile_map
+
+    # 并发获取nodes上所有sstfile的大小，返回key:node_id,value:{sst_no:size}的字典，同时记录到_sstfile_map中
+    def _get_node_all_sstfiles_map(self, nodes):
+        if len(nodes) == 0:
+            return {}
+        if self.sst_size_cache is not None:
+            sstfile_map = self._run_on_tikv_nodes(nodes, self._stat_node_all_sstfiles_withcache)
+        else:
+            sstfile_map = self._run_on_tikv_nodes(nodes, self._stat_node_all_sstfiles)
+        self._sstfile_map.update(sstfile_map)
+        return sstfile_map
+
+    # 在多个tikv节点上并发执行func(node)，最多host_parallel个节点同时执行，总耗时接近最慢的节点而不是所有节点之和
+    # 单个节点失败只记录错误，该节点的sstfile视为缺失（计入sstfiles_withoutsize），不影响其他节点
+    # 返回key:node_id,value:func(node)返回值的字典，失败的节点不在结果中
+    def _run_on_tikv_nodes(self, nodes, func):
+        result_map = {}
+
+        def get_node_result(node):
+            start_time = time.time()
+            result_map[intern(str(node.id))] = func(node)
+            log.info("node_id:%s,get sstfiles done,elapsed:%.2fs" % (node.id, time.time() - start_time))
+
+        for node, e in run_in_threads(nodes, get_node_result, self.host_parallel):
+            if e is not None:
+                log.error("node_id:%s,get sstfiles error,sstfiles on this node will be missing,message:%s" % (
+                    node.id, e))
+        return result_map
+
+    def _use_async_engine(self):
+        if self.properties_engine == "thread":
+            return False
+        if aio_properties is None:
+            if self.properties_engine == "asyncio":
+                log.warning("asyncio region-properties engine is not available,use thread engine instead")
+            return False
+        # python3.8以下asyncio子进程依赖主线程的child watcher，auto时使用线程引擎
+        if sys.version_info < (3, 8) and (
+                self.properties_engine == "auto" or threading.current_thread() is not threading.main_thread()):
+            if self.properties_engine == "asyncio":
+                log.warning("asyncio region-properties engine need python3.8+ outside the main thread,"
+                            "use thread engine instead")
+            return False
+        return True
+
+    # 返回需要查询property信息的region列表[(full_tabname,region_id)]
+    # 如果开启了region property缓存，则region epoch未变化的region直接使用缓存结果，不需要再次查询
+    def _region_property_tasks(self, table_region_map):
+        tasks = []
+        region_id_set = set()  # region去重，多张表共用的region只查询一次
+        cache_hit_count = 0
+        store_address_map = {}  # key:store_id,value:address
+        # 远程聚合模式只返回每张表的汇总结果，无法确认缓存中的sstfile是否仍然存在，因此不使用缓存（查询结果仍然写入缓存）
+        use_cache = self.region_properties_cache is not None and not self.remote_aggregate
+        if use_cache:
+            for store in self.get_all_stores():
+                store_address_map[store.id] = store.address
+        candidates = []  # [(full_tabname,region_id,缓存结果)]，缓存中epoch和副本都有效的region
+        for full_tabname, table_info in table_region_map.items():
+            for region_id, region in table_info.get_property_region_map().items():
+                if region_id in region_id_set:
                     continue
-                if inline:
-                    each_line_fields = each_line.split(":")
-                    each_line_fields_len = len(each_line_fields)
-                    if each_line_fields_len != 2 or each_line.find(".sst:") == -1: continue
-                    sstfile = SSTFile()
-                    sstfile.sst_name = each_line_fields[0]
-                    sstfile.sst_size = int(each_line_fields[1])
-                    sstfile.sst_node_id = node.id
-                    result_sstfiles.append(sstfile)
-        self._sstfiles_list = result_sstfiles
-        self._get_store_sstfiles_bystoreall_once = True
-        return result_sstfiles
+                region_id_set.add(region_id)
+                cached = None
+                if use_cache:
+                    peer_addresses = set([store_address_map.get(store_id, "") for store_id in region.peer_store_ids])
+                    peer_addresses.add(region.leader_store_node_id)
+                    cached = self.region_properties_cache.lookup(region, peer_addresses)
+                if cached is None:
+                    tasks.append((full_tabname, region_id))
+                else:
+                    candidates.append((full_tabname, region_id, cached))
+        if use_cache:
+            # 用于判断region在上次查询之后是否有flush、ingest写入的数据，查询的结果写入缓存时也需要记录统计信息
+            # 只获取需要查询property的region（抽样模式下为抽样的region），按所在表的key范围扫描pd或者按region_id获取
+            self._fill_region_approximate_stats(table_region_map, region_ids=region_id_set)
+        for full_tabname, region_id, cached in candidates:
+            region = table_region_map[full_tabname].all_region_map[region_id]
+            node_id, properties = cached
+            # 老版本的缓存中没有mvcc统计信息，需要mvcc统计时重新查询
+            if not self.is_cached_properties_valid(region, properties) or (
+                    self.collect_mvcc and properties.get("mvcc") is None):
+                tasks.append((full_tabname, region_id))
+                continue
+            self._set_region_sstfiles(region, node_id, properties["sst_files"], properties["only_writecf"])
+            if self.collect_mvcc:
+                region.mvcc_stats = properties["mvcc"]
+            region.props_from_cache = True
+            cache_hit_count += 1
+        if use_cache:
+            log.info("region properties cache hit:%d,need query:%d" % (cache_hit_count, len(tasks)))
+        return tasks
+
+    # 缓存的region-properties结果中记录的pd统计信息（approximate_size,approximate_keys）与region当前的统计信息一致时缓存有效
+    # region写入的数据flush或者ingest之后会新增sstfile，但不会改变epoch，也不会删除已有的sstfile，只能通过统计信息的变化发现
+    # 老版本的缓存中没有统计信息，获取不到region当前的统计信息时也无法判断，都视为无效
+    @staticmethod
+    def is_cached_properties_valid(region, properties):
+        pd_stats = properties.get("pd_stats")
+        if pd_stats is None or not region.has_pd_stats:
+            return False
+        return pd_stats[0] == region.approximate_size and pd_stats[1] == region.approximate_keys
+
+    # 根据peer_policy为每个region选择查询region-properties的tikv节点，返回[(full_tabname,region_id,address)]
+    # leader:只查询leader；round-robin:在region的副本之间轮流选择；least-loaded:选择已分配查询数最少的副本；
+    # store:<store_id>:region在该store上有副本时查询该副本，否则查询leader。tiflash的store不参与选择
+    def _assign_property_nodes(self, table_region_map, tasks):
+        if self.peer_policy == "leader":
+            return [(full_tabname, region_id,
+                     table_region_map[full_tabname].all_region_map[region_id].leader_store_node_id) for
+                    full_tabname, region_id in tasks]
+        store_address_map = {}  # key:store_id,value:address
+        for store in self.get_all_stores():
+            if not store.is_tiflash:
+                store_address_map[store.id] = intern(str(store.address))
+        designated_store_id = None
+        if self.peer_policy.startswith("store:"):
+            designated_store_id = int(self.peer_policy.split(":", 1)[1])
+        store_load = {}  # key:address,value:已分配的查询数
+        assigned_tasks = []
+        for i, (full_tabname, region_id) in enumerate(tasks):
+            region = table_region_map[full_tabname].all_region_map[region_id]
+            candidates = [store_address_map[store_id] for store_id in region.peer_store_ids if
+                          store_id in store_address_map]
+            if len(candidates) == 0:
+                address = region.leader_store_node_id
+            elif designated_store_id is not None:
+                address = region.leader_store_node_id
+                if designated_store_id in region.peer_store_ids and designated_store_id in store_address_map:
+                    address = store_address_map[designated_store_id]
+            elif self.peer_policy == "round-robin":
+                address = candidates[i % len(candidates)]
+            else:
+                address = min(candidates, key=lambda candidate: store_load.get(candidate, 0))
+            store_load[address] = store_load.get(address, 0) + 1
+            assigned_tasks.append((full_tabname, region_id, address))
+        log.info("peer policy:%s,region-properties queries per store:%s" % (
+            self.peer_policy, ",".join("%s=%d" % (address, cnt) for address, cnt in sorted(store_load.items()))))
+        return assigned_tasks
+
+    # 查询tasks中region的property信息，并补充table_region_map中的sstfile相关信息
+    # tasks:[(full_tabname,region_id)]
+    # parallel为整个集群的并发上限，self.store_parallel为每个store的并发上限
+    # 常驻进程只在找到tikv-ctl二进制时使用，否则每个region调用一次tiup ctl（与常驻进程中循环调用tiup的代价相同）
+    def _collect_region_properties(self, table_region_map, tasks, parallel):
+        use_worker = self.has_ctl_binary()
+        if not use_worker:
+            log.warning("cannot find tikv-ctl binary,query region-properties per call without long-lived workers")
+        if use_worker and self._use_async_engine():
+            log.info("region-properties engine:asyncio")
+            engine_tasks = []
+            for full_tabname, region_id, address in self._assign_property_nodes(table_region_map, tasks):
+                engine_tasks.append((address, region_id, (full_tabname, region_id, address)))
+            ctl_command = self.get_ctl_command()
+            engine = aio_properties.AsyncRegionPropertiesEngine(
+                lambda address: RegionPropertiesWorker.script(ctl_command, address),
+                RegionPropertiesWorker.end_marker, parallel, self.store_parallel,
+                adaptive_limit=self._properties_gate.adaptive_limit if self._properties_gate is not None else None)
+            engine.run(engine_tasks, lambda ctx, result, recode: self._apply_region_properties(
+                table_region_map, ctx[0], ctx[1], ctx[2], result, recode))
+            log.info("region-properties engine:asyncio done")
+        else:
+            log.info("region-properties engine:thread")
+
+            # 获取region信息,并将结果写入region_queue
+            def put_regions_to_queue(tasks, region_queue, parallel):
+                for full_tabname, region_id, address in tasks:
+                    region_queue.put((full_tabname, region_id, address))
+                    log.debug("put region into region_queue:%s" % (region_id))
+                for i in range(parallel):
+                    # signal close region_queue
+                    log.debug("put region into region_queue:None")
+                    region_queue.put(None)
+
+            region_thread = threading.Thread(target=put_regions_to_queue, args=(
+                self._assign_property_nodes(table_region_map, tasks), region_queue, parallel))
+            log.info("put_regions_to_queue")
+            region_thread.start()
+            # 每个store维护store_parallel个常驻的region-properties进程
+            if use_worker:
+                self._properties_collector = RegionPropertiesCollector(self.get_ctl_command(), self.store_parallel)
+            threads = []
+            log.info("region_queue->get_leader_region_sstfiles_muti")
+            for i in range(parallel):
+                t = threading.Thread(target=self.get_leader_region_sstfiles_muti,
+                                     args=(table_region_map, region_queue, i))
+                t.start()
+                threads.append(t)
+            for i in threads: i.join()
+            if self._properties_collector is not None:
+                self._properties_collector.close()
+                self._properties_collector = None
+            log.info("region_queue->get_leader_region_sstfiles_muti done")
+            region_thread.join()
+            log.info("put_regions_to_queue done")
+        if self.region_properties_cache is not None:
+            self.region_properties_cache.flush()
+
+    # 解析region-properties的结果，补充table_region_map中region的sstfile信息
+    # node_id为查询region-properties的tikv节点
+    def _apply_region_properties(self, table_region_map, full_tabname, region_id, node_id, result, recode):
+        region = table_region_map[full_tabname].all_region_map[region_id]
+        # cannot find region when region split or region merge
+        if recode != 0:
+            log.warning("region-properties error,node_id:%s,region_id:%d,message:%s" % (
+                node_id, region_id, result))
+            self._set_region_sstfiles(region, node_id, [], False)
+            return
+        sstfile_names, only_writecf = parse_region_sstfiles(result)
+        self._set_region_sstfiles(region, node_id, sstfile_names, only_writecf)
+        mvcc_stats = parse_region_mvcc(result)
+        if self.collect_mvcc:
+            region.mvcc_stats = mvcc_stats
+        if len(sstfile_names) == 0:
+            log.debug("region-properties:tabname:%s,region:%d's sstfile cannot found" % (full_tabname, region_id))
+        elif self.region_properties_cache is not None:
+            self.region_properties_cache.put(region, node_id,
+                                             {"sst_files": sstfile_names, "only_writecf": only_writecf,
+                                              "mvcc": mvcc_stats,
+                                              "pd_stats": [region.approximate_size, region.approximate_keys]
+                                              if region.has_pd_stats else None})
+
+    # node_id为查询property的tikv节点，sstfile位于该节点上
+    def _set_region_sstfiles(self, region, node_id, sstfile_names, only_writecf):
+        if only_writecf and not self.property_only_writecf_mode:
+            self.property_only_writecf_mode = True
+            log.info("property_only_writecf_mode:%s" % (self.property_only_writecf_mode))
+        region.sst_nos = array.array(ARRAY_INT_TYPECODE, [sst_file_number(sstfilename) for sstfilename in sstfile_names])
+        region.sst_sizes = array.array(ARRAY_INT_TYPECODE, [0]) * len(sstfile_names)
+        region.props_node_id = intern(str(node_id))
+        region.props_from_cache = False
 
     # 获取提供的region信息，多线程获取property信息
     # 入参：
     # table_region_map为以dbname+"."+tabname为key，TableInfo为value的字典
-    # region_queue中获取region信息（dbname,tablename,region_id)，修改table_region_map，补充sstfile相关信息
+    # region_queue中获取region信息（full_tabname,region_id)，修改table_region_map，补充sstfile相关信息
     def get_leader_region_sstfiles_muti(self, table_region_map, region_queue, thread_id=0):
         log.debug("thread_id:%d,get_leader_region_sstfiles_muti start" % (thread_id))
         while True:
@@ -729,43 +3493,37 @@ class TiDBCluster:
             if data is None:
                 log.debug("thread_id:%d,get_leader_region_sstfiles_muti done" % (thread_id))
                 return
-            # (tabname, leader_node_id, region_id) = data
-            (dbname, tabname, region_id) = data
-            full_tabname = dbname + "." + tabname
-            table_info = table_region_map[full_tabname]
-            region = table_info.all_region_map[region_id]
-            leader_node_id = region.leader_store_node_id
-            sstfiles = []
-            cmd = "tiup ctl:%s tikv --host %s region-properties -r %d" % (
-                self.ctl_version, leader_node_id, region_id)
-            result, recode = command_run(cmd)
-            # cannot find region when region split or region merge
-            if recode != 0:
-                log.warning("cmd:%s,message:%s" % (cmd, result))
+            (full_tabname, region_id, node_id) = data
+            start_time = self._properties_gate.acquire() if self._properties_gate is not None else None
+            if self._properties_collector is not None:
+                result, recode = self._properties_collector.query(node_id, region_id)
             else:
-                for each_line in result.splitlines():
-                    if each_line.find("sst_files:") > -1:
-                        # 如果tikv-ctl region properties的结果中包含sst_files开头的说明打印的结果只包含了writecf的sst文件
-                        if each_line.find("sst_files:") == 0 and not self.property_only_writecf_mode:
-                            self.property_only_writecf_mode = True
-                            log.info("property_only_writecf_mode:%s" % (self.property_only_writecf_mode))
-                        each_line_fields = each_line.split(":")
-                        each_line_fields_len = len(each_line_fields)
-                        if each_line_fields_len == 2 and each_line_fields[1] != "":
-                            for sstfilename in [x.strip() for x in each_line_fields[1].split(",")]:
-                                if sstfilename == "":
-                                    continue
-                                sstfile = SSTFile()
-                                sstfile.sst_name = sstfilename
-                                sstfile.region_id_list.append(region_id)
-                                sstfile.sst_node_id = leader_node_id
-                                sstfiles.append(sstfile)
-            if len(sstfiles) == 0:
-                log.debug(
-                    "region-properties:tabname:%s,region:%d's sstfile cannot found,cmd:%s" % (tabname, region_id, cmd))
-            table_region_map[full_tabname].all_region_map[region_id].sstfile_list = sstfiles
+                cmd = "%s --host %s region-properties -r %d" % (self.get_ctl_command(), node_id, region_id)
+                result, recode = command_run(cmd)
+            if self._properties_gate is not None:
+                # region不存在（split、merge）是正常的返回，只把超时当作失败
+                self._properties_gate.release(start_time, recode != 9)
+            self._apply_region_properties(table_region_map, full_tabname, region_id, node_id, result, recode)
             region_queue.task_done()
 
+    # 返回tikv-ctl的命令前缀，优先直接使用tiup已安装的tikv-ctl二进制，避免每次调用都经过tiup启动和组件解析
+    def get_ctl_command(self):
+        if self._ctl_command != "":
+            return self._ctl_command
+        tiup_home = os.environ.get("TIUP_HOME", os.path.expanduser("~/.tiup"))
+        ctl_binary = os.path.join(tiup_home, "components", "ctl", self.ctl_version, "tikv-ctl")
+        if os.path.isfile(ctl_binary) and os.access(ctl_binary, os.X_OK):
+            self._ctl_command = shell_quote(ctl_binary)
+        else:
+            log.warning("cannot find tikv-ctl binary:%s,use tiup ctl instead" % (ctl_binary))
+            self._ctl_command = "tiup ctl:%s tikv" % (self.ctl_version)
+        log.info("tikv-ctl command:%s" % (self._ctl_command))
+        return self._ctl_command
+
+    # 是否找到了tiup已安装的tikv-ctl二进制（否则get_ctl_command返回tiup ctl）
+    def has_ctl_binary(self):
+        return not self.get_ctl_command().startswith("tiup ")
+
     def get_cf_info(self):
         if self.property_only_writecf_mode is not True:
             return None
@@ -898,6 +3656,16 @@ class OutPutShow():
             format_list.append("%-" + str(self.max_width_map[i] + 2) + "s")
         return "".join(format_list)
 
+    # 流式输出时事先无法得到每列值的最大长度，按照标题长度和min_width固定列宽，超长的值会使该行不对齐
+    def show_title(self, min_width=12):
+        self._output_format = "".join(
+            ["%-" + str(max(len(str(title)), min_width) + 2) + "s" for title in self.title_list])
+        print(self._format() % tuple(self.title_list))
+
+    def show_row(self, each_line_list):
+        print(self._format() % tuple(each_line_list))
+        sys.stdout.flush()
+
     def show(self, with_title=True):
         if not self._check():
             log.error("output show check error")
@@ -912,14 +3680,120 @@ class OutPutShow():
                 print(self._format() % tuple(each_line_list))
 
 
+# history子命令：查询一段时间内表的增长，并执行降采样和过期数据清理
+# python3 main.py history -f table_size.db -c tidb-test [-d db] [-t t1,t2] [--days 7]
+def history_main(argv):
+    arg_parser = argparse.ArgumentParser(prog="%s history" % (sys.argv[0]),
+                                         description='show table size growth from size history')
+    arg_parser.add_argument('-f', '--sqlite3dbfile', type=str, required=True, help='sqlite3 file of size history')
+    arg_parser.add_argument('-c', '--cluster', type=str, required=True, help='tidb cluster name')
+    arg_parser.add_argument('-d', '--dbname', type=str, default="*", help='database name,* mains all databases')
+    arg_parser.add_argument('-t', '--tabnamelist', type=str, default="*", help='table name list like "t1,t2,t3"')
+    arg_parser.add_argument('--days', default=7, type=float, help='growth in the last N days')
+    arg_parser.add_argument('--since', type=str, help='window start time,format:"YYYY-mm-dd HH:MM:SS",override --days')
+    arg_parser.add_argument('--until', type=str, help='window end time,format:"YYYY-mm-dd HH:MM:SS",default now')
+    arg_parser.add_argument('--method', type=str, choices=["exact", "sample", "approximate"],
+                            help='only use sizes got by this size method')
+    arg_parser.add_argument('--top', default=20, type=int, help='show top N tables by growth,0 means all')
+    arg_parser.add_argument('--keep-hourly', type=int, help='days to keep hourly points before downsample to daily')
+    arg_parser.add_argument('--keep-daily', type=int, help='days to keep daily points before downsample to weekly')
+    arg_parser.add_argument('--keep-weekly', type=int, help='days to keep weekly points,0 means forever')
+    arg_parser.add_argument('--drop-legacy', action='store_true',
+                            help='drop table_size_info after migrating it into size history and vacuum the file')
+    args = arg_parser.parse_args(argv)
+    log.basicConfig(filename=sys.argv[0] + ".log", filemode='a', level=log.INFO,
+                    format='%(asctime)s - %(name)s-%(filename)s[line:%(lineno)d] - %(levelname)s - %(message)s')
+    history = TableSizeHistory(args.sqlite3dbfile)
+    try:
+        if args.drop_legacy:
+            history.drop_legacy()
+        else:
+            history.migrate_legacy()
+        history.downsample(retention={"hour": args.keep_hourly, "day": args.keep_daily, "week": args.keep_weekly})
+        end_ts = TableSizeHistory.now_ts() if args.until is None else TableSizeHistory.parse_time(args.until)
+        start_ts = int(end_ts - args.days * 86400) if args.since is None else TableSizeHistory.parse_time(args.since)
+        tabname_list = None if args.tabnamelist == "*" else [x.strip() for x in args.tabnamelist.split(",")]
+        rows = history.growth(args.cluster, start_ts, end_ts, None if args.dbname == "*" else args.dbname,
+                              tabname_list, args.method)
+    finally:
+        history.close()
+    rows.sort(reverse=True, key=lambda x: x[5] - x[4])
+    if args.top > 0:
+        rows = rows[:args.top]
+    print_output = OutPutShow()
+    print_output.title_list = ["DataBase", "TabName", "StartTime", "EndTime", "StartSize", "EndSize", "Growth",
+                               "GrowthF", "GrowthRate", "Method"]
+    for dbname, tabname, first_ts, last_ts, first_size, last_size, methods in rows:
+        growth = last_size - first_size
+        print_output.data_list.append([
+            dbname, tabname, TableSizeHistory.format_ts(first_ts), TableSizeHistory.format_ts(last_ts),
+            format_size(first_size),
+            format_size(last_size), growth, ("-" if growth < 0 else "") + format_size(abs(growth)),
+            "%.2f%%" % (100.0 * growth / first_size) if first_size > 0 else "-", "->".join(methods)])
+    print_output.show()
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "history":
+        history_main(sys.argv[2:])
+        sys.exit(0)
     arg_parser = argparse.ArgumentParser(description='get table size')
     arg_parser.add_argument('-c', '--cluster', type=str, required=True, help='tidb cluster name')
     arg_parser.add_argument('-d', '--dbname', type=str, required=True, help='database name,* mains all databases')
     arg_parser.add_argument('-t', '--tabnamelist', type=str, required=True,
                             help='table name,* mains all tables for database,muti table should like this "t1,t2,t3"')
     arg_parser.add_argument('-p', '--parallel', default=1, type=int, help='parallel')
+    arg_parser.add_argument('--store-parallel', default=1, type=int,
+                            help='max concurrent region-properties queries per tikv store')
+    arg_parser.add_argument('--host-parallel', default=8, type=int,
+                            help='max tikv hosts to get sst file sizes from concurrently')
+    arg_parser.add_argument('--stat-chunk-size', default=5000, type=int,
+                            help='max sst files per stat batch when getting sst file sizes by name')
+    arg_parser.add_argument('--stat-chunk-parallel', default=4, type=int,
+                            help='max concurrent stat batches per tikv host')
+    arg_parser.add_argument('--remote-agg', action='store_true',
+                            help='sum sst file sizes per table on tikv hosts and only return the totals,cannot be used with --sample')
+    arg_parser.add_argument('--peer-policy', default="leader", type=str,
+                            help='replica to query region-properties from,leader,round-robin,least-loaded or store:<store_id>')
+    arg_parser.add_argument('--adaptive', action='store_true',
+                            help='adjust region-properties and stat concurrency by call latency,--parallel etc. are the upper limits')
+    arg_parser.add_argument('--max-grpc-p99', default=0, type=float,
+                            help='with --adaptive,slow down when tikv grpc p99 latency(seconds) from prometheus exceed this value,0 means not check')
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='get tables size in windows of --window tables and print/save each window at once,memory does not grow with the number of tables')
+    arg_parser.add_argument('--window', default=100, type=int, help='tables per window with --stream,--resume or --top')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='save finished tables into --sqlite3dbfile as it goes,and continue the last unfinished run with the same arguments')
+    arg_parser.add_argument('--restart', action='store_true',
+                            help='with --resume,abandon the unfinished run of the same tables and start a new run')
+    arg_parser.add_argument('--top', default=0, type=int,
+                            help='only get the N largest tables,rank all tables by pd approximate size first and only get exact size for tables that may be in the top N')
+    arg_parser.add_argument('--detail', action='store_true',
+                            help='split table size into partitions and indexes by region key range')
+    arg_parser.add_argument('--mvcc', action='store_true',
+                            help='report mvcc garbage and tombstone ratio of tables and indexes from region-properties')
+    arg_parser.add_argument('--no-legacy-table', action='store_true',
+                            help='only write results into size history,do not write the old wide table table_size_info')
+    arg_parser.add_argument('--http-timeout', default=30, type=float,
+                            help='timeout(seconds) of http requests to tidb status port,pd and prometheus')
+    arg_parser.add_argument('--http-retries', default=3, type=int,
+                            help='retries of failed http requests,each retry uses the next tidb/pd node and waits longer')
+    arg_parser.add_argument('--check-liveness', action='store_true',
+                            help='check node status by tiup cluster display and ignore nodes that are not up')
+    arg_parser.add_argument('--engine', default="auto", type=str, choices=["auto", "thread", "asyncio"],
+                            help='region-properties engine,auto means asyncio for python3 and thread for python2')
+    arg_parser.add_argument('--discovery', default="table", type=str, choices=["table", "pd"],
+                            help='region discovery,table:request tidb for each table,pd:scan pd regions by key range once')
     arg_parser.add_argument('-f', '--sqlite3dbfile', type=str, help='load data into sqlite3')
+    arg_parser.add_argument('--sample', type=str,
+                            help='sample regions instead of all regions,ratio(0,1) like 0.1 or region count per table like 100')
+    arg_parser.add_argument('--approximate', action='store_true',
+                            help='estimate size from pd region approximate_size only,without tikv-ctl and tiup cluster exec')
+    arg_parser.add_argument('--calibrate', action='store_true',
+                            help='calibrate --approximate result (or the --top ranking) with the last exact result '
+                                 'in --sqlite3dbfile')
+    arg_parser.add_argument('--cachefile', type=str,
+                            help='sqlite3 file to cache sst file sizes and region properties,default is table_size_cache.db next to --sqlite3dbfile')
     arg_parser.add_argument('--loglevel', default="info", type=str, help='critical,error,warn,info,debug')
     args = arg_parser.parse_args()
     cname, dbname, tabnamelist, parallel, loglevel, level, sqlite3dbfile = args.cluster, args.dbname, args.tabnamelist, args.parallel, args.loglevel, log.INFO, args.sqlite3dbfile
@@ -938,7 +3812,55 @@ if __name__ == "__main__":
                     format='%(asctime)s - %(name)s-%(filename)s[line:%(lineno)d] - %(levelname)s - %(message)s')
     start_time = time.time()
     db_list = []
-    cluster = TiDBCluster(cname)
+    is_approximate = args.approximate
+    http_client.timeout = args.http_timeout
+    http_client.retries = args.http_retries
+    cluster = TiDBCluster(cname, check_ctl=not is_approximate)
+    if args.check_liveness:
+        cluster.check_liveness()
+    cluster.properties_engine = args.engine
+    cluster.store_parallel = args.store_parallel
+    cluster.host_parallel = args.host_parallel
+    cluster.stat_chunk_size = args.stat_chunk_size
+    cluster.stat_chunk_parallel = args.stat_chunk_parallel
+    cluster.region_discovery = args.discovery
+    if args.sample is not None and args.sample != "":
+        sample_value = float(args.sample)
+        if 0 < sample_value < 1:
+            cluster.sample_ratio = sample_value
+        elif sample_value >= 1 and sample_value == int(sample_value):
+            cluster.sample_count = int(sample_value)
+        else:
+            raise Exception("invalid sample value:%s" % (args.sample))
+    is_sample = cluster.sample_ratio > 0 or cluster.sample_count > 0
+    if args.remote_agg and is_sample:
+        raise Exception("--remote-agg cannot be used with --sample")
+    cluster.remote_aggregate = args.remote_agg
+    if args.peer_policy not in ("leader", "round-robin", "least-loaded") and not (
+            args.peer_policy.startswith("store:") and args.peer_policy[len("store:"):].isdigit()):
+        raise Exception("invalid peer policy:%s" % (args.peer_policy))
+    cluster.peer_policy = args.peer_policy
+    if args.max_grpc_p99 > 0 and not args.adaptive:
+        raise Exception("--max-grpc-p99 need --adaptive")
+    cluster.adaptive = args.adaptive
+    cluster.max_grpc_p99 = args.max_grpc_p99
+    # python3需要用!=""来处理，python2需要用is not None处理
+    has_sqlite3dbfile = sqlite3dbfile != "" and sqlite3dbfile is not None
+    # 精确计算时记录pd中的region大小，用于approximate模式校准
+    cluster.collect_approximate = has_sqlite3dbfile and not is_sample and not is_approximate
+    if args.detail and args.stream:
+        raise Exception("--detail cannot be used with --stream")
+    cluster.collect_detail = args.detail
+    if args.mvcc and (args.stream or is_approximate):
+        raise Exception("--mvcc cannot be used with --stream or --approximate")
+    cluster.collect_mvcc = args.mvcc
+    cachefile = args.cachefile
+    if (cachefile == "" or cachefile is None) and sqlite3dbfile != "" and sqlite3dbfile is not None:
+        cachefile = os.path.join(os.path.dirname(os.path.abspath(sqlite3dbfile)), "table_size_cache.db")
+    if cachefile != "" and cachefile is not None and not is_approximate:
+        log.info("sst size cache file:%s" % (cachefile))
+        cluster.sst_size_cache = SSTSizeCache(cachefile)
+        cluster.region_properties_cache = RegionPropertiesCache(cachefile)
     if dbname == "*":
         db_list = cluster.get_dblist()
     else:
@@ -946,18 +3868,247 @@ if __name__ == "__main__":
     print_output = OutPutShow()
     print_output.title_list = ["DataBase", "TabName", "Partition", "IndexCnt", "DataSize", "DataSizeF", "Indexsize",
                                "IndexsizeF", "Tablesize", "TablesizeF"]
+    if is_sample:
+        print_output.title_list.extend(["DataSizeErr", "IndexsizeErr", "TablesizeErr"])
+    db_tabname_list = []
     for each_db in db_list:
         tabname_list = [x.strip() for x in tabnamelist.split(",")]
         if len(tabname_list) == 1 and tabname_list[0] == "*":
             tabname_list = cluster.get_tablelist4db(each_db)
-        tables_map = cluster.get_phy_tables_size(each_db, tabname_list, parallel)
-        for full_tabname, val in sorted(tables_map.items(), reverse=True, key=lambda x: x[1]["table_size"]):
-            print_output.data_list.append(
-                [val["dbname"], val["tabname"], val["is_partition"], val["index_count"], val["data_size"],
-                 format_size(val["data_size"]),
-                 val["index_size"], format_size(val["index_size"]), val["table_size"], format_size(val["table_size"])])
-    # python3需要用!=""来处理，python2需要用is not None处理
-    if sqlite3dbfile != "" and sqlite3dbfile is not None:
-        load2sqlite3(sqlite3dbfile, cname, print_output.data_list)
-    print_output.show()
+        db_tabname_list.append((each_db, tabname_list))
+    # 校准系数用于--approximate的结果，以及--top按approximate大小排序
+    calibration = None
+    if args.calibrate:
+        if not is_approximate and args.top <= 0:
+            raise Exception("--calibrate need --approximate or --top")
+        if not has_sqlite3dbfile:
+            raise Exception("--calibrate need --sqlite3dbfile")
+        calibration = get_calibration_from_sqlite3(sqlite3dbfile, cname)
+    if is_approximate:
+        get_tables_size = lambda db_tabname_list: cluster.get_approximate_cluster_tables_size(db_tabname_list,
+                                                                                               calibration)
+    else:
+        get_tables_size = lambda db_tabname_list: cluster.get_phy_cluster_tables_size(db_tabname_list, parallel)
+    size_method = "exact"
+    if is_sample:
+        size_method = "sample"
+    elif is_approximate:
+        size_method = "approximate"
+
+
+    def get_output_row(val):
+        row = [val["dbname"], val["tabname"], val["is_partition"], val["index_count"], val["data_size"],
+               format_size(val["data_size"]),
+               val["index_size"], format_size(val["index_size"]), val["table_size"], format_size(val["table_size"])]
+        if is_sample:
+            row.extend(["+-" + format_size(val["data_size_err"]), "+-" + format_size(val["index_size_err"]),
+                        "+-" + format_size(val["table_size_err"])])
+        return row
+
+
+    # 每个分区、每个索引一行：dbname,tabname,segment_type,segment_name,size,size_format,split_method，非分区表不输出分区
+    # split_method：approximate表示只按完整region的approximate_size分摊，estimated表示包含按key范围比例拆分的region，误差可能较大
+    def get_detail_rows(val):
+        rows = []
+        segments = []
+        if val["is_partition"] != "False":
+            segments.append(("partition", val["partition_sizes"]))
+        segments.append(("index", val["index_sizes"]))
+        for segment_type, sizes in segments:
+            for name, size in sorted(sizes.items(), reverse=True, key=lambda x: x[1]):
+                split_method = "estimated" if (segment_type, name) in val["split_segments"] else "approximate"
+                rows.append([val["dbname"], val["tabname"], segment_type, name, size, format_size(size), split_method])
+        return rows
+
+
+    def show_detail(table_list):
+        detail_output = OutPutShow()
+        detail_output.title_list = ["DataBase", "TabName", "Type", "Name", "Size", "SizeF", "Method"]
+        for val in table_list:
+            detail_output.data_list.extend(get_detail_rows(val))
+        print("")
+        detail_output.show()
+
+
+    # 每张表一行table、一行data，每个索引一行index，值为数值（写入sqlite3）
+    def get_mvcc_rows(val):
+        rows = []
+        segment_stats = [("table", "-", val["mvcc"]["table"]), ("data", "-", val["mvcc"]["data"])]
+        if len(val["mvcc"]["indexes"]) == 0 and val["mvcc"]["index"]["regions"] != 0:
+            segment_stats.append(("index", "-", val["mvcc"]["index"]))
+        for name, stats in sorted(val["mvcc"]["indexes"].items()):
+            segment_stats.append(("index", name, stats))
+        for segment_type, name, stats in segment_stats:
+            rows.append([val["dbname"], val["tabname"], segment_type, name, stats["regions"], stats["num_rows"],
+                         stats["num_versions"], stats["num_deletes"], stats["max_row_versions"],
+                         round(stats["garbage_ratio"], 4), stats["num_entries"], stats["tombstones"],
+                         round(stats["tombstone_ratio"], 4)])
+        return rows
+
+
+    def show_mvcc(table_list):
+        mvcc_output = OutPutShow()
+        mvcc_output.title_list = ["DataBase", "TabName", "Type", "Name", "Regions", "Rows", "Versions", "Deletes",
+                                  "MaxRowVersions", "GarbageRatio", "Entries", "Tombstones", "TombstoneRatio"]
+        for val in table_list:
+            for row in get_mvcc_rows(val):
+                row[9] = "%.2f%%" % (row[9] * 100)
+                row[12] = "%.2f%%" % (row[12] * 100)
+                mvcc_output.data_list.append(row)
+        print("")
+        mvcc_output.show()
+
+
+    # 表大小写入size_history，同时写入table_size_info（指定--no-legacy-table时不写入），同一次执行的所有结果使用同一个insert_time
+    history = None
+    if has_sqlite3dbfile:
+        history = TableSizeHistory(sqlite3dbfile)
+        history.migrate_legacy()
+
+
+    def save_tables_size(tables_map, data_list, insert_time=None):
+        if insert_time is None:
+            insert_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            history.write(cname, [(val["dbname"], val["tabname"], val["data_size"], val["index_size"],
+                                   val["table_size"]) for val in tables_map.values()], size_method, insert_time)
+        except Exception as e:
+            log.error("write size history error,message:%s" % (e))
+        if not args.no_legacy_table:
+            load2sqlite3(sqlite3dbfile, cname, data_list, size_method, insert_time)
+        if args.detail:
+            detail_list = []
+            for val in tables_map.values():
+                detail_list.extend(get_detail_rows(val))
+            load_detail2sqlite3(sqlite3dbfile, cname, detail_list, insert_time)
+        if args.mvcc:
+            mvcc_list = []
+            for val in tables_map.values():
+                mvcc_list.extend(get_mvcc_rows(val))
+            load_mvcc2sqlite3(sqlite3dbfile, cname, mvcc_list, insert_time)
+        if cluster.collect_approximate:
+            load_calibration2sqlite3(sqlite3dbfile, cname, [
+                (val["dbname"], val["tabname"], val["data_size"], val["index_size"], val["table_size"],
+                 val["approx_data_size"], val["approx_index_size"], val["approx_table_size"]) for val in
+                tables_map.values()], insert_time)
+
+
+    # --top本身按--window张表一批获取approximate大小，--stream时同样按排序结果输出前N张表
+    if args.top > 0 and args.resume:
+        raise Exception("--top cannot be used with --resume")
+    if args.restart and not args.resume:
+        raise Exception("--restart need --resume")
+    checkpoint = None
+    if args.resume:
+        if not has_sqlite3dbfile:
+            raise Exception("--resume need --sqlite3dbfile")
+        # 影响每张表结果的参数（--detail、--mvcc的结果也保存在检查点中）都相同的执行才能继续
+        scan_args = {"dbname": dbname, "tabnamelist": tabnamelist, "size_method": size_method,
+                     "sample_ratio": cluster.sample_ratio, "sample_count": cluster.sample_count,
+                     "discovery": args.discovery, "calibrate": args.calibrate, "engine": args.engine,
+                     "peer_policy": args.peer_policy, "remote_agg": args.remote_agg, "detail": args.detail,
+                     "mvcc": args.mvcc}
+        checkpoint = ScanCheckpoint(sqlite3dbfile, cname, scan_args)
+        checkpoint.resume_or_start(args.restart)
+        db_tabname_list = [(each_db, [tabname for tabname in tabname_list if not checkpoint.is_done(each_db, tabname)])
+                           for each_db, tabname_list in db_tabname_list]
+    try:
+        if (args.stream and args.top <= 0) or checkpoint is not None:
+            # 每批表完成后立即写入sqlite3并记录检查点，stream模式下同时立即输出，不保留已经输出的结果
+            # 同一次执行（包括中断后继续的执行）的结果使用同一个insert_time
+            insert_time = time.strftime("%Y-%m-%d %H:%M:%S") if checkpoint is None else checkpoint.insert_time
+            all_tables_map = {}
+            if checkpoint is not None:
+                for val in checkpoint.done_tables.values():
+                    all_tables_map[val["dbname"] + "." + val["tabname"]] = val
+            if args.stream:
+                print_output.show_title()
+                for val in sorted(all_tables_map.values(), reverse=True, key=lambda x: x["table_size"]):
+                    print_output.show_row(get_output_row(val))
+                all_tables_map = {}
+            for tables_map in cluster.iter_cluster_tables_size(db_tabname_list, args.window, get_tables_size):
+                data_list = [get_output_row(val) for val in
+                             sorted(tables_map.values(), reverse=True, key=lambda x: x["table_size"])]
+                if has_sqlite3dbfile:
+                    save_tables_size(tables_map, data_list, insert_time)
+                if checkpoint is not None:
+                    checkpoint.mark_done(tables_map)
+                if args.stream:
+                    for row in data_list:
+                        print_output.show_row(row)
+                else:
+                    all_tables_map.update(tables_map)
+            if checkpoint is not None:
+                checkpoint.finish()
+            if not args.stream:
+                table_list = []
+                for each_db in db_list:
+                    db_tables = [val for val in all_tables_map.values() if val["dbname"] == each_db]
+                    table_list.extend(sorted(db_tables, reverse=True, key=lambda x: x["table_size"]))
+                for val in table_list:
+                    print_output.data_list.append(get_output_row(val))
+                print_output.show()
+                if args.detail:
+                    show_detail(table_list)
+                if args.mvcc:
+                    show_mvcc(table_list)
+        elif args.top > 0:
+            # 只输出整个集群最大的top张表，按表大小排序
+            if is_approximate:
+                ranking, dropped = cluster.get_top_approximate_tables(db_tabname_list, args.top, args.window,
+                                                                      calibration)
+                tables_map = dict((item[1] + "." + item[2], item[3]) for item in ranking)
+            else:
+                tables_map = cluster.get_top_cluster_tables_size(db_tabname_list, args.top, get_tables_size,
+                                                                 calibration, args.window)
+            table_list = sorted(tables_map.values(), reverse=True, key=lambda x: x["table_size"])
+            for val in table_list:
+                print_output.data_list.append(get_output_row(val))
+            if has_sqlite3dbfile:
+                save_tables_size(tables_map, print_output.data_list)
+            print_output.show()
+            if args.detail:
+                show_detail(table_list)
+            if args.mvcc:
+                show_mvcc(table_list)
+        else:
+            tables_map = get_tables_size(db_tabname_list)
+            table_list = []
+            for each_db, tabname_list in db_tabname_list:
+                db_tables = [val for val in tables_map.values() if val["dbname"] == each_db]
+                table_list.extend(sorted(db_tables, reverse=True, key=lambda x: x["table_size"]))
+            for val in table_list:
+                print_output.data_list.append(get_output_row(val))
+            if has_sqlite3dbfile:
+                save_tables_size(tables_map, print_output.data_list)
+            print_output.show()
+            if args.detail:
+                show_detail(table_list)
+            if args.mvcc:
+                show_mvcc(table_list)
+    except KeyboardInterrupt:
+        # 已经完成的表、region-properties结果和sstfile大小都已经保存，未完成的查询线程直接随进程退出
+        if checkpoint is not None:
+            log.error("interrupted,done tables:%d,run again with --resume to continue" % (checkpoint.done_count))
+        else:
+            log.error("interrupted")
+        # os._exit不会执行finally和之后的close，先关闭检查点、历史数据和缓存（region-properties缓存关闭时提交未提交的结果）
+        for each_store in (checkpoint, history, cluster.sst_size_cache, cluster.region_properties_cache):
+            if each_store is None:
+                continue
+            try:
+                each_store.close()
+            except Exception as e:
+                log.error("close %s error:%s" % (each_store.__class__.__name__, e))
+        os._exit(130)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    if history is not None:
+        history.downsample()
+        history.close()
+    if cluster.sst_size_cache is not None:
+        cluster.sst_size_cache.close()
+    if cluster.region_properties_cache is not None:
+        cluster.region_properties_cache.close()
     log.info("Complate,time spend:%d seconds" % (time.time() - start_time))
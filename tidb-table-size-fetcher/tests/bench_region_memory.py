@@ -0,0 +1,92 @@
+# encoding=utf8
+# region目录（Region、副本、sstfile）的内存占用测试，需要python3（tracemalloc）
+# 用法：python3 tests/bench_region_memory.py [--regions 200000]
+# size-fetcher：Region使用__slots__，副本和sstfile保存在整数数组中
+# compact-table：Region、Peer、SSTFile都使用__slots__，每个副本和sstfile一个对象（与size-fetcher改造前的结构相同）
+# 每个region 3个副本、4个sstfile，按照1/4索引、3/4数据放入TableInfo的region字典
+import argparse
+import os
+import sys
+import tracemalloc
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, base_dir)
+
+import main
+
+
+def load_compactor():
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("compact_main",
+                                                  os.path.join(os.path.dirname(base_dir), "tidb-compact-table",
+                                                               "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+NODES = ["10.0.0.%d:20160" % (i) for i in range(10)]
+
+
+def sstfile_names(region_id):
+    return ["%06d.sst" % (region_id * 4 + k + 1000000) for k in range(4)]
+
+
+def build_fetcher(region_id):
+    region = main.Region()
+    region.region_id = region_id
+    region.leader_id = region_id * 3
+    region.leader_store_id = region_id % 10 + 1
+    region.leader_store_node_id = NODES[region_id % 10]
+    region.conf_ver = 5
+    region.version = 100
+    region.peer_store_ids = main.array.array(main.ARRAY_INT_TYPECODE, [(region_id + s) % 10 + 1 for s in range(3)])
+    region.sst_nos = main.array.array(main.ARRAY_INT_TYPECODE,
+                                      [main.sst_file_number(name) for name in sstfile_names(region_id)])
+    region.sst_sizes = main.array.array(main.ARRAY_INT_TYPECODE, [1234567] * 4)
+    region.props_node_id = NODES[region_id % 10]
+    return region
+
+
+def build_compactor(compactor, region_id):
+    region = compactor.Region()
+    region.region_id = region_id
+    region.leader_id = region_id * 3
+    region.leader_store_id = region_id % 10 + 1
+    region.leader_store_node_id = NODES[region_id % 10]
+    for s in range(3):
+        peer = compactor.Peer()
+        peer.region_id = region_id
+        peer.peer_id = region_id * 3 + s
+        peer.store_id = (region_id + s) % 10 + 1
+        region.peers.append(peer)
+    for name in sstfile_names(region_id):
+        sstfile = compactor.SSTFile()
+        sstfile.sst_name = name
+        sstfile.sst_size = 1234567
+        sstfile.sst_node_id = NODES[region_id % 10]
+        sstfile.region_id_list.append(region_id)
+        region.sstfile_list.append(sstfile)
+    return region
+
+
+def measure(name, region_count, table_info, build):
+    tracemalloc.start()
+    for region_id in range(region_count):
+        region = build(region_id)
+        (table_info.data_region_map if region_id % 4 else table_info.index_region_map)[region_id] = region
+        table_info.all_region_map[region_id] = region
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-15s regions:%d current:%.1fMB peak:%.1fMB per-region:%.0fB" % (
+        name, region_count, current / 2.0 ** 20, peak / 2.0 ** 20, float(current) / region_count))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="region catalog memory benchmark")
+    arg_parser.add_argument('--regions', default=200000, type=int, help='region count')
+    args = arg_parser.parse_args()
+    measure("size-fetcher", args.regions, main.TableInfo(), build_fetcher)
+    compactor = load_compactor()
+    measure("compact-table", args.regions, compactor.TableInfo(),
+            lambda region_id: build_compactor(compactor, region_id))
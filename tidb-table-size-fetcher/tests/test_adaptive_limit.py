@@ -0,0 +1,64 @@
+# encoding=utf8
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+    def test_additive_increase(self):
+        limit = main.AdaptiveLimit("t", max_limit=4)
+        self.assertEqual(1, limit.current())
+        limit.on_result(0.1)
+        self.assertEqual(2, limit.current())
+        # 上限为2时每次调用加1/limit，大约3次调用加1
+        for i in range(3):
+            limit.on_result(0.1)
+        self.assertEqual(3, limit.current())
+        for i in range(100):
+            limit.on_result(0.1)
+        self.assertEqual(4, limit.current())
+
+    def test_decrease_on_failure(self):
+        limit = main.AdaptiveLimit("t", max_limit=16, min_limit=2)
+        for i in range(200):
+            limit.on_result(0.001)
+        self.assertEqual(16, limit.current())
+        limit.on_result(0.001, ok=False)
+        self.assertEqual(8, limit.current())
+
+    def test_decrease_once_per_baseline(self):
+        limit = main.AdaptiveLimit("t", max_limit=16)
+        limit.limit = 16.0
+        limit.on_result(10)
+        limit.on_result(30)
+        self.assertEqual(8, limit.current())
+        # 同一个基线周期（10s*2）内在途的慢调用不再减半
+        limit.on_result(30)
+        limit.on_result(10, ok=False)
+        self.assertEqual(8, limit.current())
+
+    def test_decrease_on_pressure(self):
+        limit = main.AdaptiveLimit("t", max_limit=8, min_limit=3)
+        limit.limit = 8.0
+        limit.pressure = True
+        limit.on_result(0.1)
+        self.assertEqual(4, limit.current())
+        limit._last_decrease_time = 0
+        limit.on_result(0.1)
+        self.assertEqual(3, limit.current())
+
+    def test_gate(self):
+        gate = main.ConcurrencyGate(main.AdaptiveLimit("t", max_limit=4))
+        start_time = gate.acquire()
+        self.assertEqual(1, gate._inflight)
+        gate.release(start_time)
+        self.assertEqual(0, gate._inflight)
+        self.assertEqual(2, gate.adaptive_limit.current())
+
+
+if __name__ == "__main__":
+    unittest.main()
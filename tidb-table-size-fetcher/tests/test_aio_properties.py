@@ -0,0 +1,72 @@
+# encoding=utf8
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+if main.aio_properties is not None:
+    import asyncio
+
+
+class FakeLimit(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.results = []
+
+    def current(self):
+        return self.limit
+
+    def on_result(self, latency, ok):
+        self.results.append(ok)
+
+
+@unittest.skipIf(main.aio_properties is None, "asyncio engine need python3")
+class AsyncRegionPropertiesEngineTest(unittest.TestCase):
+    script = 'while read r; do echo "sst_files: $r.sst"; echo "__END__ $r 0"; done'
+
+    def test_run_twice(self):
+        engine = main.aio_properties.AsyncRegionPropertiesEngine(lambda address: self.script, "__END__", 4, 2)
+        results = []
+        for i in range(2):
+            engine.run([("s%d" % (region_id % 2), region_id, region_id) for region_id in range(10)],
+                       lambda ctx, result, recode: results.append((ctx, result.strip(), recode)))
+        self.assertEqual(20, len(results))
+        self.assertIn((3, "sst_files: 3.sst", 0), results)
+
+    def test_gate_released_when_query_raises(self):
+        limit = FakeLimit(1)
+        engine = main.aio_properties.AsyncRegionPropertiesEngine(lambda address: self.script, "__END__", 4, 1,
+                                                                 adaptive_limit=limit)
+
+        # 不使用async语法，测试文件在python2下也可以被导入
+        class BrokenWorker(object):
+            def query(self, region_id):
+                future = loop.create_future()
+                future.set_exception(ValueError("broken"))
+                return future
+
+            def close(self):
+                future = loop.create_future()
+                future.set_result(None)
+                return future
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            queue = asyncio.Queue()
+            queue.put_nowait((1, None))
+            gate = main.aio_properties.AsyncConcurrencyGate(limit)
+            with self.assertRaises(ValueError):
+                loop.run_until_complete(engine._consume(BrokenWorker(), queue, asyncio.Semaphore(1), gate, None))
+            self.assertEqual(0, gate._inflight)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assertEqual([False], limit.results)
+
+
+if __name__ == "__main__":
+    unittest.main()
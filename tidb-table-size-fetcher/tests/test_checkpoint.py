@@ -0,0 +1,85 @@
+# encoding=utf8
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def new_scan_args(**kwargs):
+    scan_args = {"dbname": "db", "tabnamelist": "*", "size_method": "sample", "sample_ratio": 0.1,
+                 "sample_count": 0, "discovery": "table", "calibrate": False, "engine": "auto"}
+    scan_args.update(kwargs)
+    return scan_args
+
+
+class ScanCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "history.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def new_checkpoint(self, scan_args):
+        checkpoint = main.ScanCheckpoint(self.fname, "c", scan_args)
+        self.addCleanup(checkpoint.close)
+        return checkpoint
+
+    def test_resume_same_args(self):
+        checkpoint = self.new_checkpoint(new_scan_args())
+        self.assertFalse(checkpoint.resume_or_start())
+        checkpoint.mark_done({"db.t1": {"dbname": "db", "tabname": "t1", "table_size": 1}})
+        checkpoint = self.new_checkpoint(new_scan_args())
+        self.assertTrue(checkpoint.resume_or_start())
+        self.assertTrue(checkpoint.is_done("db", "t1"))
+
+    def test_refuse_different_args(self):
+        self.new_checkpoint(new_scan_args()).resume_or_start()
+        for kwargs in ({"sample_ratio": 0.2}, {"discovery": "pd"}, {"engine": "asyncio"}, {"calibrate": True}):
+            self.assertRaises(Exception, self.new_checkpoint(new_scan_args(**kwargs)).resume_or_start)
+        # 其他表不受影响
+        self.assertFalse(self.new_checkpoint(new_scan_args(tabnamelist="t1", sample_ratio=0.2)).resume_or_start())
+
+    def test_restart(self):
+        old_checkpoint = self.new_checkpoint(new_scan_args())
+        old_checkpoint.resume_or_start()
+        checkpoint = self.new_checkpoint(new_scan_args(sample_ratio=0.2))
+        self.assertFalse(checkpoint.resume_or_start(restart=True))
+        self.assertNotEqual(old_checkpoint.run_id, checkpoint.run_id)
+        self.assertTrue(self.new_checkpoint(new_scan_args(sample_ratio=0.2)).resume_or_start())
+
+    def test_legacy_scan_args(self):
+        checkpoint = self.new_checkpoint(new_scan_args())
+        checkpoint.scan_args = json.dumps(["db", "*", "exact"])
+        checkpoint.resume_or_start()
+        self.assertRaises(Exception, self.new_checkpoint(new_scan_args()).resume_or_start)
+
+    def test_resume_remove_unfinished_rows(self):
+        checkpoint = self.new_checkpoint(new_scan_args())
+        checkpoint.resume_or_start()
+        insert_time = checkpoint.insert_time
+        checkpoint.mark_done({"db.t1": {"dbname": "db", "tabname": "t1", "table_size": 1}})
+        # t1已经完成，t2写入结果之后、记录检查点之前中断
+        for tabname in ("t1", "t2"):
+            main.load2sqlite3(self.fname, "c", [["db", tabname, "False", 0, 1, "1B", 2, "2B", 3, "3B"]], "exact",
+                              insert_time)
+            main.load_detail2sqlite3(self.fname, "c", [["db", tabname, "index", "a", 1, "1B", "estimated"]], insert_time)
+            main.load_mvcc2sqlite3(self.fname, "c", [["db", tabname, "table", "", 1, 1, 1, 0, 1, 0.0, 1, 0, 0.0]],
+                                   insert_time)
+            main.load_calibration2sqlite3(self.fname, "c", [("db", tabname, 1, 1, 2, 1, 1, 2)], insert_time)
+        self.assertTrue(self.new_checkpoint(new_scan_args()).resume_or_start())
+        conn = sqlite3.connect(self.fname)
+        self.addCleanup(conn.close)
+        for table_name in main.ScanCheckpoint.output_tables:
+            self.assertEqual([("t1",)], conn.execute("select tabname from %s" % (table_name)).fetchall())
+
+
+if __name__ == "__main__":
+    unittest.main()
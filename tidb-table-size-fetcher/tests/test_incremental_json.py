@@ -0,0 +1,49 @@
+# encoding=utf8
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def parse(data, decode_paths=(), chunk_size=3):
+    values = []
+    reader = main.IncrementalJSONReader(io.BytesIO(data.encode("utf-8")), chunk_size=chunk_size)
+    reader.parse(lambda path, value: values.append((path, value)), decode_paths)
+    return values
+
+
+class IncrementalJSONReaderTest(unittest.TestCase):
+    def test_scalars_by_path(self):
+        data = '{"count": 2, "regions": [{"id": 12345, "ok": true}, {"id": 7, "ok": null}], "name": "abc"}'
+        self.assertEqual([(("count",), 2), (("regions", 0, "id"), 12345), (("regions", 0, "ok"), True),
+                          (("regions", 1, "id"), 7), (("regions", 1, "ok"), None), (("name",), u"abc")],
+                         parse(data))
+
+    def test_decode_paths(self):
+        data = '{"count": 2, "regions": [{"id": 1, "peers": [{"id": 11}]}, {"id": 2, "peers": []}]}'
+        values = parse(data, decode_paths=[("regions", "*")])
+        self.assertEqual([(("count",), 2), (("regions", 0), {"id": 1, "peers": [{"id": 11}]}),
+                          (("regions", 1), {"id": 2, "peers": []})], values)
+
+    def test_chunk_boundaries(self):
+        # 每次读取不同字节数，数字、字符串和多字节字符都可能被截断
+        data = json.dumps({"tables": [{"name": u"表%d" % (i), "size": i * 123456789} for i in range(20)],
+                           "empty": {}, "list": [1.5, -2, [], "x"]})
+        expected = json.loads(data)
+        for chunk_size in (1, 2, 5, 64, 1 << 16):
+            values = dict(parse(data, decode_paths=[("tables", "*")], chunk_size=chunk_size))
+            self.assertEqual([values[("tables", i)] for i in range(20)], expected["tables"])
+            self.assertEqual([1.5, -2, u"x"], [values[("list", 0)], values[("list", 1)], values[("list", 3)]])
+
+    def test_invalid_json(self):
+        self.assertRaises(ValueError, parse, '{"a": [1, 2}')
+        self.assertRaises(ValueError, parse, '{"a": 1')
+
+
+if __name__ == "__main__":
+    unittest.main()
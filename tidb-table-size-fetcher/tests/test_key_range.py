@@ -0,0 +1,218 @@
+# encoding=utf8
+import binascii
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeResponse(io.BytesIO):
+    def close(self):
+        pass
+
+
+# 不连接集群的TiDBCluster，只用于测试表结构相关的方法
+class FakeCluster(main.TiDBCluster):
+    def __init__(self):
+        self._pd_schema_map = {}
+        self._table_region_map = {}
+
+    def _get_tidb_status_addresses(self):
+        return ["tidb:10080"]
+
+
+def new_region(region_id, start_key, end_key, approximate_size):
+    region = main.Region()
+    region.region_id = region_id
+    region.start_key = start_key
+    region.end_key = end_key
+    region.approximate_size = approximate_size
+    region.has_pd_stats = True
+    return region
+
+
+def new_table(partitions, index_list):
+    table_info = main.TableInfo()
+    table_info.dbname = "db"
+    table_info.tabname = "t"
+    for physical_id, partition_name in partitions:
+        table_info.add_physical_segments(physical_id, partition_name, index_list)
+        table_info.partition_name_list.append(partition_name)
+        table_info.index_name_list.extend([index_name for index_id, index_name in index_list])
+    return table_info
+
+
+def row_key(table_id, handle):
+    return main.encode_table_key(table_id, b"_r" + main.encode_comparable_int64(handle))
+
+
+class EncodeKeyTest(unittest.TestCase):
+    def test_memcomparable_bytes(self):
+        self.assertEqual(b"\x00" * 8 + b"\xf7", main.encode_memcomparable_bytes(b""))
+        self.assertEqual(b"abc" + b"\x00" * 5 + b"\xfa", main.encode_memcomparable_bytes(b"abc"))
+        self.assertEqual(b"12345678\xff" + b"\x00" * 8 + b"\xf7", main.encode_memcomparable_bytes(b"12345678"))
+
+    def test_comparable_int64(self):
+        self.assertEqual("8000000000000064", binascii.hexlify(main.encode_comparable_int64(100)).decode())
+        self.assertTrue(main.encode_comparable_int64(-1) < main.encode_comparable_int64(0))
+
+    def test_key_order(self):
+        # 索引key在数据key之前，表之间按id排序
+        self.assertTrue(main.encode_index_key(100, 1) < main.encode_index_key(100, 2) < main.encode_record_key(100))
+        self.assertTrue(main.encode_record_key(100) < row_key(100, 1) < main.encode_table_key(100, b"_s"))
+        self.assertTrue(main.encode_table_key(100, b"_s") < main.encode_table_key(101))
+
+    def test_key_range_overlap(self):
+        self.assertTrue(main.is_key_range_overlap(b"a", b"", b"b", b"c"))
+        self.assertTrue(main.is_key_range_overlap(b"a", b"c", b"b", b"d"))
+        self.assertFalse(main.is_key_range_overlap(b"a", b"b", b"b", b"d"))
+        self.assertFalse(main.is_key_range_overlap(b"d", b"", b"b", b"d"))
+
+
+class KeyRangeIndexTest(unittest.TestCase):
+    def test_key_range_fraction(self):
+        self.assertEqual(1.0, main.key_range_fraction(b"", b"", b"", b""))
+        self.assertAlmostEqual(0.5, main.key_range_fraction(b"\x00", b"\x02", b"\x00", b"\x01"))
+        # 位于key中较深位置的索引id也能区分
+        start, end = main.encode_index_key(100, 1), main.encode_index_key(100, 3)
+        self.assertAlmostEqual(0.5, main.key_range_fraction(start, end, start, main.encode_index_key(100, 2)))
+
+    def test_overlaps_fraction_of_region(self):
+        index = main.KeyRangeIndex([(b"b", b"c", "x"), (b"d", b"f", "y"), (b"h", b"i", "z")])
+        self.assertEqual([], index.overlaps(b"f", b"h"))
+        result = dict(index.overlaps(b"b", b"f"))
+        self.assertEqual(["x", "y"], sorted(result.keys()))
+        self.assertAlmostEqual(0.25, result["x"])
+        self.assertAlmostEqual(0.5, result["y"])
+        # 没有边界的region以所有区间的范围作为边界
+        self.assertEqual(["x", "y", "z"], sorted(dict(index.overlaps(b"", b"")).keys()))
+
+    def test_distribute_by_weights(self):
+        self.assertEqual({"a": 334, "b": 333, "c": 333}, main.distribute_by_weights(1000, {"a": 1, "b": 1, "c": 1}))
+        self.assertEqual({"a": 0, "b": 0}, main.distribute_by_weights(1000, {"a": 0, "b": 0}))
+
+
+class SegmentSizesTest(unittest.TestCase):
+    def test_one_region_covers_whole_table(self):
+        table_info = new_table([(100, "t")], [(1, "a"), (2, "b")])
+        region = new_region(1, b"", b"", 10)
+        table_info.all_region_map[1] = region
+        partition_sizes, index_sizes, split_segments = table_info.get_segment_sizes(1000, 600)
+        self.assertEqual({"t": 1000}, partition_sizes)
+        self.assertEqual(600, sum(index_sizes.values()))
+        self.assertEqual(index_sizes["a"], index_sizes["b"])
+        # 索引按key范围比例拆分，只有一个分区时分区的大小不需要拆分
+        self.assertEqual(set([("index", "a"), ("index", "b")]), split_segments)
+
+    def test_segments_sum_to_total(self):
+        table_info = new_table([(100, "p0"), (101, "p1")], [(1, "a"), (2, "b")])
+        regions = [
+            new_region(1, b"", main.encode_index_key(100, 2), 80),  # p0.a
+            new_region(2, main.encode_index_key(100, 2), row_key(100, 1000), 40),  # p0.b和p0的数据
+            new_region(3, row_key(100, 1000), main.encode_index_key(101, 1), 100),  # p0的数据
+            new_region(4, main.encode_index_key(101, 1), b"", 200),  # p1的索引和数据
+        ]
+        for region in regions:
+            table_info.all_region_map[region.region_id] = region
+        partition_sizes, index_sizes, split_segments = table_info.get_segment_sizes(12345, 5432)
+        self.assertEqual(12345, sum(partition_sizes.values()))
+        self.assertEqual(5432, sum(index_sizes.values()))
+        # p0占80+40+100，p1占200
+        self.assertAlmostEqual(220.0 / 420, partition_sizes["p0"] / 12345.0, places=3)
+        self.assertTrue(index_sizes["a"] > index_sizes["b"])
+        # region 1只包含p0.a，region 4同时包含p1的数据和索引
+        self.assertEqual(set([("index", "b"), ("index", "a")]), split_segments)
+        regions[2].end_key = b""
+        del table_info.all_region_map[4]
+        self.assertTrue(("partition", "p1") in table_info.get_segment_sizes(12345, 5432)[2])
+
+    def test_no_pd_stats(self):
+        table_info = new_table([(100, "t")], [(1, "a")])
+        table_info.all_region_map[1] = main.Region()
+        self.assertEqual(({"t": 0}, {"a": 0}, set()), table_info.get_segment_sizes(1000, 100))
+
+
+
+class PDScanRangeTest(unittest.TestCase):
+    def test_pd_schema_once(self):
+        schema = [{"id": 100, "name": {"L": "t1"}, "index_info": [{"id": 1, "idx_name": {"L": "a"}}]},
+                   {"id": 101, "name": {"L": "t2"}, "index_info": None,
+                    "partition": {"definitions": [{"id": 102, "name": {"L": "p0"}}, {"id": 103, "name": {"L": "p1"}}]}}]
+        requests = []
+
+        def fake_request(addresses, path):
+            requests.append(path)
+            return FakeResponse(json.dumps(schema).encode("utf-8"))
+
+        cluster = FakeCluster()
+        old_request = main.http_client.request
+        main.http_client.request = fake_request
+        try:
+            self.assertEqual({"t1": ([(1, "a")], [(100, "t1")]), "t2": ([], [(102, "p0"), (103, "p1")])},
+                             cluster.get_pd_schema4db("db"))
+            self.assertEqual(["t1", "t2"], cluster._sort_tablist_byid("db", ["t2", "t1"]))
+            segments = {}
+            skipped_ids = set()
+            cluster._add_pd_segments4db("db", ["t1"], segments, skipped_ids)
+        finally:
+            main.http_client.request = old_request
+        self.assertEqual(["/schema/db"], requests)
+        self.assertEqual([100], sorted(segments.keys()))
+        self.assertEqual(set([102, 103]), skipped_ids)
+
+    def test_skip_unselected_tables(self):
+        id_db_map = {100: "db1", 101: "db1", 105: "db1", 110: "db1"}
+        # 101和105之间有未选中的表103
+        self.assertEqual([(100, 101), (105, 110)],
+                         main.get_pd_scan_ranges([100, 101, 105, 110], set([103, 200]), id_db_map))
+        self.assertEqual([(100, 110)], main.get_pd_scan_ranges([100, 101, 105, 110], set(), id_db_map))
+
+    def test_split_by_db(self):
+        id_db_map = {100: "db1", 101: "db2", 105: "db2"}
+        # 不同数据库的表只有id相邻时才合并
+        self.assertEqual([(100, 105)], main.get_pd_scan_ranges([100, 101, 105], set(), id_db_map))
+        id_db_map = {100: "db1", 105: "db2"}
+        self.assertEqual([(100, 100), (105, 105)], main.get_pd_scan_ranges([100, 105], set(), id_db_map))
+
+
+    def test_approximate_stats_scan_selected_tables(self):
+        small = new_table([(100, "t")], [])
+        big = new_table([(200, "p0"), (201, "p1")], [])
+        for region_id in range(1, 301):
+            region = main.Region()
+            region.region_id = region_id
+            (small if region_id <= 2 else big).all_region_map[region_id] = region
+        scans = []
+
+        def scan_pd_regions(start_key, end_key=b"", limit=10000):
+            scans.append((start_key, end_key))
+            return [{"id": region_id, "approximate_size": 1, "approximate_keys": 10} for region_id in range(1, 301)]
+
+        cluster = FakeCluster()
+        cluster.scan_pd_regions = scan_pd_regions
+        cluster._fill_region_approximate_stats({"db.small": small, "db.big": big})
+        # 只扫描选中的表的key范围，同一张表的分区合并为一次扫描
+        self.assertEqual([(main.encode_table_key(100), main.encode_table_key(101)),
+                          (main.encode_table_key(200), main.encode_table_key(202))], scans)
+        self.assertTrue(all(region.has_pd_stats for region in big.all_region_map.values()))
+        # region_ids只包含small的region时按region_id获取，不扫描
+        del scans[:]
+        for region in small.all_region_map.values():
+            region.has_pd_stats = False
+        cluster._get_pd_addresses = lambda: ["pd:2379"]
+        old_get_json = main.http_client.get_json
+        main.http_client.get_json = lambda addresses, path: ({"id": int(path.rsplit("/", 1)[1])}, None)
+        try:
+            cluster._fill_region_approximate_stats({"db.small": small, "db.big": big}, region_ids=set([1, 2]))
+        finally:
+            main.http_client.get_json = old_get_json
+        self.assertEqual([], scans)
+        self.assertTrue(all(region.has_pd_stats for region in small.all_region_map.values()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# encoding=utf8
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+# 老版本tikv-ctl region-properties的输出，sst_files只包含writecf
+OLD_FORMAT = """mvcc.min_ts: 1
+mvcc.max_ts: 2
+mvcc.num_rows: 10
+mvcc.num_puts: 12
+mvcc.num_deletes: 2
+mvcc.num_versions: 14
+mvcc.max_row_versions: 3
+num_entries: 16
+num_deletes: 4
+num_files: 2
+sst_files: 000011.sst, 000012.sst
+region.start_key: 7480
+"""
+
+# 新版本tikv-ctl按cf打印
+NEW_FORMAT = """mvcc.min_ts: 1
+mvcc.max_ts: 2
+mvcc.num_rows: 10
+mvcc.num_puts: 12
+mvcc.num_deletes: 2
+mvcc.num_versions: 14
+mvcc.max_row_versions: 3
+writecf.num_entries: 16
+writecf.num_deletes: 4
+writecf.num_files: 1
+writecf.sst_files: 000011.sst
+defaultcf.num_entries: 8
+defaultcf.num_deletes: 0
+defaultcf.num_files: 1
+defaultcf.sst_files: 000012.sst
+region.start_key: 7480
+"""
+
+
+class ParseRegionPropertiesTest(unittest.TestCase):
+    def test_sstfiles_old_format(self):
+        self.assertEqual((["000011.sst", "000012.sst"], True), main.parse_region_sstfiles(OLD_FORMAT))
+
+    def test_sstfiles_new_format(self):
+        self.assertEqual((["000011.sst", "000012.sst"], False), main.parse_region_sstfiles(NEW_FORMAT))
+
+    def test_mvcc_old_format(self):
+        self.assertEqual([10, 12, 2, 14, 3, 16, 4], main.parse_region_mvcc(OLD_FORMAT))
+
+    def test_mvcc_new_format(self):
+        self.assertEqual([10, 12, 2, 14, 3, 16, 4], main.parse_region_mvcc(NEW_FORMAT))
+
+    def test_mvcc_missing(self):
+        self.assertIsNone(main.parse_region_mvcc("sst_files: 000011.sst\n"))
+
+    def test_sum_mvcc_stats(self):
+        regions = []
+        for mvcc_stats in ([10, 12, 2, 14, 3, 16, 4], [30, 30, 0, 36, 5, 48, 12], None):
+            region = main.Region()
+            region.mvcc_stats = mvcc_stats
+            regions.append(region)
+        stats = main.sum_mvcc_stats(regions)
+        self.assertEqual(2, stats["regions"])
+        self.assertEqual(40, stats["num_rows"])
+        self.assertEqual(50, stats["num_versions"])
+        self.assertEqual(5, stats["max_row_versions"])
+        self.assertEqual(16, stats["tombstones"])
+        self.assertAlmostEqual(0.2, stats["garbage_ratio"])
+        self.assertAlmostEqual(0.25, stats["tombstone_ratio"])
+
+
+if __name__ == "__main__":
+    unittest.main()
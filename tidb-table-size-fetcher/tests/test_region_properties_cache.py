@@ -0,0 +1,56 @@
+# encoding=utf8
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def new_region(approximate_size=10, approximate_keys=1000):
+    region = main.Region()
+    region.region_id = 1
+    region.conf_ver = 5
+    region.version = 8
+    region.approximate_size = approximate_size
+    region.approximate_keys = approximate_keys
+    region.has_pd_stats = True
+    return region
+
+
+class RegionPropertiesCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = main.RegionPropertiesCache(os.path.join(self.tmpdir, "cache.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_epoch_and_peer(self):
+        region = new_region()
+        self.cache.put(region, "kv1:20160", {"sst_files": ["000011.sst"], "pd_stats": [10, 1000]})
+        self.assertEqual("kv1:20160", self.cache.lookup(region, ["kv1:20160"])[0])
+        self.assertIsNone(self.cache.lookup(region, ["kv2:20160"]))
+        region.version += 1
+        self.assertIsNone(self.cache.lookup(region, ["kv1:20160"]))
+
+    def test_flush_marker(self):
+        region = new_region()
+        self.cache.put(region, "kv1:20160", {"sst_files": ["000011.sst"], "pd_stats": [10, 1000]})
+        properties = self.cache.lookup(region, ["kv1:20160"])[1]
+        self.assertTrue(main.TiDBCluster.is_cached_properties_valid(region, properties))
+        # flush、ingest之后epoch不变，region的统计信息发生变化
+        self.assertFalse(main.TiDBCluster.is_cached_properties_valid(new_region(10, 1200), properties))
+        self.assertFalse(main.TiDBCluster.is_cached_properties_valid(new_region(12, 1000), properties))
+        region.has_pd_stats = False
+        self.assertFalse(main.TiDBCluster.is_cached_properties_valid(region, properties))
+        # 老版本的缓存中没有统计信息
+        self.assertFalse(main.TiDBCluster.is_cached_properties_valid(new_region(), {"sst_files": ["000011.sst"]}))
+
+
+if __name__ == "__main__":
+    unittest.main()
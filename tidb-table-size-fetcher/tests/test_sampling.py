@@ -0,0 +1,90 @@
+# encoding=utf8
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def new_region(region_id, sst_nos, sst_size=100, node_id="kv1:20160"):
+    region = main.Region()
+    region.region_id = region_id
+    region.leader_store_node_id = node_id
+    region.props_node_id = node_id
+    region.sst_nos.extend(sst_nos)
+    region.sst_sizes.extend([sst_size] * len(sst_nos))
+    return region
+
+
+def new_table(data_regions, index_regions, both_regions):
+    table_info = main.TableInfo()
+    table_info.dbname = "db"
+    table_info.tabname = "t"
+    for region in data_regions + both_regions:
+        table_info.data_region_map[region.region_id] = region
+    for region in index_regions + both_regions:
+        table_info.index_region_map[region.region_id] = region
+    for region in data_regions + index_regions + both_regions:
+        table_info.all_region_map[region.region_id] = region
+    return table_info
+
+
+class SamplingTest(unittest.TestCase):
+    def test_shared_regions_sampled_for_index(self):
+        # 100个只属于数据的region，10个只属于索引的region，2个同时属于数据和索引的region
+        data_regions = [new_region(i, [i]) for i in range(1, 101)]
+        index_regions = [new_region(i, [i]) for i in range(101, 111)]
+        both_regions = [new_region(i, [i]) for i in range(111, 113)]
+        table_info = new_table(data_regions, index_regions, both_regions)
+        table_info.sample_regions(sample_ratio=0.1, rand=random.Random(1))
+        self.assertTrue(set([111, 112]) <= table_info.sampled_region_ids)
+        # 每个region一个100字节的sstfile，按层外推后和精确结果一致
+        self.assertEqual(12 * 100, table_info.get_all_index_size())
+        self.assertEqual(102 * 100, table_info.get_all_data_size())
+        self.assertEqual(112 * 100, table_info.get_all_table_size())
+
+    def test_unsampled_stratum_extrapolated(self):
+        regions = [new_region(i, [i]) for i in range(1, 11)]
+        table_info = new_table(regions, [], [])
+        table_info.sample_regions(sample_ratio=0.2, rand=random.Random(1))
+        # 抽样之后新加入的region
+        for i in range(11, 16):
+            region = new_region(i, [i], node_id="kv2:20160")
+            table_info.data_region_map[i] = region
+            table_info.all_region_map[i] = region
+        self.assertEqual(15 * 100, table_info.get_all_data_size())
+
+    def test_shared_sstfile_dedup(self):
+        # 所有region共用两个sstfile，和精确计算一样只计算一次
+        regions = [new_region(i, [1, 2]) for i in range(1, 5)]
+        table_info = new_table(regions, [], [])
+        table_info.sampled_region_ids = set([1, 2, 3, 4])
+        self.assertEqual(200, table_info.get_all_data_size())
+        self.assertEqual(table_info._get_xx_size(table_info.data_region_map), table_info.get_all_data_size())
+        self.assertEqual(0, table_info.get_all_data_size_err())
+
+    def test_size_and_err_in_one_pass(self):
+        regions = [new_region(i, [i], sst_size=100 + i) for i in range(1, 21)]
+        table_info = new_table(regions[:15], regions[15:], [])
+        table_info.sample_regions(sample_ratio=0.3, rand=random.Random(1))
+        expected = [(table_info.get_all_data_size(), table_info.get_all_data_size_err()),
+                    (table_info.get_all_index_size(), table_info.get_all_index_size_err()),
+                    (table_info.get_all_table_size(), table_info.get_all_table_size_err())]
+        calls = []
+        get_xx_size_sampled = table_info._get_xx_size_sampled
+
+        def count_calls(region_map):
+            calls.append(len(region_map))
+            return get_xx_size_sampled(region_map)
+
+        table_info._get_xx_size_sampled = count_calls
+        self.assertEqual(expected, [tuple(x) for x in table_info.get_all_sizes_with_err()])
+        # 数据、索引、整张表各计算一次
+        self.assertEqual([15, 5, 20], calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
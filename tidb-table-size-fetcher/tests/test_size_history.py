@@ -0,0 +1,96 @@
+# encoding=utf8
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class TableSizeHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "history.db")
+        self.history = main.TableSizeHistory(self.fname)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.tmpdir)
+
+    def points(self, granularity=0):
+        return self.history._conn.execute('''select ts,size_method,samples,table_size from size_history
+        where granularity=? order by ts''', (granularity,)).fetchall()
+
+    def test_local_time_alignment(self):
+        self.history.write("c1", [("db", "t1", 1, 2, 3)], "exact", "2024-03-05 10:59:59")
+        ts = self.points()[0][0]
+        self.assertEqual("2024-03-05 10:00", main.TableSizeHistory.format_ts(ts))
+
+    def test_write_keeps_better_size_method(self):
+        self.history.write("c1", [("db", "t1", 1, 1, 100)], "exact", "2024-03-05 10:05:00")
+        self.history.write("c1", [("db", "t1", 1, 1, 999)], "approximate", "2024-03-05 10:30:00")
+        self.assertEqual(100, self.points()[0][3])
+        self.history.write("c1", [("db", "t1", 1, 1, 120)], "exact", "2024-03-05 10:40:00")
+        self.assertEqual(120, self.points()[0][3])
+        self.history.write("c1", [("db", "t2", 1, 1, 50)], "approximate", "2024-03-05 10:05:00")
+        self.history.write("c1", [("db", "t2", 1, 1, 60)], "sample", "2024-03-05 10:30:00")
+        self.assertEqual([(1, 120), (1, 60)], [(row[1] if row[3] == 60 else 1, row[3]) for row in self.points()])
+
+    def test_downsample(self):
+        now = main.TableSizeHistory.parse_time("2024-03-20 12:00:00")
+        for day in range(1, 4):
+            for hour, size_method, size in ((1, "exact", 100 * day), (2, "exact", 100 * day + 20),
+                                            (3, "approximate", 9999)):
+                self.history.write("c1", [("db", "t1", 0, 0, size)], size_method,
+                                   "2024-03-%02d %02d:00:00" % (day, hour))
+        self.history.write("c1", [("db", "t1", 0, 0, 2000)], "exact", "2024-03-20 11:00:00")
+        self.history.downsample(now, {"hour": 7, "day": 30, "week": 0})
+        self.assertEqual([(now - 3600, 0, 1, 2000)], self.points(0))
+        # 每天只使用exact的两个点，按样本数加权平均
+        self.assertEqual([110, 210, 310], [row[3] for row in self.points(1)])
+        self.assertEqual([2, 2, 2], [row[2] for row in self.points(1)])
+        self.history.downsample(now + 30 * 86400)
+        self.assertEqual([(now - 12 * 3600, 0, 1, 2000)], self.points(1))
+        weeks = self.points(2)
+        self.assertEqual(1, len(weeks))
+        self.assertEqual("2024-02-26 00:00", main.TableSizeHistory.format_ts(weeks[0][0]))
+        self.assertEqual((6, 210), (weeks[0][2], weeks[0][3]))
+        # 保留天数记录在文件中
+        self.assertEqual({"hour": 7, "day": 30, "week": 0}, self.history.get_retention())
+
+    def test_growth(self):
+        self.history.write("c1", [("db", "t1", 0, 0, 100), ("db", "t2", 0, 0, 500)], "exact", "2024-03-01 01:00:00")
+        self.history.write("c1", [("db", "t1", 0, 0, 300)], "sample", "2024-03-02 01:00:00")
+        self.history.write("c2", [("db", "t1", 0, 0, 1)], "exact", "2024-03-02 01:00:00")
+        start = main.TableSizeHistory.parse_time("2024-03-01 00:00:00")
+        end = main.TableSizeHistory.parse_time("2024-03-03 00:00:00")
+        rows = self.history.growth("c1", start, end)
+        self.assertEqual([("db", "t1", 100, 300, ["exact", "sample"]), ("db", "t2", 500, 500, ["exact"])],
+                         [(row[0], row[1], row[4], row[5], row[6]) for row in rows])
+        self.assertEqual(1, len(self.history.growth("c1", start, end, size_method="sample")))
+        self.assertEqual(1, len(self.history.growth("c1", start, end, "db", ["t2"])))
+
+    def test_migrate_legacy(self):
+        main.load2sqlite3(self.fname, "c1", [["db", "t1", "False", 0, 1, "1B", 2, "2B", 30, "30B"]], "exact",
+                          "2024-03-01 01:10:00")
+        main.load2sqlite3(self.fname, "c1", [["db", "t1", "False", 0, 1, "1B", 2, "2B", 99, "99B"]], "approximate",
+                          "2024-03-01 01:20:00")
+        self.assertEqual(2, self.history.migrate_legacy())
+        self.assertEqual(0, self.history.migrate_legacy())
+        self.assertEqual([30], [row[3] for row in self.points()])
+        main.load2sqlite3(self.fname, "c1", [["db", "t1", "False", 0, 1, "1B", 2, "2B", 40, "40B"]], "exact",
+                          "2024-03-01 02:00:00")
+        self.assertEqual(1, self.history.migrate_legacy())
+        self.history.drop_legacy()
+        conn = sqlite3.connect(self.fname)
+        self.assertEqual(0, conn.execute(
+            "select count(*) from sqlite_master where name='table_size_info'").fetchone()[0])
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
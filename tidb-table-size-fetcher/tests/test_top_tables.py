@@ -0,0 +1,85 @@
+# encoding=utf8
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def new_val(dbname, tabname, table_size):
+    return {"dbname": dbname, "tabname": tabname, "table_size": table_size}
+
+
+# 不连接集群的TiDBCluster，approximate大小为approx_sizes中的值，计算大小为approximate大小*ratio
+class FakeCluster(main.TiDBCluster):
+    def __init__(self, approx_sizes, window_max=3, ratio=1.0):
+        self.region_discovery = "table"
+        self.top_margin = 0.2
+        self.top_candidates = 2
+        self._table_region_map = {}
+        self._region_registry = {}
+        self.approx_sizes = approx_sizes
+        self.window_max = window_max
+        self.ratio = ratio
+        self.approx_calls = 0
+        self.refined_tables = []
+
+    def get_approximate_cluster_tables_size(self, db_tabname_list, calibration=None):
+        self.approx_calls += 1
+        table_map = {}
+        for dbname, tabname_list in db_tabname_list:
+            # 每批的表不能超过window
+            assert len(tabname_list) <= self.window_max
+            for tabname in tabname_list:
+                table_map[dbname + "." + tabname] = new_val(dbname, tabname, self.approx_sizes[tabname])
+        return table_map
+
+    def get_tables_size(self, db_tabname_list):
+        table_map = {}
+        for dbname, tabname_list in db_tabname_list:
+            for tabname in tabname_list:
+                self.refined_tables.append(tabname)
+                table_map[dbname + "." + tabname] = new_val(dbname, tabname,
+                                                            int(self.approx_sizes[tabname] * self.ratio))
+        return table_map
+
+
+def new_db_tabname_list(approx_sizes):
+    return [("db", sorted(approx_sizes.keys()))]
+
+
+class TopTablesTest(unittest.TestCase):
+    def test_top_approximate_bounded(self):
+        approx_sizes = dict(("t%02d" % (i), (i * 7) % 20) for i in range(20))
+        cluster = FakeCluster(approx_sizes)
+        ranking, dropped = cluster.get_top_approximate_tables(new_db_tabname_list(approx_sizes), 3, 3)
+        self.assertTrue(dropped)
+        self.assertEqual([19, 18, 17], [item[0] for item in ranking])
+        self.assertEqual(7, cluster.approx_calls)
+        ranking, dropped = cluster.get_top_approximate_tables(new_db_tabname_list(approx_sizes), 3, 3,
+                                                              cutoff=ranking[-1][:3])
+        self.assertEqual([16, 15, 14], [item[0] for item in ranking])
+
+    def test_top_skip_small_tables(self):
+        approx_sizes = dict(("t%02d" % (i), 2 ** i) for i in range(20))
+        cluster = FakeCluster(approx_sizes)
+        table_map = cluster.get_top_cluster_tables_size(new_db_tabname_list(approx_sizes), 2, cluster.get_tables_size,
+                                                        window=3)
+        self.assertEqual(set(["db.t19", "db.t18"]), set(table_map.keys()))
+        # t17的大小上限2^17*1.2小于第2大的表，不需要计算
+        self.assertEqual(["t19", "t18"], cluster.refined_tables)
+
+    def test_top_next_candidates(self):
+        # approximate大小都相同时无法跳过，候选表计算完之后继续获取下一轮候选表，直到所有表都计算过
+        approx_sizes = dict(("t%02d" % (i), 10) for i in range(10))
+        cluster = FakeCluster(approx_sizes)
+        table_map = cluster.get_top_cluster_tables_size(new_db_tabname_list(approx_sizes), 2, cluster.get_tables_size,
+                                                        window=3)
+        self.assertEqual(2, len(table_map))
+        self.assertEqual(sorted(approx_sizes.keys()), sorted(cluster.refined_tables))
+
+
+if __name__ == "__main__":
+    unittest.main()